@@ -91,8 +91,11 @@ struct __attribute__((packed)) ArmCommand {
 };
 
 
-// The one ArmCommand structure we care about is deemed to occupy the RPMsg
-// buffer defined in aphd_pru1_rpmsg.cc.
+// The ArmCommand structure we care about is deemed to occupy the RPMsg buffer
+// defined in aphd_pru1_rpmsg.cc. The ARM may send several commands back-to-back
+// in the same message (or RPMsg may deliver several messages at once), so
+// `handle_interrupt()` moves this pointer along the buffer from one command to
+// the next.
 ArmCommand* ARM_COMMAND = reinterpret_cast<ArmCommand*>(&RPMSG_BUFFER);
 
 
@@ -125,16 +128,25 @@ InterruptMeaning handle_interrupt() {
     // 1. Zero out the command field in the ARM_COMMAND structure, since this
     // is one of the things we check to make sure we're reading the ARM's
     // message correctly.
+    ARM_COMMAND = reinterpret_cast<ArmCommand*>(&RPMSG_BUFFER);
     ARM_COMMAND->command = 0U;
 
-    // 2. Read in data from the ARM. If it was too little data to contain a
-    // meaningful command structure, ignore it.
-    uint16_t received = aphd_pru1_rpmsg_receive();
+    // 2. Read in data from the ARM. Only the first RPMSG_BUFFER_SIZE bytes are
+    // guaranteed to be kept, so we ignore anything past that.
+    const uint16_t received = std::min(
+        aphd_pru1_rpmsg_receive(), static_cast<uint16_t>(RPMSG_BUFFER_SIZE));
                                    if (kDebug) SHMEM.rpmsg_debug_word = 0x0100;
-    if (received >= 8) {
+
+    // 3. Handle each command in the received data in turn. If there is too
+    // little data left to contain a meaningful command structure, ignore it.
+    uint16_t offset = 0;
+    while (received - offset >= 8) {
+      ARM_COMMAND = reinterpret_cast<ArmCommand*>(RPMSG_BUFFER + offset);
+      offset += 8;  // Skip past the command; for puts, we'll skip data too.
                                    if (kDebug) SHMEM.rpmsg_debug_word = 0x0200;
       // 3a. If the magic bytes at the beginning are the "go ahead" command,
       // return the "Proceed" symbol so that the PRU can get on with it.
+      // (The ARM should never send anything after a "go ahead" command.)
       if (ARM_COMMAND->command == kCommandGoAhead) {
                                    if (kDebug) SHMEM.rpmsg_debug_word = 0x0300;
         result = kImArmProceed;             // Tell caller to get on with it
@@ -152,10 +164,12 @@ InterruptMeaning handle_interrupt() {
       // 3c. Or, receive data from the ARM into the drive sector buffer.
       else if (ARM_COMMAND->command == kCommandPutDriveSectorData) {
                                    if (kDebug) SHMEM.rpmsg_debug_word = 0x0500;
-        if (!handle_put_drive_sector_data_command(received)) {
+        if (!handle_put_drive_sector_data_command(received - (offset - 8))) {
                                    if (kDebug) SHMEM.rpmsg_debug_word = 0x0599;
           result = kImArmFailedToHandle;
         }
+        offset += std::min(ARM_COMMAND->length_bytes,
+                           static_cast<uint16_t>(received - offset));
       }
 
       // 3d. Or, compute a checksum of the drive sector data.
@@ -166,6 +180,12 @@ InterruptMeaning handle_interrupt() {
           result = kImArmFailedToHandle;
         }
       }
+
+      // 3e. Or, we have no idea what this is, and we can't know where the next
+      // command would start. Ignore the rest of the data.
+      else {
+        break;
+      }
     }
 
     CT_INTC.SECR0 = (1 << eARMtoPRU1);    // Clear the interrupt
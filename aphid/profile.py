@@ -38,7 +38,10 @@ the emulator is not running or that some other, unforeseen error has occurred.
 """
 
 import argparse
+import collections
+import concurrent.futures
 import contextlib
+import ctypes
 import logging
 import mmap
 import os
@@ -49,9 +52,15 @@ import sys
 import threading
 import time
 
-from typing import BinaryIO, Dict, Generator, Iterator, Optional, Tuple, NamedTuple
+from typing import Any, BinaryIO, Callable, Deque, Dict, Generator, Iterator, List, Optional, Set, Tuple, NamedTuple, Union
 
+import profile_compressed
+import profile_dc42
+import profile_journal
+import profile_metrics
+import profile_overlay
 import profile_plugins
+import profile_trace
 
 
 ###################
@@ -62,7 +71,11 @@ import profile_plugins
 IMAGE_SIZE_P5  = 5175296   # 5 MB ProFile hard drive image size in bytes.
 IMAGE_SIZE_P10 = 10350592  # 10 MB ProFile hard drive image size in bytes.
 
+# Ways to allocate space for new disk image files; see `image_create`.
+IMAGE_CREATE_MODES = ('sparse', 'allocate')
+
 SECTOR_SIZE = 532  # Sector size in bytes. Cf. "block size" in spare tables.
+ZERO_SECTOR = bytes(SECTOR_SIZE)  # A sector's worth of $00 bytes.
 
 # This "secret" Cameo/Aphid device ID and protocol version is appended to the
 # end of the sector $FFFFFF spare table data structure, allowing software to
@@ -80,6 +93,10 @@ APHD_COMMAND_PUT_PART_1 = b'\xdb\x95\x4b\xc7' + struct.pack('<HH', 0, 354)
 APHD_COMMAND_PUT_PART_2 = b'\xdb\x95\x4b\xc7' + struct.pack('<HH', 354, 354)
 APHD_COMMAND_PUT_PART_3 = b'\xdb\x95\x4b\xc7' + struct.pack('<HH', 708, 356)
 APHD_COMMAND_GOAHEAD = b'\xa6\x93\x73\xea' + struct.pack('<HH', 0, 0)
+APHD_COMMAND_CHECKSUM = b'\x9d\xb9\x5b\xa3' + struct.pack('<HH', 0, 0)
+# Firmware that handles multiple commands per RPMsg message can accept both
+# "get" commands at once. See `aphd_get_sector`.
+APHD_COMMAND_GET_PARTS_1_AND_2 = APHD_COMMAND_GET_PART_1 + APHD_COMMAND_GET_PART_2
 
 # Here are the various ProFile operations that we pretend to do.
 PROFILE_READ = 0x00
@@ -93,6 +110,14 @@ ALL_PROFILE_WRITE_COMMANDS = (
 OCP_PREFIX = '/sys/devices/platform/ocp/'
 GPIO_PREFIX = '/sys/class/gpio/gpio'
 
+# Header pins to configure for PRU input, for PRU output, and for GPIO input.
+# GPIO numbers appear to be 32 * <GPIO module number> + <GPIO bit>.
+PRU_INPUT_PINS = ('P1_02', 'P1_30', 'P2_09')
+PRU_OUTPUT_PINS = ('P2_24', 'P2_35')
+GPIO_INPUT_PINS = (('P1_36', '110'), ('P1_33', '111'), ('P2_32', '112'),
+                   ('P2_30', '113'), ('P1_31', '114'), ('P2_34', '115'),
+                   ('P2_28', '116'), ('P1_29', '117'))
+
 # Paths to the filesystem objects that allow us to choose PRU firmware.
 PRU0_STATE_PATH = '/sys/class/remoteproc/remoteproc1/state'
 PRU1_STATE_PATH = '/sys/class/remoteproc/remoteproc2/state'
@@ -106,9 +131,21 @@ LED_PREFIX = '/sys/class/leds/beaglebone:green:usr'
 
 # The device we use to communicate with PRU1 over RPMsg
 RPMSG_DEVICE = '/dev/rpmsg_pru31'
+# We read from the RPMsg device this many bytes at a time: more than any single
+# RPMsg message from PRU1.
+RPMSG_READ_CHUNK = 2048
+# While waiting for the PRUs to come up, we check on them this often at first,
+# then half as often each time, up to the second figure (both in seconds).
+BRINGUP_BACKOFF = (0.001, 0.05)
+# A "handshake" with PRU 1 (see `pru1_handshake`) gives up on a probe this
+# long after sending it at first, then twice as long each time, up to the
+# second figure (both in seconds).
+HANDSHAKE_BACKOFF = (0.01, 1.0)
 
 # Precomputed even parity lookup table.
 PARITY = tuple(0x00 if bin(c).count('1') % 2 else 0xff for c in range(256))
+# The same table in a form suitable for `bytes.translate`.
+PARITY_TABLE = bytes(PARITY)
 
 
 ##############################
@@ -125,12 +162,145 @@ def _define_flags() -> argparse.ArgumentParser:
           'Device file for the RPMsg connection to PRU 1. By default, this '
           'is {}.'.format(RPMSG_DEVICE)))
   flags.add_argument(
-      '-v', '--verbose', action='store_true', help=(
-          'Enable verbose logging.'))
+      '-v', '--verbose', action='count', default=0, help=(
+          'Enable verbose logging, which summarises the Apple\'s commands '
+          'once a second. Give this flag twice to log every command instead.'))
   flags.add_argument(
       '-c', '--create', action='store_true', help=(
           'Create the empty hard drive image file image_file if it does not '
           'already exist.'))
+  flags.add_argument(
+      '--create_size', type=_image_size, default=IMAGE_SIZE_P5, help=(
+          'Size of the image file made by --create: "p5" for a 5 MB ProFile '
+          '(the default), "p10" for a ProFile-10, or any size in bytes.'))
+  flags.add_argument(
+      '--create_mode', choices=IMAGE_CREATE_MODES, default='sparse', help=(
+          'How --create allocates space for the image file: "sparse" (the '
+          'default) allocates space only as the Apple writes data, which is '
+          'fastest; "allocate" reserves all the space up front, so that the '
+          'emulator cannot run out of space later.'))
+  flags.add_argument(
+      '--flush_policy', choices=sorted(FLUSH_POLICIES), default='balanced',
+      help=(
+          'When to save changes to the disk image: "balanced" saves changes '
+          'within four seconds; "safe" saves within a second, or as soon as '
+          'the Apple pauses; "throughput" saves in large batches, every 30 '
+          'seconds. The following flags adjust the chosen policy.'))
+  flags.add_argument(
+      '--flush_delay', type=float, default=None, metavar='SECONDS', help=(
+          'Save changes to the disk image no more often than this.'))
+  flags.add_argument(
+      '--flush_max_dirty_kb', type=int, default=None, metavar='KB', help=(
+          'Save changes to the disk image straight away once this many '
+          'kilobytes of sectors have changed. 0 means no limit.'))
+  flags.add_argument(
+      '--flush_idle_ms', type=float, default=None, metavar='MS', help=(
+          'Save changes to the disk image straight away once the Apple has '
+          'sent no commands for this many milliseconds. 0 means never.'))
+  flags.add_argument(
+      '--create_overlay', type=str, default=None, metavar='BASE', help=(
+          'Create image_file, if it does not already exist, as a '
+          'copy-on-write overlay of the disk image file BASE. The overlay '
+          'stores only the sectors that differ from BASE. See '
+          'profile_overlay.py for details.'))
+  flags.add_argument(
+      '--journal', action='store_true', help=(
+          'Append sectors written by the Apple to a journal file alongside '
+          'the disk image, copying them into the disk image itself only from '
+          'time to time. This turns scattered writes to the storage device '
+          'into sequential ones. See profile_journal.py for details.'))
+  flags.add_argument(
+      '--no_leds', action='store_true', help=(
+          "Don't display status information on the PocketBeagle user LEDs. "
+          '(Useful for running the emulator on other computers, e.g. against '
+          'the simulated PRU1 in profile_simulator.py.)'))
+  flags.add_argument(
+      '--pipelined_rpmsg', action='store_true', help=(
+          'Request both halves of the sector data for a write from PRU 1 '
+          'with a single RPMsg message, instead of one half at a time. '
+          'Requires PRU 1 firmware that can handle multiple commands in one '
+          'message.'))
+  flags.add_argument(
+      '--spin_us', type=int, default=0, metavar='MICROSECONDS', help=(
+          'Before waiting (with poll) for data from PRU 1, spend up to this '
+          'many microseconds repeatedly checking for it instead. This spares '
+          'the latency of waking up from poll when PRU 1 replies quickly, at '
+          'the cost of CPU time. By default, 0: never spin.'))
+  flags.add_argument(
+      '--read_ahead', type=int, default=0, metavar='N', help=(
+          'After each read from the disk image, prepare the data for the '
+          'next N sectors for PRU 1 while waiting for the next command, so '
+          'that sequential reads can be answered without delay. By default, '
+          'N is 0: no read-ahead.'))
+  flags.add_argument(
+      '--prefault', choices=('none', 'boot', 'all'), default='none', help=(
+          'At start-up and after each switch of disk image files, bring the '
+          "disk image's first megabyte (boot) or all of it (all) into memory "
+          'in the background, so that the first reads are not delayed by the '
+          'microSD card; also advise the kernel how to read ahead depending '
+          "on the Apple's reads. By default, none of this happens."))
+  flags.add_argument(
+      '--trace', type=str, default=None, metavar='FILE', help=(
+          "Record the Apple's commands and how long each took to service in "
+          'FILE, for study with profile_trace.py. The file is replaced if '
+          'it exists already.'))
+  flags.add_argument(
+      '--trace_events', type=int, default=profile_trace.DEFAULT_EVENTS,
+      metavar='N', help=(
+          'With --trace, how many commands to keep in memory between saves '
+          'to the trace file (which happen whenever the disk image is '
+          'flushed). If the Apple issues more, the oldest are lost.'))
+  flags.add_argument(
+      '--trace_data', action='store_true', help=(
+          'With --trace, also record the data of each sector read or '
+          'written, so that the trace can be replayed through the emulator '
+          'with profile_benchmark.py replay. Each command kept in memory then '
+          'takes 552 bytes instead of 20, so consider a smaller '
+          '--trace_events.'))
+  flags.add_argument(
+      '--eager_plugins', action='store_true', help=(
+          'Load all "magic block" plugins at start-up. By default, each '
+          'plugin is loaded when the Apple first uses its block, so that the '
+          'emulator is ready for the Apple sooner.'))
+  flags.add_argument(
+      '--plugin_read_ahead', type=int, default=8, metavar='N', help=(
+          'After the Apple reads from a "magic block" plugin, have the '
+          'plugin prepare its replies to the N reads that usually follow, '
+          'if it can, so that those reads are answered without calling the '
+          'plugin. 0 disables this.'))
+  flags.add_argument(
+      '--plugin_deadline_ms', type=float, default=0.0, metavar='MS', help=(
+          'Run "magic block" plugins on threads of their own, and reply to '
+          'the Apple if a plugin is still working on a write after this '
+          'many milliseconds: the write is acknowledged and finished in the '
+          'background. (Reads always wait for the plugin\'s reply.) Read '
+          'block $FFFFFC to check on a plugin\'s background work; see '
+          'PluginWorker in profile.py. 0 runs plugins in the main thread '
+          'without a deadline.'))
+  flags.add_argument(
+      '--metrics_socket', type=str, default=None, metavar='PATH', help=(
+          'Serve counters and latency histograms for commands, plugin calls, '
+          'RPMsg retries, and flushes in the Prometheus text format to '
+          'anything that connects to a Unix domain socket at PATH (see '
+          'profile_metrics.py).'))
+  flags.add_argument(
+      '--pool_mb', type=int, default=32, metavar='MB', help=(
+          'Keep disk image files that were used recently (or listed by the '
+          'Apple through the filesystem ops plugin) open and ready in a '
+          'pool no larger than this many megabytes, so that the Apple can '
+          'switch back to them instantly. 0 disables the pool.'))
+  flags.add_argument(
+      '--sysfs_root', type=str, default='/', metavar='DIR', help=(
+          'Look for the sysfs objects that configure the PocketBeagle\'s '
+          'pins, PRUs, and LEDs beneath DIR instead of /, e.g. in a fake '
+          'sysfs tree (see profile_simulator.FakeSysfs) for trying out the '
+          'whole start-up sequence on another computer.'))
+  flags.add_argument(
+      '--rpmsg_settle_s', type=float, default=0.0, metavar='SECONDS', help=(
+          'After starting the PRU firmware, wait this long before trying to '
+          'send PRU 1 its "bootup" message. Ordinarily the emulator sends '
+          'the message as soon as the RPMsg device appears, and sends more '
+          'until the firmware answers.'))
   flags.add_argument(
       '--skip_pin_setup', action='store_true', help=(
           'Bypass the typical startup operation of configuring the I/O header '
@@ -154,6 +324,19 @@ def _define_flags() -> argparse.ArgumentParser:
   return flags
 
 
+def _image_size(value: str) -> int:
+  """Parse the value of the --create_size flag."""
+  sizes = {'p5': IMAGE_SIZE_P5, 'p10': IMAGE_SIZE_P10}
+  try:
+    size = sizes[value.lower()] if value.lower() in sizes else int(value)
+  except ValueError:
+    raise argparse.ArgumentTypeError(
+        'not "p5", "p10", or a number of bytes: {!r}'.format(value))
+  if size < SECTOR_SIZE: raise argparse.ArgumentTypeError(
+      'disk images must be at least {} bytes'.format(SECTOR_SIZE))
+  return size
+
+
 # From here on, the code starts silly and gets more serious the further you go.
 
 ######################
@@ -169,8 +352,21 @@ class LEDs:
   to turn LEDs on, turn them off, or cycle them through a blinking pattern.
   """
 
+  def __init__(self, enabled: bool = True, prefix: str = LED_PREFIX) -> None:
+    """Initialise an LEDs object.
+
+    Args:
+      enabled: If False, all LED "output" goes to /dev/null instead, which
+          allows the emulator to run on computers that aren't PocketBeagles.
+      prefix: Path to the sysfs objects for the LEDs, less the LED number.
+    """
+    self._enabled = enabled
+    self._prefix = prefix
+
   def __enter__(self) -> 'LEDs':
-    led_files = ['{}{}/brightness'.format(LED_PREFIX, i) for i in range(4)]
+    led_files = (
+        ['{}{}/brightness'.format(self._prefix, i) for i in range(4)]
+        if self._enabled else [os.devnull] * 4)
     self._leds = [open(lf, 'wb', buffering=0) for lf in led_files]
     # State for cycling the LEDs.
     self._current_in_cycle = 0   # Current state of the LED cycler.
@@ -243,34 +439,166 @@ class LEDs:
 #####################################################
 
 
-def setup_pins():
-  """Configure PocketBeagle pinmux configuration for Cameo/Aphid."""
+class SysfsPaths(NamedTuple(
+    'SysfsPaths', [('ocp_prefix', str),
+                   ('gpio_prefix', str),
+                   ('pru0_state', str),
+                   ('pru1_state', str),
+                   ('pru0_firmware', str),
+                   ('pru1_firmware', str),
+                   ('led_prefix', str)])):
+  """Where to find the sysfs objects for configuring the PocketBeagle.
+
+  Fields:
+    ocp_prefix: Prefix for pinmux objects; cf. `OCP_PREFIX`.
+    gpio_prefix: Prefix for GPIO objects; cf. `GPIO_PREFIX`.
+    pru0_state: remoteproc state object for PRU 0.
+    pru1_state: remoteproc state object for PRU 1.
+    pru0_firmware: remoteproc firmware chooser object for PRU 0.
+    pru1_firmware: remoteproc firmware chooser object for PRU 1.
+    led_prefix: Prefix for user LED objects; cf. `LED_PREFIX`.
+  """
+
+
+def sysfs_paths(root: str = '/') -> SysfsPaths:
+  """The usual `SysfsPaths`, perhaps moved beneath a different root directory.
+
+  Args:
+    root: Directory standing in for /, e.g. a fake sysfs tree for trying out
+        the emulator's start-up sequence on computers that aren't
+        PocketBeagles (see `profile_simulator.FakeSysfs`).
+
+  Returns:
+    Paths to the sysfs objects beneath `root`.
+  """
+  return SysfsPaths(*(os.path.join(root, p.lstrip('/')) for p in (
+      OCP_PREFIX, GPIO_PREFIX, PRU0_STATE_PATH, PRU1_STATE_PATH,
+      PRU0_FW_CHOOSER_PATH, PRU1_FW_CHOOSER_PATH, LED_PREFIX)))
+
+
+class _Inotify:
+  """Wakes up waiters when entries appear in (or change in) a directory.
+
+  For files like the RPMsg device, which udev creates in /dev some while
+  after PRU 1's firmware starts, this saves waiting out a polling interval.
+  Most sysfs objects never generate inotify events, so waiters should still
+  time out and check for themselves now and then. If inotify isn't available,
+  `wait` just sleeps.
+  """
+
+  # From <sys/inotify.h>.
+  _IN_ATTRIB = 0x004
+  _IN_MOVED_TO = 0x080
+  _IN_CREATE = 0x100
+
+  def __init__(self, directory: str) -> None:
+    """Initialise an _Inotify.
+
+    Args:
+      directory: Directory to watch.
+    """
+    self._fd = -1
+    try:
+      libc = ctypes.CDLL(None, use_errno=True)
+      self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+      if self._fd >= 0 and libc.inotify_add_watch(
+          self._fd, os.fsencode(directory),
+          self._IN_ATTRIB | self._IN_MOVED_TO | self._IN_CREATE) < 0:
+        self.close()
+    except (AttributeError, OSError):
+      self.close()
+
+  def wait(self, timeout: float) -> None:
+    """Wait up to `timeout` seconds for something to happen."""
+    if self._fd < 0:
+      time.sleep(timeout)
+    elif select.select([self._fd], [], [], timeout)[0]:
+      try:
+        while os.read(self._fd, 4096): pass  # Discard the events.
+      except BlockingIOError:
+        pass
+
+  def close(self) -> None:
+    """Stop watching."""
+    if self._fd >= 0: os.close(self._fd)
+    self._fd = -1
+
+
+def _wait_for(
+    condition: Callable[[], bool],
+    timeout: float,
+    watch: Optional[str] = None,
+) -> bool:
+  """Check `condition` until it's true or `timeout` seconds have passed.
+
+  Checks come at exponentially-increasing intervals (see `BRINGUP_BACKOFF`),
+  or sooner if anything happens in the directory `watch`.
+
+  Returns:
+    Whether `condition` became true in time.
+  """
+  deadline = time.monotonic() + timeout
+  interval, max_interval = BRINGUP_BACKOFF
+  inotify = None  # type: Optional[_Inotify]
+  try:
+    while not condition():
+      remaining = deadline - time.monotonic()
+      if remaining <= 0: return False
+      if inotify is None and watch is not None and os.path.isdir(watch):
+        inotify = _Inotify(watch)
+        continue  # Check again, in case we missed the moment.
+      if inotify is None:
+        time.sleep(min(interval, remaining))
+      else:
+        inotify.wait(min(interval, remaining))
+      interval = min(2 * interval, max_interval)
+    return True
+  finally:
+    if inotify is not None: inotify.close()
+
+
+def _read_text(path: str) -> str:
+  """Read the contents of a text file."""
+  with open(path, 'r') as f:
+    return f.read()
+
+
+def setup_pins(paths: Optional[SysfsPaths] = None):
+  """Configure PocketBeagle pinmux configuration for Cameo/Aphid.
+
+  Args:
+    paths: Where to find sysfs objects. By default, the usual places.
+  """
+  paths = paths or sysfs_paths()
 
   # These pins should be set for PRU input.
-  for pin in ('P1_02', 'P1_30', 'P2_09'):
+  for pin in PRU_INPUT_PINS:
     logging.info('Configuring pin %s as pruin', pin)
-    with open('{}ocp:{}_pinmux/state'.format(OCP_PREFIX, pin), 'w') as f:
+    with open('{}ocp:{}_pinmux/state'.format(paths.ocp_prefix, pin), 'w') as f:
       f.write('pruin\n')
 
   # These pins should be set for PRU output.
-  for pin in ('P2_24', 'P2_35'):
+  for pin in PRU_OUTPUT_PINS:
     logging.info('Configuring pin %s as pruout', pin)
-    with open('{}ocp:{}_pinmux/state'.format(OCP_PREFIX, pin), 'w') as f:
+    with open('{}ocp:{}_pinmux/state'.format(paths.ocp_prefix, pin), 'w') as f:
       f.write('pruout\n')
 
-  # These pins should be set for GPIO, input direction. The GPIO numbers
-  # appear to be 32 * <GPIO module number> + <GPIO bit>.
-  for pin, gpio in (('P1_36', '110'), ('P1_33', '111'), ('P2_32', '112'),
-                    ('P2_30', '113'), ('P1_31', '114'), ('P2_34', '115'),
-                    ('P2_28', '116'), ('P1_29', '117')):
+  # These pins should be set for GPIO, input direction.
+  for pin, gpio in GPIO_INPUT_PINS:
     logging.info('Configuring pin %s as GPIO, GPIO %s as input', pin, gpio)
-    with open('{}ocp:{}_pinmux/state'.format(OCP_PREFIX, pin), 'w') as f:
+    with open('{}ocp:{}_pinmux/state'.format(paths.ocp_prefix, pin), 'w') as f:
       f.write('gpio\n')
-    with open('{}{}/direction'.format(GPIO_PREFIX, gpio), 'w') as f:
+    with open('{}{}/direction'.format(paths.gpio_prefix, gpio), 'w') as f:
       f.write('in\n')
 
 
-def setup_pru_firmware(device, load_firmware=True):
+def setup_pru_firmware(
+    device: str,
+    load_firmware: bool = True,
+    paths: Optional[SysfsPaths] = None,
+    report: Optional['StartupReport'] = None,
+    settle: float = 0.0,
+):
   """Ensure PRU 0 and PRU 1 are running the Aphid firmware
 
   Stops any currently-running firmware running on the PRUs, directs the kernel
@@ -279,34 +607,40 @@ def setup_pru_firmware(device, load_firmware=True):
   Args:
     device: The device file for the RPMsg connection to PRU 1. (Usually this is
         `/dev/rpmsg_pru31`.) After starting the firmware, this routine sends
-        a meaningless message to PRU 1 to initiate its ordinary operation.
+        a meaningless message to PRU 1 to initiate its ordinary operation, and
+        waits for the firmware to answer; see `pru1_handshake`.
     load_firmware: If set, this routine will direct the kernel to load the
         firmware files `/lib/firmware/aphd_pru0_datapump.fw` and
         `/lib/firmware/aphd_pru1_control.fw` into the PRUs. Not necessary if the
         kernel is loading the firmware at boot time from
         `/lib/firmware/am335x-pru[01]-fw`.
+    paths: Where to find sysfs objects. By default, the usual places.
+    report: If not None, time the phases of this routine here.
+    settle: Seconds to wait after the firmware is running before sending
+        PRU 1 the message, as well as waiting for the firmware to answer.
 
   Raises:
     RuntimeError: Various errors in attempting to establish running firmware on
         the PRU, most relating to timeouts.
   """
+  paths = paths or sysfs_paths()
+  report = report or StartupReport()
+  states = (paths.pru0_state, paths.pru1_state)
 
   # Immediately after the PocketBeagle boots, the filesystem objects for
   # controlling PRUs may not be available. We wait on them for up to a minute.
-  for _ in range(600):
-    if all(os.path.exists(p) for p in [
-        PRU0_STATE_PATH, PRU1_STATE_PATH,
-        PRU0_FW_CHOOSER_PATH, PRU1_FW_CHOOSER_PATH]): break
-    time.sleep(0.1)
-  else:
-    raise RuntimeError(
-        'Gave up waiting for filesystem objects for PRU control to exist.')
+  with report.phase('waiting for remoteproc'):
+    if not _wait_for(lambda: all(os.path.exists(p) for p in states + (
+        paths.pru0_firmware, paths.pru1_firmware)), 60.0,
+                     watch=os.path.dirname(os.path.dirname(states[0]))):
+      raise RuntimeError(
+          'Gave up waiting for filesystem objects for PRU control to exist.')
 
   # Shut down any PRU firmware that might be running now.
   logging.info('Stopping any PRU firmware running now...')
   for i in (0, 1):
     try:
-      with open([PRU0_STATE_PATH, PRU1_STATE_PATH][i], 'w') as f:
+      with open(states[i], 'w') as f:
         f.write('stop\n')
     except IOError:
       logging.info("Couldn't stop PRU %d; maybe it's not running. "
@@ -315,40 +649,102 @@ def setup_pru_firmware(device, load_firmware=True):
   if load_firmware:
     # Indicate which firmware we'd like to run the PRU.
     logging.info('Pointing remoteproc at the Aphid PRU firmware...')
-    with open(PRU0_FW_CHOOSER_PATH, 'w') as f: f.write(PRU0_FW_NAME + '\n')
-    with open(PRU1_FW_CHOOSER_PATH, 'w') as f: f.write(PRU1_FW_NAME + '\n')
+    with open(paths.pru0_firmware, 'w') as f: f.write(PRU0_FW_NAME + '\n')
+    with open(paths.pru1_firmware, 'w') as f: f.write(PRU1_FW_NAME + '\n')
 
-  # Start the firmware.
+  # Start the firmware, and wait for both PRUs to be up and running.
   logging.info('Starting the Aphid PRU firmware...')
-  with open(PRU0_STATE_PATH, 'w') as f: f.write('start\n')
-  with open(PRU1_STATE_PATH, 'w') as f: f.write('start\n')
+  with report.phase('starting PRU firmware'):
+    for state in states:
+      with open(state, 'w') as f: f.write('start\n')
+    for i, state in enumerate(states):
+      if not _wait_for(lambda: _read_text(state) == 'running\n', 60.0):
+        raise RuntimeError('Gave up waiting on PRU {} firmware boot.'.format(i))
+
+  # The RPMsg device only appears once PRU 1's firmware has announced itself
+  # to the kernel, and then we make sure the firmware is listening.
+  with report.phase('waiting for RPMsg'):
+    if settle: time.sleep(settle)
+    if not _wait_for(lambda: os.path.exists(device), 60.0,
+                     watch=os.path.dirname(device)): raise RuntimeError(
+                         'Gave up waiting for {} to appear.'.format(device))
+  with report.phase('PRU 1 handshake'):
+    probes, elapsed = pru1_handshake(device, 60.0)
+  logging.info('PRU 1 answered the %s probe %.1f ms after the RPMsg device '
+               'appeared.', _ordinal(probes), 1000 * elapsed)
+
+
+def _ordinal(n: int) -> str:
+  """1st, 2nd, 3rd, 4th..."""
+  return '{}{}'.format(n, 'th' if 10 <= n % 100 < 20 else
+                       {1: 'st', 2: 'nd', 3: 'rd'}.get(n % 10, 'th'))
+
+
+def pru1_handshake(device: str, timeout: float) -> Tuple[int, float]:
+  """Send PRU 1 its "bootup" message and wait for the firmware to answer.
+
+  Just after it starts, the PRU 1 firmware waits for an RPMsg message in
+  order to learn critical identifiers for communicating back to the ARM; it
+  discards this message and any others that arrive with it. Messages that
+  arrive before it starts waiting are lost. So instead of waiting a fixed time
+  before sending the message and hoping for the best, we "probe" the firmware
+  with a command to checksum the drive sector buffer (which the firmware
+  answers without changing anything), and wait for the checksum. If it
+  doesn't come soon, we probe again, waiting twice as long each time (see
+  `HANDSHAKE_BACKOFF`). The first probe the firmware receives serves as its
+  "bootup" message; it answers the next one.
+
+  Each probe is a single message holding nothing but the command: the
+  firmware joins up all of the messages waiting for it before it looks for
+  commands, and gives up on everything after anything it doesn't recognise.
 
-  # Wait for both PRUs to be up and running.
-  for i in (0, 1):
-    for _ in range(600):
-      with open([PRU0_STATE_PATH, PRU1_STATE_PATH][i], 'r') as f:
-        if f.read() == 'running\n': break
-      time.sleep(0.1)
-    else:
-      raise RuntimeError('Gave up waiting on PRU {} firmware boot.'.format(i))
+  Args:
+    device: The device file for the RPMsg connection to PRU 1.
+    timeout: Give up after this many seconds.
 
-  if load_firmware:
-    # Despite all these precautions, it seems necessary to wait a bit to be
-    # assured that the PRU is ready for RPMsg communication, particularly after
-    # reboots. This is an empirical finding. It probably depends on load :-(
-    time.sleep(15.0)
-
-  # The firmware waits for an RPMsg message in order to learn critical
-  # identifiers for communicating back to the ARM. Here we send it a
-  # meaningless message as soon as we can, or give up after a minute of trying.
-  for _ in range(600):
+  Returns:
+    The number of probes sent, and the seconds elapsed until the firmware
+    answered.
+
+  Raises:
+    RuntimeError: The firmware didn't answer in time.
+  """
+  start = time.monotonic()
+  deadline = start + timeout
+  interval, max_interval = HANDSHAKE_BACKOFF
+  probes = 0
+  fd = None  # type: Optional[int]
+  try:
+    while True:
+      remaining = deadline - time.monotonic()
+      if remaining <= 0: raise RuntimeError(
+          'Gave up after {} attempts to get an answer from PRU 1.'.format(
+              probes))
+      try:
+        # The device may be there before we're allowed to open it, and the
+        # firmware may not be able to accept messages at first.
+        if fd is None: fd = os.open(device, os.O_RDWR | os.O_NONBLOCK)
+        os.write(fd, APHD_COMMAND_CHECKSUM)
+        probes += 1
+        if select.select([fd], [], [], min(interval, remaining))[0]: break
+      except OSError as error:
+        logging.debug('Probing PRU 1 via %s: %s', device, error)
+        if fd is not None: os.close(fd)
+        fd = None
+        time.sleep(min(interval, remaining))
+      interval = min(2 * interval, max_interval)
+    elapsed = time.monotonic() - start
+
+    # Discard the answer. Should an answer to an earlier probe turn up later,
+    # `aphd_await_command` will discard that too, as it's too short to be an
+    # Apple command.
     try:
-      with open(device, 'w') as f: f.write('\n')
-      break
-    except IOError:
-      time.sleep(0.1)
-  else:
-    raise RuntimeError('Gave up waiting to send a "bootup" message to PRU 1.')
+      os.read(fd, 2)
+    except BlockingIOError:
+      pass
+    return probes, elapsed
+  finally:
+    if fd is not None: os.close(fd)
 
 
 ###########################
@@ -359,7 +755,12 @@ def setup_pru_firmware(device, load_firmware=True):
 class Rpmsg(NamedTuple(
     'Rpmsg', [('fd', int),
               ('poll_read', select.poll),
-              ('poll_write', select.poll)])):
+              ('poll_write', select.poll),
+              ('put_frames', 'PutSectorFrames'),
+              ('pipelined', bool),
+              ('read_buffer', memoryview),
+              ('spin', Optional['SpinWait']),
+              ('metrics', Optional[profile_metrics.Registry])])):
   """I/O-related objects for RPMsg communication with PRU1.
 
   Use `rpmsg_io_init` to initialise/prepare this data structure.
@@ -368,10 +769,73 @@ class Rpmsg(NamedTuple(
     fd: A prepared read-write file descriptor for an RPMsg device file.
     poll_read: For detecting when reads will not block.
     poll_write: For detecting when writes will not block.
+    put_frames: Reusable buffers for commands that send sector data to PRU1.
+    pipelined: Whether to use pipelined transfers; see `aphd_get_sector`.
+    read_buffer: Reusable buffer for data read from PRU1.
+    spin: If not None, busy-wait for data from PRU1 before polling for it.
+    metrics: If not None, where to count retries and short reads.
+  """
+
+
+class SpinWait:
+  """Busy-waits for data from PRU1 for a little while before giving up.
+
+  Waking up from `poll` takes long enough on the PocketBeagle to make up a
+  noticeable part of every exchange with PRU1, which usually answers our
+  requests within microseconds. Retrying non-blocking reads for a short while
+  first avoids that wake-up delay whenever data arrives in time, at the cost
+  of keeping the CPU busy while we wait.
+
+  Attributes:
+    window: How long to spin for, in seconds.
+    waits: Number of times we've spun.
+    hits: Number of times that data arrived while we were spinning.
+    cpu_seconds: CPU time spent spinning.
   """
 
+  def __init__(self, window: float) -> None:
+    """Initialise a SpinWait.
+
+    Args:
+      window: How long to spin for, in seconds.
+    """
+    self.window = window
+    self.waits = 0
+    self.hits = 0
+    self.cpu_seconds = 0.0
+
+  def readinto(self, fd: int, buffer: memoryview) -> Optional[int]:
+    """Read data from `fd` into `buffer` if it arrives within the window.
+
+    Args:
+      fd: A non-blocking file descriptor to read.
+      buffer: Where to place the data.
+
+    Returns:
+      The number of bytes read, or None if no data arrived in time.
+    """
+    self.waits += 1
+    cpu_start = time.thread_time()
+    deadline = time.perf_counter() + self.window
+    try:
+      while True:
+        try:
+          count = os.readv(fd, [buffer])
+          self.hits += 1
+          return count
+        except BlockingIOError:
+          if time.perf_counter() >= deadline: return None
+          os.sched_yield()  # Let whatever's sending us data run, if it can.
+    finally:
+      self.cpu_seconds += time.thread_time() - cpu_start
+
 
-def rpmsg_io_init(fd: int) -> Rpmsg:
+def rpmsg_io_init(
+    fd: int,
+    pipelined: bool = False,
+    spin_window: float = 0.0,
+    metrics: Optional[profile_metrics.Registry] = None,
+) -> Rpmsg:
   """Prepare a file object for RPMsg I/O and derive `select.poll` objects.
 
   The argument file descriptor should be the device file used for two-way RPMsg
@@ -382,6 +846,11 @@ def rpmsg_io_init(fd: int) -> Rpmsg:
   Args:
     fd: A file descrptor referring to the PRU1 RPMsg device file. This
         descriptor will be manipulated as described above.
+    pipelined: Whether to use pipelined transfers with PRU1; see
+        `aphd_get_sector`.
+    spin_window: If positive, how long in seconds to busy-wait for data from
+        PRU1 before polling for it; see `SpinWait`.
+    metrics: If not None, where to count RPMsg retries and short reads.
 
   Returns:
     An Rpmsg object initialised from `fd`.
@@ -397,7 +866,37 @@ def rpmsg_io_init(fd: int) -> Rpmsg:
   poll_write.register(fd, select.POLLOUT)
 
   # Pack all RPMsg I/O objects and return.
-  return Rpmsg(fd, poll_read, poll_write)
+  return Rpmsg(fd, poll_read, poll_write, PutSectorFrames(), pipelined,
+               memoryview(bytearray(4 * RPMSG_READ_CHUNK)),
+               SpinWait(spin_window) if spin_window > 0 else None, metrics)
+
+
+def _rpmsg_readinto(rpmsg: Rpmsg, buffer: memoryview, delay: float) -> int:
+  """Wait for data from PRU1, then read it into `buffer`.
+
+  Args:
+    rpmsg: An Rpmsg object returned by `rpmsg_io_init`.
+    buffer: Where to place the data.
+    delay: How long in seconds to block while waiting for data from PRU1. A
+        negative value means wait indefinitely.
+
+  Returns:
+    The number of bytes read.
+
+  Raises:
+    RuntimeError: Failed (probably timed out) whilst waiting for RPMsg data
+        from PRU1.
+  """
+  fd = rpmsg.fd
+  if rpmsg.spin is not None:
+    count = rpmsg.spin.readinto(fd, buffer)
+    if count is not None: return count
+
+  # Wait for data to be ready to read.
+  if rpmsg.poll_read.poll(int(1000 * delay)) != [(fd, select.POLLIN)]:
+    raise RuntimeError(
+        'Waiting for data from PRU 1 on the RPMsg device was unsuccessful.')
+  return os.readv(fd, [buffer])
 
 
 def rpmsg_read(rpmsg: Rpmsg, length: int, delay: float = 5.0) -> bytes:
@@ -424,39 +923,100 @@ def rpmsg_read(rpmsg: Rpmsg, length: int, delay: float = 5.0) -> bytes:
     RuntimeError: Failed (probably timed out) whilst waiting for RPMsg data
         from PRU1.
   """
-  # Unpack RPMsg I/O objects; compute delay in ms.
-  fd, poll_read, _ = rpmsg
-  delay = int(1000 * delay)
-
-  # Wait for data to be ready to read.
-  if poll_read.poll(delay) != [(fd, select.POLLIN)]: raise RuntimeError(
-      'Waiting for data from PRU 1 on the RPMsg device was unsuccessful.')
-
-  # Read as much data as possible, 2k at a time; drain the file descriptor.
-  all_data_parts = []
-  while True:
-    data = os.read(fd, 2048)
-    all_data_parts.append(data)
-    if len(data) < 2048: break
+  # Unpack RPMsg I/O objects.
+  fd, buffer = rpmsg.fd, rpmsg.read_buffer
+
+  # Wait for data, then read as much data as possible, 2k at a time into our
+  # reusable buffer; drain the file descriptor.
+  count = _rpmsg_readinto(rpmsg, buffer[:RPMSG_READ_CHUNK], delay)
+  end = total = count
+  while count == RPMSG_READ_CHUNK:
+    if end + RPMSG_READ_CHUNK > len(buffer):  # Buffer full? Keep the newest
+      kept = min(length, end)                 # bytes and carry on.
+      buffer[:kept] = buffer[end - kept:end]
+      end = kept
+    try:
+      count = os.readv(fd, [buffer[end:end + RPMSG_READ_CHUNK]])
+    except BlockingIOError:
+      break
+    end += count
+    total += count
 
   # Return just those bytes requested. If we have collected more than the
   # number of bytes requested, we assume the oldest ones are stale and only
   # return the most recent values.
-  all_data = b''.join(all_data_parts)
-  if len(all_data) != length: logging.warning(
-      'Expected to read %d bytes from PRU1; read %d instead.',
-      length, len(all_data))
-  return all_data[-length:]
+  if total != length:
+    logging.warning(
+        'Expected to read %d bytes from PRU1; read %d instead.', length, total)
+    if rpmsg.metrics is not None: rpmsg.metrics.counter(
+        'aphid_rpmsg_short_reads_total',
+        'Reads from PRU1 that yielded an unexpected amount of data.').inc()
+  return bytes(buffer[max(0, end - length):end])
+
+
+def rpmsg_read_message(rpmsg: Rpmsg, delay: float = 5.0) -> bytes:
+  """Read one RPMsg message from PRU1.
+
+  Unlike `rpmsg_read`, this function makes no attempt to drain additional
+  data from PRU1, nor does it expect any particular amount of data.
 
+  Args:
+    rpmsg: An Rpmsg object returned by `rpmsg_io_init`.
+    delay: How long in seconds to block while waiting for data from PRU1. A
+        negative value means wait indefinitely.
+
+  Returns:
+    The message.
 
-def rpmsg_write(rpmsg: Rpmsg, data: bytes, delay: float = 5.0):
+  Raises:
+    RuntimeError: Failed (probably timed out) whilst waiting for RPMsg data
+        from PRU1.
+  """
+  buffer = rpmsg.read_buffer
+  count = _rpmsg_readinto(rpmsg, buffer[:RPMSG_READ_CHUNK], delay)
+  return bytes(buffer[:count])
+
+
+def rpmsg_drain(rpmsg: Rpmsg) -> int:
+  """Discard any data from PRU1 that is waiting to be read.
+
+  Args:
+    rpmsg: An Rpmsg object returned by `rpmsg_io_init`.
+
+  Returns:
+    The number of bytes discarded.
+  """
+  discarded = 0
+  try:
+    while True:
+      data = os.read(rpmsg.fd, RPMSG_READ_CHUNK)
+      if not data: break
+      discarded += len(data)
+  except BlockingIOError:
+    pass
+  return discarded
+
+
+def _count_retry(rpmsg: Rpmsg, operation: str) -> None:
+  """Count a retried RPMsg operation in `rpmsg`'s metrics, if any."""
+  if rpmsg.metrics is not None: rpmsg.metrics.counter(
+      'aphid_rpmsg_retries_total', 'RPMsg operations that had to be retried.',
+      operation=operation).inc()
+
+
+def rpmsg_write(
+    rpmsg: Rpmsg,
+    data: Union[bytes, memoryview],
+    delay: float = 5.0,
+):
   """Write `data` to PRU1 via RPMsg.
 
   Attempts (with some persistence) to write all of `data` to PRU1 via RPMsg.
 
   Args:
     rpmsg: An Rpmsg object returned by `rpmsg_io_init`.
-    data: bytes object of data to send to PRU1.
+    data: bytes-like object of data to send to PRU1. A memoryview is never
+        copied.
     delay: How long in seconds to block each time we wait until it is possible
         to write data to PRU1. A negative value means wait indefinitely.
 
@@ -465,15 +1025,17 @@ def rpmsg_write(rpmsg: Rpmsg, data: bytes, delay: float = 5.0):
         possible to write RPMsg data to PRU1.
   """
   # Unpack RPMsg I/O objects; compute delay in ms.
-  fd, _, poll_write = rpmsg
+  fd, poll_write = rpmsg.fd, rpmsg.poll_write
   delay = int(1000 * delay)
 
-  # Write data out bit by bit.
+  # Write data out bit by bit. (Usually it all goes in the first write, so we
+  # avoid slicing `data` unless we have to.)
   all_written = 0
   while all_written < len(data):
-    written = os.write(fd, data[all_written:])
+    written = os.write(fd, data[all_written:] if all_written else data)
 
     if written <= 0:  # If nothing was written, let's wait until we can write.
+      _count_retry(rpmsg, 'write')
       if poll_write.poll(delay) != [(fd, select.POLLOUT)]: raise RuntimeError(
           'Waiting to write to PRU 1 on the RPMsg device was unsuccessful.')
     else:  # Otherwise advance the write index.
@@ -529,118 +1091,485 @@ def make_spare_table(image_size: int) -> bytes:
 
 class Image(NamedTuple(
     'Image', [('image_file', BinaryIO),
-              ('mapped', mmap.mmap),
+              ('mapped', Optional[mmap.mmap]),
+              ('view', Optional[memoryview]),
               ('image_size', int),
-              ('spare_table', bytes)])):
+              ('spare_table', bytes),
+              ('journal', Optional[profile_journal.Journal]),
+              ('overlay', Optional[profile_overlay.Overlay]),
+              ('compressed', Optional[profile_compressed.CompressedImage]),
+              ('dc42', Optional[profile_dc42.Dc42Image])])):
   """I/O-related objects for memory-mapped disk image files.
 
   Use `image_mmap` to initialise/prepare this data structure.
 
   Fields:
-    image_file: A read-write handle for the disk image file. Don't modify the
+    image_file: A read-write handle for the disk image file (for overlays, a
+        read-only handle for the base disk image file). Don't modify the
         disk image file with this object; in fact, you probably shouldn't use
         it for anything.
-    mapped: A writeable mmap object for the file's entire contents.
+    mapped: A writeable mmap object for the file's entire contents (for
+        overlays, a read-only mmap of the base disk image file; for compressed
+        disk image files and dc42 files, None).
+    view: A memoryview of `mapped`, for retrieving sector data without copying
+        (for compressed disk image files and dc42 files, None).
     image_size: Size of the disk image in bytes.
     spare_table: Sector $FFFFFF spare table contents for this disk image.
+    journal: In journal mode, the journal of sector writes not yet copied to
+        the disk image; otherwise None.
+    overlay: For overlay disk image files (see `profile_overlay.py`), the
+        overlay holding sectors that differ from the base disk image;
+        otherwise None.
+    compressed: For compressed disk image files (see
+        `profile_compressed.py`), the open compressed disk image, which holds
+        all of the sector data; otherwise None.
+    dc42: For DiskCopy 4.2 files (see `profile_dc42.py`), the open dc42 file,
+        which holds all of the sector data; otherwise None.
   """
 
 
+def image_create(
+    path: str,
+    image_size: int = IMAGE_SIZE_P5,
+    mode: str = 'sparse',
+):
+  """Create a new disk image file full of $00 bytes.
+
+  Args:
+    path: Path to the new image file. There must not be a file there already.
+    image_size: Size of the new image file in bytes.
+    mode: One of IMAGE_CREATE_MODES. 'sparse' sets the file's size without
+        allocating any storage for it. 'allocate' allocates storage for the
+        entire file, which may take longer, but which guarantees that writes
+        to a memory map of the file will never fail for want of space.
+
+  Raises:
+    FileExistsError: There's already a file at `path`.
+    ValueError: `mode` wasn't one of IMAGE_CREATE_MODES.
+  """
+  if mode not in IMAGE_CREATE_MODES: raise ValueError(
+      'Unknown disk image creation mode {!r}'.format(mode))
+  start = time.perf_counter()
+  with open(path, 'xb') as f:
+    if mode == 'allocate':
+      os.posix_fallocate(f.fileno(), 0, image_size)
+    else:
+      f.truncate(image_size)
+  logging.info('Created the %d-byte disk image file %s (%s) in %.3f s.',
+               image_size, path, mode, time.perf_counter() - start)
+
+
 @contextlib.contextmanager
-def image_mmap(path: str, create: bool) -> Generator[Image, None, None]:
+def image_mmap(
+    path: str,
+    create: bool,
+    journal: bool = False,
+    create_size: int = IMAGE_SIZE_P5,
+    create_mode: str = 'sparse',
+) -> Generator[Image, None, None]:
   """mmap (after optionally creating) the disk image file.
 
   A context manager that opens and mmaps the disk image file, optionally
-  creating it beforehand if `create` is True and the file does not exist.
-  (Created image files are always 5 MB ProFile images, but disk image files
-  can be any size.) When control exits the context, the map is closed and the
+  creating it beforehand (see `image_create`) if `create` is True and the file
+  does not exist. When control exits the context, the map is closed and the
   file is sync'd to disk.
 
+  If a journal from an earlier journal-mode session (see `profile_journal.py`)
+  is present, its contents are copied into the disk image first, whether or
+  not this session uses journal mode.
+
+  If the disk image file is an overlay (see `profile_overlay.py`), its base
+  disk image file is mapped read-only instead, and changed sectors are kept
+  in the overlay file. Journal mode is unavailable for overlays.
+
+  If the disk image file is compressed (see `profile_compressed.py`), it isn't
+  mapped at all: sectors are decompressed as needed instead. Journal mode is
+  unavailable for compressed disk image files, too.
+
+  Likewise, a DiskCopy 4.2 file (whose name must end in `.dc42`; see
+  `profile_dc42.py`) is mapped, but its sectors are reassembled from their
+  separate data and tag parts as needed. Journal mode is unavailable for these
+  files as well.
+
   Args:
     path: Path to the image file.
-    create: Boolean indicating whether to create the image file. If True,
-        there must not be a file at `path`.
+    create: Boolean indicating whether to create the image file if there is
+        no file at `path`.
+    journal: Whether to use journal mode for writes to the disk image.
+    create_size: Size in bytes of the image file, if created.
+    create_mode: How to allocate space for the image file, if created; see
+        `image_create`.
 
   Yields:
     An Image object initialised from `path`.
   """
 
   # Create the new image file if directed.
-  if create:
-    if os.path.isfile(path): raise IOError(
-        "File {} already exists; won't overwrite it with a new disk "
-        'image.'.format(path))
-    with open(path, 'wb') as f:
-      for s in range(IMAGE_SIZE_P5 // SECTOR_SIZE):
-        f.write(bytes(SECTOR_SIZE))
-      f.flush()
+  if create and not os.path.exists(path):
+    image_create(path, create_size, create_mode)
+
+  # Compressed disk image files keep their own cache of decompressed sectors.
+  if profile_compressed.is_compressed(path):
+    if journal: logging.warning('Journal mode is unavailable for the '
+                                'compressed disk image %s; ignoring.', path)
+    compressed = profile_compressed.CompressedImage(path)
+    try:
+      with open(path, 'rb') as bf:
+        yield Image(bf, None, None, compressed.image_size,
+                    make_spare_table(compressed.image_size), None, None,
+                    compressed, None)
+    finally:
+      compressed.close()
+    return
+
+  # So do DiskCopy 4.2 files, more or less.
+  if profile_dc42.is_dc42(path):
+    if journal: logging.warning(
+        'Journal mode is unavailable for the dc42 file %s; ignoring.', path)
+    dc42 = profile_dc42.Dc42Image(path)
+    try:
+      with open(path, 'rb') as bf:
+        yield Image(bf, None, None, dc42.image_size,
+                    make_spare_table(dc42.image_size), None, None, None, dc42)
+    finally:
+      dc42.close()
+    return
+
+  # Overlays keep changed sectors to themselves and read the rest from their
+  # base disk image file, which we never modify.
+  overlay = None  # type: Optional[profile_overlay.Overlay]
+  if profile_overlay.is_overlay(path):
+    overlay = profile_overlay.Overlay(path)
+    if journal: logging.warning(
+        'Journal mode is unavailable for the overlay %s; ignoring.', path)
+    journal = False
+  mapped_path = path if overlay is None else overlay.base_path
 
   # Measure the size of the image file and use that to create the data for the
   # spare table.
-  image_size = os.stat(path).st_size
-  logging.info('Mapping the %d-byte disk image file %s.', image_size, path)
+  image_size = os.stat(mapped_path).st_size
+  logging.info('Mapping the %d-byte disk image file %s.',
+               image_size, mapped_path)
   spare_table = make_spare_table(image_size)
 
   # Open and mmap the file to allow reads and writes. Yield the file object
   # and the memory. When the caller is done with it, aggressively save.
-  with open(path, 'rb+') as bf:
-    mem = mmap.mmap(bf.fileno(), length=image_size, access=mmap.ACCESS_WRITE)
+  with contextlib.ExitStack() as stack:
+    if overlay is not None: stack.callback(overlay.close)
+    bf = stack.enter_context(
+        open(mapped_path, 'rb+' if overlay is None else 'rb'))
+    mem = mmap.mmap(bf.fileno(), length=image_size, access=(
+        mmap.ACCESS_WRITE if overlay is None else mmap.ACCESS_READ))
+    view = memoryview(mem)
+    image_journal = None  # type: Optional[profile_journal.Journal]
     try:
-      yield Image(bf, mem, image_size, spare_table)
+      journal_path = profile_journal.journal_path(path)
+      if journal or (overlay is None and os.path.exists(journal_path)):
+        image_journal = profile_journal.Journal(journal_path, mem, image_size)
+        if not journal:  # It's been replayed; we don't need it anymore.
+          image_journal.close()
+          image_journal = None
+          os.remove(journal_path)
+      yield Image(bf, mem, view, image_size, spare_table, image_journal,
+                  overlay, None, None)
     finally:
+      if image_journal is not None: image_journal.close()
       mem.flush()
-      mem.close()
+      view.release()
+      try:
+        mem.close()
+      except BufferError:
+        # Some sector memoryview is still alive somewhere, perhaps in an
+        # exception traceback. The data is safe, and the map will be closed
+        # when the memoryview is garbage-collected.
+        logging.warning('Disk image memory map still in use; not closing.')
       logging.info('Final disk image data flush complete. '
                    'Disk image file closed.')
 
 
+class FlushPolicy(NamedTuple(
+    'FlushPolicy', [('delay', float),
+                    ('max_dirty_bytes', int),
+                    ('idle', float)])):
+  """When an `ImageFlusher` should save changes to the disk image file.
+
+  Fields:
+    delay: Flush no more frequently than this often, in seconds (unless one of
+        the other fields says otherwise).
+    max_dirty_bytes: If positive, flush straight away once this many bytes of
+        sector data have changed.
+    idle: If positive, flush straight away once the Apple has sent no
+        commands for this many seconds.
+  """
+
+
+# Named flush policies for the --flush_policy flag.
+FLUSH_POLICIES = {
+    # A change is saved within four seconds. The original behaviour.
+    'balanced': FlushPolicy(delay=4.0, max_dirty_bytes=0, idle=0.0),
+    # Changes are saved within a second, or as soon as the Apple pauses.
+    'safe': FlushPolicy(delay=1.0, max_dirty_bytes=64 * 1024, idle=0.05),
+    # Changes are saved in big batches, so a power cut may lose more of them.
+    'throughput': FlushPolicy(delay=30.0, max_dirty_bytes=4 << 20, idle=0.0),
+}  # type: Dict[str, FlushPolicy]
+
+
+class Histogram:
+  """A histogram of durations, with power-of-two buckets of microseconds."""
+
+  def __init__(self, name: str) -> None:
+    """Initialise a Histogram.
+
+    Args:
+      name: What the histogram measures, for `lines`.
+    """
+    self._name = name
+    self._counts = {}  # type: Dict[int, int]
+
+  def add(self, seconds: float) -> None:
+    """Count a duration of `seconds` seconds."""
+    bucket = int(seconds * 1e6).bit_length()
+    self._counts[bucket] = self._counts.get(bucket, 0) + 1
+
+  def lines(self) -> List[str]:
+    """Describe the histogram as lines of text."""
+    lines = ['{} ({} samples):'.format(self._name, sum(self._counts.values()))]
+    for bucket in sorted(self._counts):
+      lines.append('  < {:>12} us: {:>6}'.format(
+          '{:,}'.format(1 << bucket), self._counts[bucket]))
+    return lines
+
+
 class ImageFlusher:
   """Background disk-syncing for mmap'd disk images.
 
   This context manager manages a thread that forces changes to a mmap'd disk
   image file to disk (at least as much as Linux allows---the kernel source
   makes it look as if `mmap.mmap.flush()` should force this, but who knows).
-  To avoid excessive writes to Flash media, a delay can be specified between
-  successive writes.
+  To avoid excessive writes to Flash media, a `FlushPolicy` says how long to
+  wait between successive writes, and when to save changes sooner.
 
   Code that changes data in the mmap'd file should call the `dirty` method on
   the `ImageFlusher` object created for (and obtained by) the `with` statement.
-  The thread will save the data to disk at most `delay` seconds later (where
-  `delay` is a constructor argument).
+  If `dirty` is told which sectors changed, the flusher keeps track of the
+  memory pages that hold them and flushes only the part of the disk image that
+  spans those pages, instead of the whole thing. For policies that flush when
+  the Apple is idle, the emulator should call `activity` whenever the Apple
+  starts and finishes a command.
+
+  In journal mode, the flusher syncs the journal instead, and it checkpoints
+  the journal (see `profile_journal.py`) when the journal grows large or when
+  no changes arrive for a while.
 
   NOTE: Disk-syncing is NOT triggered on exiting an `ImageFlusher` context.
   (It would be redundant with the sync upon leaving an `image_mmap` context.)
+
+  Attributes:
+    flushes: Number of times the thread has saved data.
+    bytes_synced: Total size of the changed pages that the thread has saved.
+    flush_times: Histogram of how long each flush took.
+    dirty_ages: Histogram of how long the oldest change saved by each flush
+        had been waiting---the changes a power cut would have lost.
+    also_flush: If not None, a callable that the thread calls after each
+        flush, e.g. to save a `profile_trace.TraceRecorder`'s records.
   """
 
-  def __init__(self, image: Image, delay: float = 4.0) -> None:
+  def __init__(
+      self,
+      image: Image,
+      policy: FlushPolicy = FLUSH_POLICIES['balanced'],
+      checkpoint_idle: float = 10.0,
+      checkpoint_records: int = 2048,
+      metrics: Optional[profile_metrics.Registry] = None,
+  ) -> None:
     """Initialise an ImageFlusher.
 
     Args:
       image: An Image object returned by `image_mmap`.
-      delay: Flush no more frequently than this often, in seconds.
+      policy: When to flush changes to the disk image.
+      checkpoint_idle: In journal mode, checkpoint the journal once there have
+          been no changes for this many seconds.
+      checkpoint_records: In journal mode, checkpoint the journal when a flush
+          finds at least this many records in it.
+      metrics: If not None, where to count flushes and their durations.
     """
     self._image = image
-    self._delay = delay
-    self._event = threading.Event()  # "Must flush" -OR- "It's time to quit"
+    self._policy = policy
+    self._max_dirty_sectors = -(-policy.max_dirty_bytes // SECTOR_SIZE)
+    self._checkpoint_idle = checkpoint_idle
+    self._checkpoint_records = checkpoint_records
+    self._event = threading.Event()  # "Policy may say flush" -OR- "Quit"
     self._cease = threading.Event()  # "It's time to quit"
     self._thread = None  # type: Optional[threading.Thread]
+    self._lock = threading.Lock()  # Guards the next three members.
+    self._dirty_sectors = set()  # type: Set[int]
+    self._dirty_everything = False
+    self._dirty_since = None  # type: Optional[float]  # Oldest unsaved change.
+    self._last_dirty = self._last_activity = time.monotonic()
+    self._last_flush = -float('inf')
+    self.flushes = 0
+    self.bytes_synced = 0
+    self.flush_times = Histogram('Flush durations')
+    self.dirty_ages = Histogram('Age of oldest change when flushed')
+    self.also_flush = None  # type: Optional[Callable[[], Any]]
+    self._metrics = None if metrics is None else (
+        metrics.counter('aphid_flushes_total',
+                        'Times the disk image file has been flushed.'),
+        metrics.histogram('aphid_flush_duration_seconds',
+                          'How long flushing the disk image file took.'))
+
+  def dirty(self, sector: Optional[int] = None):
+    """Note that data in the disk image has changed.
+
+    Args:
+      sector: Index of the sector that changed, or None if (for all we know)
+          anything in the disk image might have changed.
+    """
+    now = time.monotonic()
+    self._last_dirty = now
+    with self._lock:
+      wake = self._dirty_since is None  # Wake the thread for the first change,
+      if wake: self._dirty_since = now
+      if sector is None:
+        self._dirty_everything = True
+      else:
+        self._dirty_sectors.add(sector)
+        # or when the changes grow too large.
+        wake |= len(self._dirty_sectors) == self._max_dirty_sectors
+    if wake: self._event.set()  # An event ("Time to flush to disk?") occurred
 
-  def dirty(self):
-    self._event.set()  # An event ("Time to flush to disk!") has occurred
+  def activity(self):
+    """Note that the Apple has started or finished a command."""
+    self._last_activity = time.monotonic()
+
+  def _dirty_ranges(self) -> List[Tuple[int, int]]:
+    """Collect (and forget) what needs flushing as ranges of whole pages.
+
+    Returns:
+      A sorted list of non-overlapping, non-adjacent (offset, size) byte ranges
+      of the disk image that contain all the changes noted by `dirty` so far.
+    """
+    with self._lock:
+      sectors, self._dirty_sectors = self._dirty_sectors, set()
+      everything, self._dirty_everything = self._dirty_everything, False
+      self._dirty_since = None
+
+    image_size = self._image.image_size
+    if everything: return [(0, image_size)]
+
+    ranges = []  # type: List[Tuple[int, int]]
+    start = end = -1
+    for sector in sorted(sectors):
+      # Expand the sector's extent to page boundaries, as msync requires.
+      sector_start = sector * SECTOR_SIZE // mmap.PAGESIZE * mmap.PAGESIZE
+      sector_end = min(image_size, ((sector + 1) * SECTOR_SIZE +
+                                    mmap.PAGESIZE - 1) // mmap.PAGESIZE *
+                       mmap.PAGESIZE)
+      if sector_start <= end:  # Overlaps or abuts the current range: extend it.
+        end = max(end, sector_end)
+      else:  # Otherwise, start a new range.
+        if end > start: ranges.append((start, end - start))
+        start, end = sector_start, sector_end
+    if end > start: ranges.append((start, end - start))
+    return ranges
+
+  def _flush(self) -> None:
+    """Save changes noted by `dirty` so far to the disk image file."""
+    dirty_since = self._dirty_since
+    ranges = self._dirty_ranges()
+    if not ranges: return
+    start = self._last_flush = time.monotonic()
+    if dirty_since is not None: self.dirty_ages.add(start - dirty_since)
+
+    journal = self._image.journal
+    if journal is not None:  # In journal mode, the changes are in the journal.
+      journal.sync()
+      self._flushed(start)
+      logging.info('Journal synced (%d records).', journal.records)
+      if journal.records >= self._checkpoint_records: journal.checkpoint()
+      return
+
+    overlay = self._image.overlay
+    if overlay is not None:  # For overlays, the changes are in the overlay.
+      overlay.sync()
+      self._flushed(start)
+      logging.info('Overlay synced.')
+      return
+
+    compressed = self._image.compressed
+    if compressed is not None:  # Compressed images recompress changed chunks.
+      chunks = compressed.flush()
+      self._flushed(start)
+      logging.info('Compressed disk image saved (%d chunks).', chunks)
+      return
+
+    dc42 = self._image.dc42
+    if dc42 is not None:  # dc42 files need their checksums updated.
+      dc42.flush()
+      self._flushed(start)
+      logging.info('dc42 file flushed.')
+      return
+
+    # Linux writes back only the changed pages within the range given to
+    # msync, but it also syncs the whole file for each call, which costs far
+    # more. So we flush everything from the first range to the last at once.
+    first_offset = ranges[0][0]
+    last_offset, last_size = ranges[-1]
+    self._image.mapped.flush(
+        first_offset, last_offset + last_size - first_offset)
+    self._flushed(start)
+
+    synced = sum(size for _, size in ranges)
+    self.bytes_synced += synced
+    logging.info('Disk image data flushed to the disk image file '
+                 '(%d bytes in %d ranges).', synced, len(ranges))
+
+  def _flushed(self, start: float) -> None:
+    """Count a flush that began at `start` (per `time.monotonic`)."""
+    elapsed = time.monotonic() - start
+    self.flushes += 1
+    self.flush_times.add(elapsed)
+    if self._metrics is not None:
+      self._metrics[0].inc()
+      self._metrics[1].observe(elapsed)
+
+  def _next_action(self) -> Tuple[Optional[Callable[[], Any]], float]:
+    """Decide what the thread should do next, and when.
+
+    Returns:
+      A tuple of a method to call (or None if there's nothing to do) and how
+      many seconds from now to call it.
+    """
+    now = time.monotonic()
+    policy = self._policy
+    with self._lock:
+      dirty = self._dirty_since is not None
+      too_dirty = (self._dirty_everything or
+                   len(self._dirty_sectors) >= self._max_dirty_sectors > 0)
+    if dirty:
+      when = self._last_flush + policy.delay
+      if policy.idle > 0: when = min(when, self._last_activity + policy.idle)
+      if too_dirty and policy.max_dirty_bytes > 0: when = now
+      return self._flush, when - now
+
+    journal = self._image.journal
+    if journal is not None and journal.records:
+      return journal.checkpoint, self._last_dirty + self._checkpoint_idle - now
+    return None, 0.0
 
   def __enter__(self) -> 'ImageFlusher':
     """Context manager entry. Create and run the flusher thread."""
 
     def thread():
-      mem = self._image.mapped
-      while True:
-        self._event.wait()               # Wait for anything to happen
-        if self._cease.is_set(): return  # Exit the thread if it's time to quit
-        mem.flush()                      # Nope, time to flush, so flush
-        logging.info('Disk image data flushed to the disk image file.')
-        self._event.clear()              # Get ready for the next event
-        # The next line: pause temporarily to avoid lots of writes.
-        self._cease.wait(self._delay)    # But wake NOW if it's time to quit
+      while not self._cease.is_set():  # Exit the thread if it's time to quit
+        action, wait = self._next_action()
+        if action is not None and wait <= 0:
+          action()                       # It's time, so flush (or checkpoint)
+          also_flush = self.also_flush   # and do whatever else should happen
+          if action == self._flush and also_flush is not None: also_flush()
+        else:                            # Otherwise wait until it's time, or
+          self._event.wait(wait if action is not None else None)  # until some
+          self._event.clear()            # event might change our plans
 
     self._thread = threading.Thread(target=thread, name='flusher')
     self._thread.start()
@@ -652,11 +1581,444 @@ class ImageFlusher:
     self._cease.set()  # The flusher should shut down
     self._event.set()  # An event ("Shut down the flusher!") has occurred
     self._thread.join()
+    if self.flushes and logging.getLogger().isEnabledFor(logging.INFO):
+      for line in self.flush_times.lines() + self.dirty_ages.lines():
+        logging.info('%s', line)
+
+
+class BackgroundCloser:
+  """Closes disk images in the background, so that the next can open at once.
+
+  Closing a disk image (i.e. exiting its `image_mmap` and `ImageFlusher`
+  contexts) saves all outstanding changes to the disk image file, which can
+  take a while. When the Apple switches from one disk image to another, the
+  main program hands the old disk image's contexts to this context manager's
+  `close` method, which exits them in a separate thread while the emulator
+  serves the new disk image. The same file is never open twice at once: call
+  `wait` before opening a disk image file that might still be closing.
+
+  All closing threads are allowed to finish when this context manager exits.
+  """
+
+  def __init__(self) -> None:
+    """Initialise a BackgroundCloser."""
+    self._threads = {}  # type: Dict[str, threading.Thread]
+
+  def close(self, path: str, stack: contextlib.ExitStack) -> None:
+    """Close the disk image file `path` by closing `stack` in the background.
+
+    Args:
+      path: Path to the disk image file being closed.
+      stack: An `ExitStack` holding the contexts that the disk image file was
+          opened with. Its contexts will see no exception.
+    """
+    def thread():
+      start = time.monotonic()
+      try:
+        stack.close()
+        logging.info('Closed image file %s in the background (%.1f ms).',
+                     path, 1000 * (time.monotonic() - start))
+      except Exception:
+        logging.exception('Error while closing image file %s', path)
+
+    self.wait(path)
+    self._threads[path] = threading.Thread(target=thread, name='closer')
+    self._threads[path].start()
+
+  def wait(self, path: str) -> None:
+    """Wait until the disk image file `path` has finished closing, if it is."""
+    thread = self._threads.pop(path, None)
+    if thread is not None: thread.join()
+
+  def __enter__(self) -> 'BackgroundCloser':
+    return self
 
+  def __exit__(self, ex_type, ex_value, traceback):
+    """Context manager exit. Wait for all disk images to finish closing."""
+    del ex_type, ex_value, traceback  # Unused
+    for path in list(self._threads): self.wait(path)
+
+
+class ImagePool:
+  """Keeps recently used disk images open, for instant switching.
+
+  When an emulation session starts, the main program "acquires" its disk
+  image from the pool, opening it only if it isn't there already, and the
+  last session's disk image stays behind in the pool instead of closing. Disk
+  images stay open, mapped, and watched by their own `ImageFlusher` in the
+  pool, so switching back to one costs next to nothing.
+
+  Plugins can "offer" the pool disk image files that the Apple might want
+  soon. (The filesystem ops plugin offers every file the Apple lists, for
+  example.) Offering a file only queues it: a "warmer" thread opens and
+  prefaults (see `image_prefault`) offered files if there's room for them in
+  the pool, but they're the first to go when room is needed: they join the
+  pool as its least recently used members. Offered files are opened without
+  journal mode, so warming them leaves no journal files behind; if the pool's
+  disk images use journal mode, an offered disk image is reopened in journal
+  mode when it's acquired (which is still quick, as its data is in memory by
+  then). The pool finds itself among plugin services as 'image_pool' (see
+  `profile_plugins.providing`).
+
+  The pool is bounded by the total size of the disk images in it, not
+  counting the one in use. When it grows too large, least recently used disk
+  images are closed in the background by a `BackgroundCloser`. Disk images
+  are identified by their files, not their filenames, so renaming a file
+  doesn't confuse the pool, and a new file under an old name isn't mistaken
+  for the old file.
+
+  `acquire` is meant to be called from the emulator's main thread; `offer`
+  and `stats` may be called from any thread (e.g. a `PluginWorker` thread).
+  All disk images in the pool are closed when this context manager exits.
+
+  Attributes:
+    hits: How many disk images acquired were already open in the pool.
+    misses: How many disk images acquired had to be opened.
+    warmed: How many offered disk images were opened.
+    evictions: How many disk images were closed to make room.
+  """
+
+  class _Entry(NamedTuple(
+      '_Entry', [('path', str),
+                 ('stack', contextlib.ExitStack),
+                 ('image', Image),
+                 ('flusher', ImageFlusher),
+                 ('journal', bool)])):
+    """A disk image in the pool and the contexts it was opened with."""
+
+  def __init__(
+      self,
+      max_bytes: int,
+      closer: BackgroundCloser,
+      open_image: Callable[[str, contextlib.ExitStack, bool],
+                           Tuple[Image, ImageFlusher]],
+      journal: bool = False,
+  ) -> None:
+    """Initialise an ImagePool.
 
-def image_get_sector(image: Image, sector: int) -> bytes:
+    Args:
+      max_bytes: Largest total size of all disk images in the pool, except
+          for the one in use. 0 means that disk images are closed as soon as
+          they're released.
+      closer: Closes disk images evicted from the pool.
+      open_image: Opens a disk image file given its path, entering all the
+          contexts it needs into the `ExitStack`, and returns its `Image` and
+          `ImageFlusher`. The third argument says whether to use journal mode
+          (see `image_mmap`).
+      journal: Whether acquired disk images use journal mode.
+    """
+    self._max_bytes = max_bytes
+    self._closer = closer
+    self._open_image = open_image
+    self._journal = journal
+    self._lock = threading.Condition()  # Guards everything below.
+    # Disk images in the pool, least recently used first, keyed by their
+    # files' device and inode numbers; and the key of the one in use.
+    self._entries = (
+        collections.OrderedDict()
+    )  # type: collections.OrderedDict[Tuple[int, int], ImagePool._Entry]
+    self._in_use = None  # type: Optional[Tuple[int, int]]
+    # Offered files not yet considered by the warmer thread, the key of the
+    # file it's opening now (if any), and the thread itself.
+    self._offers = collections.deque()  # type: Deque[str]
+    self._warming = None  # type: Optional[Tuple[int, int]]
+    self._warmer = None  # type: Optional[threading.Thread]
+    self._closing = False
+
+    self.hits = 0
+    self.misses = 0
+    self.warmed = 0
+    self.evictions = 0
+
+  def acquire(self, path: str) -> Tuple[Image, ImageFlusher]:
+    """Obtain a disk image for use, opening it if it isn't in the pool.
+
+    Only one disk image is in use at a time: the disk image acquired before
+    returns to the pool. This is also when the pool closes disk images whose
+    files have been deleted or renamed (or replaced by other files), since the
+    Apple can't switch to them by their old names anymore.
+
+    Args:
+      path: Path to the disk image file.
+
+    Returns:
+      The disk image's `Image` and `ImageFlusher`.
+    """
+    with self._lock:
+      key = self._key(path)
+      # If the warmer is opening this very file, let it finish.
+      while key is not None and key == self._warming: self._lock.wait()
+      entry = self._entries.get(key) if key is not None else None
+      if entry is not None and entry.journal != self._journal:
+        # Warmed without journal mode; reopen it in journal mode.
+        del self._entries[key]  # type: ignore
+        entry.stack.close()
+        entry = self._open(path, self._journal)
+        self._entries[key] = entry  # type: ignore
+        self.hits += 1
+      elif entry is not None:
+        self.hits += 1
+        self._entries.move_to_end(key)  # type: ignore
+      else:
+        self.misses += 1
+        self._closer.wait(path)  # In case it's a disk image we just evicted.
+        entry = self._open(path, self._journal)
+        key = self._key(path)
+        self._entries[key] = entry  # type: ignore
+      self._in_use = key
+
+      for stale_key, stale in list(self._entries.items()):
+        if stale_key != key and self._key(stale.path) != stale_key:
+          del self._entries[stale_key]
+          self._closer.close(stale.path, stale.stack)
+      self._evict(0)
+      return entry.image, entry.flusher
+
+  def offer(self, path: str) -> None:
+    """Suggest a disk image file that the Apple may want soon.
+
+    This returns right away. Later, the warmer thread opens the file if it
+    isn't already in the pool and there's room for it without evicting
+    anything. Failure to open it is logged and ignored.
+
+    Args:
+      path: Path to the disk image file.
+    """
+    with self._lock:
+      if self._closing or not self._max_bytes or path in self._offers: return
+      self._offers.append(path)
+      if self._warmer is None:
+        self._warmer = threading.Thread(target=self._warm, name='warmer')
+        self._warmer.start()
+      self._lock.notify_all()
+
+  def stats(self) -> Dict[str, int]:
+    """Statistics about the pool, for plugins to report to the Apple."""
+    with self._lock:
+      return dict(hits=self.hits, misses=self.misses, warmed=self.warmed,
+                  evictions=self.evictions, images=len(self._entries),
+                  bytes=self._total_bytes())
+
+  def __enter__(self) -> 'ImagePool':
+    return self
+
+  def __exit__(self, ex_type, ex_value, traceback):
+    """Context manager exit. Close all disk images in the pool, right away."""
+    del ex_type, ex_value, traceback  # Unused
+    with self._lock:
+      self._closing = True
+      self._lock.notify_all()
+    if self._warmer is not None: self._warmer.join()
+    while self._entries:
+      _, entry = self._entries.popitem(last=False)
+      entry.stack.close()
+
+  def _warm(self) -> None:
+    """The warmer thread: open offered disk image files until closing."""
+    while True:
+      with self._lock:
+        while not self._offers and not self._closing: self._lock.wait()
+        if self._closing: return
+        path = self._offers.popleft()
+        key = self._key(path)
+        if not self._has_room_for(key, path): continue
+        self._warming = key
+
+      entry = None  # type: Optional[ImagePool._Entry]
+      try:
+        entry = self._open(path, False)
+        image_prefault(entry.image)
+      except Exception:
+        logging.exception('While warming image file %s for the pool', path)
+
+      with self._lock:
+        self._warming = None
+        self._lock.notify_all()
+        if entry is None: continue
+        if self._key(path) != key or not self._has_room_for(key, path):
+          self._closer.close(entry.path, entry.stack)  # Too late for it.
+          continue
+        self._entries[key] = entry  # type: ignore
+        self._entries.move_to_end(key, last=False)  # type: ignore
+        self.warmed += 1
+
+  def _has_room_for(self, key: Optional[Tuple[int, int]], path: str) -> bool:
+    """Whether an offered file can join the pool without evicting anything.
+
+    Call with `_lock` held.
+    """
+    if key is None or key in self._entries: return False
+    try:
+      size = os.stat(path).st_size
+    except OSError:
+      return False
+    return self._total_bytes() + size <= self._max_bytes
+
+  def _open(self, path: str, journal: bool) -> 'ImagePool._Entry':
+    """Open a disk image file for the pool."""
+    with contextlib.ExitStack() as stack:
+      image, flusher = self._open_image(path, stack, journal)
+      return ImagePool._Entry(path, stack.pop_all(), image, flusher, journal)
+
+  def _evict(self, room: int) -> None:
+    """Close least recently used disk images until there's `room` bytes.
+
+    Call with `_lock` held.
+    """
+    for key in list(self._entries):
+      if self._total_bytes() + room <= self._max_bytes: break
+      if key == self._in_use: continue
+      entry = self._entries.pop(key)
+      self.evictions += 1
+      logging.info('Evicting image file %s from the pool.', entry.path)
+      self._closer.close(entry.path, entry.stack)
+
+  def _total_bytes(self) -> int:
+    """Total size of disk images in the pool, except for the one in use.
+
+    Call with `_lock` held.
+    """
+    return sum(entry.image.image_size for key, entry in self._entries.items()
+               if key != self._in_use)
+
+  @staticmethod
+  def _key(path: str) -> Optional[Tuple[int, int]]:
+    """Identify a file by its device and inode numbers, if it exists."""
+    try:
+      st = os.stat(path)
+    except FileNotFoundError:
+      return None
+    return st.st_dev, st.st_ino
+
+
+def image_prefault(image: Image) -> None:
+  """Ask the kernel to read the disk image into memory ahead of use.
+
+  This returns right away: the kernel reads the disk image file in the
+  background. It does nothing for disk images that aren't memory-mapped
+  directly (compressed disk images and dc42 files), or on Pythons too old to
+  call `madvise`.
+
+  Args:
+    image: An Image object returned by `image_mmap`.
+  """
+  if image.mapped is not None and hasattr(image.mapped, 'madvise'):
+    image.mapped.madvise(mmap.MADV_WILLNEED)
+
+
+class Prefaulter:
+  """Brings a disk image into memory in the background, and advises the kernel.
+
+  The first time the emulator touches a page of a memory-mapped disk image
+  file that isn't in memory, it waits for the microSD card---in the middle of
+  a transaction with the Apple. At the start of an emulation session (i.e.
+  at start-up, or just after the Apple switches disk images), this context
+  manager runs a thread that touches every page of the "boot region" at the
+  start of the disk image (where boot blocks and most operating systems'
+  directory structures live), or of the entire disk image, before the Apple
+  can get to them. `madvise(MADV_WILLNEED)` gets the kernel reading ahead of
+  the thread.
+
+  Meanwhile, the emulator reports the Apple's reads to `note_read`, and the
+  Prefaulter advises the kernel to read ahead aggressively
+  (`MADV_SEQUENTIAL`) while the Apple reads sectors in order and not to read
+  ahead at all (`MADV_RANDOM`) while its reads are scattered.
+
+  Disk images that aren't memory-mapped directly (compressed disk images and
+  dc42 files) are left alone.
+
+  Attributes:
+    pages: How many pages the thread has touched.
+    seconds: How long the thread took to touch them, or None if it's still
+        working (or hasn't started).
+  """
+
+  BOOT_REGION_BYTES = 1 << 20  # Size of the "boot region".
+  _STEP_BYTES = 1 << 18  # The thread advises and touches this much at once.
+  _ADVICE_READS = 64  # Reconsider advice after this many reads.
+
+  def __init__(self, image: Image, region: str = 'boot') -> None:
+    """Initialise a Prefaulter.
+
+    Args:
+      image: An Image object returned by `image_mmap`.
+      region: 'boot' to bring the boot region into memory, 'all' to bring in
+          the entire disk image.
+    """
+    if region not in ('boot', 'all'): raise ValueError(
+        'Unknown prefault region {!r}'.format(region))
+    self._mapped = image.mapped if hasattr(image.mapped, 'madvise') else None
+    self._end = (image.image_size if region == 'all' else
+                 min(image.image_size, self.BOOT_REGION_BYTES))
+    self._cease = threading.Event()
+    self._thread = None  # type: Optional[threading.Thread]
+
+    self._last_read = -2  # The sector the Apple read last.
+    self._reads = 0  # Reads since we last reconsidered our advice.
+    self._sequential = 0  # How many of those reads followed the one before.
+    self._advice = mmap.MADV_NORMAL if self._mapped is not None else None
+
+    self.pages = 0
+    self.seconds = None  # type: Optional[float]
+
+  def note_read(self, sector: int) -> None:
+    """Note that the Apple has read a sector from the disk image."""
+    if self._mapped is None: return
+    self._sequential += sector == self._last_read + 1
+    self._last_read = sector
+    self._reads += 1
+    if self._reads < self._ADVICE_READS: return
+
+    if self._sequential >= 0.75 * self._reads:
+      advice, name = mmap.MADV_SEQUENTIAL, 'sequential'
+    elif self._sequential <= 0.25 * self._reads:
+      advice, name = mmap.MADV_RANDOM, 'random'
+    else:
+      advice, name = mmap.MADV_NORMAL, 'normal'
+    self._reads = self._sequential = 0
+    if advice != self._advice:
+      self._mapped.madvise(advice)
+      self._advice = advice
+      logging.info('Prefaulter: advising %s access to the disk image.', name)
+
+  def __enter__(self) -> 'Prefaulter':
+    """Context manager entry. Create and run the prefaulting thread."""
+    mapped = self._mapped
+    if mapped is None: return self
+
+    def thread():
+      start = time.monotonic()
+      for offset in range(0, self._end, self._STEP_BYTES):
+        if self._cease.is_set(): return
+        length = min(self._STEP_BYTES, self._end - offset)
+        mapped.madvise(mmap.MADV_WILLNEED, offset, length)
+        for page in range(offset, offset + length, mmap.PAGESIZE):
+          mapped[page]  # Touching the page brings it into memory.
+          self.pages += 1
+      self.seconds = time.monotonic() - start
+      logging.info('Prefaulter: %d pages in memory after %.1f ms.',
+                   self.pages, 1000 * self.seconds)
+
+    self._thread = threading.Thread(target=thread, name='prefaulter')
+    self._thread.start()
+    return self
+
+  def __exit__(self, ex_type, ex_value, traceback):
+    """Context manager exit. Stop prefaulting and restore normal advice."""
+    del ex_type, ex_value, traceback  # Unused
+    self._cease.set()
+    if self._thread is not None: self._thread.join()
+    if self._advice not in (None, mmap.MADV_NORMAL):
+      self._mapped.madvise(mmap.MADV_NORMAL)  # type: ignore
+
+
+def image_get_sector(image: Image, sector: int) -> Union[bytes, memoryview]:
   r"""Retrieve the `sector`th sector from the disk image.
 
+  Sector data is not copied out of the disk image: the return value is a
+  memoryview of the mmap'd image file. Callers that need the data to stay
+  the same even after the sector is written should make a copy.
+
   Args:
     image: An Image object returned by `image_mmap`.
     sector: Index of the sector to retrieve.
@@ -668,8 +2030,16 @@ def image_get_sector(image: Image, sector: int) -> bytes:
   start_index = sector * SECTOR_SIZE
   end_index = start_index + SECTOR_SIZE
 
-  if start_index < 0 or end_index > image.image_size: return bytes(SECTOR_SIZE)
-  return image.mapped[start_index:end_index]
+  if start_index < 0 or end_index > image.image_size: return ZERO_SECTOR
+  if image.journal is not None:
+    data = image.journal.get(sector)
+    if data is not None: return data
+  if image.overlay is not None:
+    data = image.overlay.get(sector)
+    if data is not None: return data
+  if image.compressed is not None: return image.compressed.get(sector)
+  if image.dc42 is not None: return image.dc42.get(sector)
+  return image.view[start_index:end_index]
 
 
 def image_put_sector(
@@ -680,8 +2050,8 @@ def image_put_sector(
 ):
   """Store sector data in the `sector`th sector of the disk image.
 
-  The modified disk image data is committed to the image file as soon as
-  possible.
+  The modified disk image data is committed to the image file (or in journal
+  mode, to the journal) as soon as possible.
 
   Args:
     image: An Image object returned by `image_mmap`.
@@ -702,9 +2072,27 @@ def image_put_sector(
   end_index = start_index + SECTOR_SIZE
   if start_index < 0 or end_index > image.image_size: return
 
-  mem[start_index:end_index] = data
+  if image.journal is not None:
+    image.journal.append(sector, data)
+  elif image.overlay is not None:
+    image.overlay.put(sector, data)
+  elif image.compressed is not None:
+    image.compressed.put(sector, data)
+  elif image.dc42 is not None:
+    image.dc42.put(sector, data)
+  else:
+    mem[start_index:end_index] = data
+
   if flusher is not None:
-    flusher.dirty()
+    flusher.dirty(sector)
+  elif image.journal is not None:
+    image.journal.sync()
+  elif image.overlay is not None:
+    image.overlay.sync()
+  elif image.compressed is not None:
+    image.compressed.flush()
+  elif image.dc42 is not None:
+    image.dc42.flush()
   else:
     mem.flush()
 
@@ -714,6 +2102,166 @@ def image_put_sector(
 #######################################
 
 
+class PutSectorFrames:
+  """Reusable commands for storing sector data into the disk buffer on PRU1.
+
+  A sector's worth of data (with parity bytes) is too large for a single RPMsg
+  message, so `aphd_put_sector` sends it to PRU1 in three commands. Rather than
+  assembling these commands anew for each sector, we keep them in one buffer
+  whose command headers are written only once. Sector data is copied straight
+  into the commands' data slots; parity bytes are computed for the entire
+  sector at once with `bytes.translate` and copied into the parity slots.
+  """
+
+  # Where the data for each of the three commands starts and ends within the
+  # parity-interleaved sector data.
+  _PARTS = ((APHD_COMMAND_PUT_PART_1, 0, 354),
+            (APHD_COMMAND_PUT_PART_2, 354, 708),
+            (APHD_COMMAND_PUT_PART_3, 708, 2 * SECTOR_SIZE))
+
+  def __init__(self) -> None:
+    """Initialise a PutSectorFrames."""
+    self._buffer = bytearray(
+        sum(len(header) + end - start for header, start, end in self._PARTS))
+    view = memoryview(self._buffer)
+
+    frames = []  # The commands themselves.
+    slots = []  # Where data and parity bytes go in the buffer.
+    offset = 0
+    for header, start, end in self._PARTS:
+      payload = offset + len(header)
+      frame_end = payload + end - start
+      self._buffer[offset:payload] = header
+      frames.append(view[offset:frame_end])
+      slots.append((slice(start // 2, end // 2),         # These sector bytes...
+                    slice(payload, frame_end, 2),        # ...go here, and their
+                    slice(payload + 1, frame_end, 2)))   # parity bytes go here.
+      offset = frame_end
+
+    self._frames = tuple(frames)
+    self._slots = tuple(slots)
+
+  def encode(
+      self,
+      data: Union[bytes, memoryview],
+  ) -> Tuple[memoryview, memoryview, memoryview]:
+    """Fill the commands with `data` and its parity bytes.
+
+    Args:
+      data: 532 bytes of sector data.
+
+    Returns:
+      Commands for storing the first 354, the next 354, and the last 356 bytes
+      of the parity-interleaved sector data in the PRU1 disk buffer. These are
+      views of this object's buffer, so they will change with the next call to
+      `encode`.
+    """
+    buffer = self._buffer
+    for sector_part, data_slots, _ in self._slots:
+      buffer[data_slots] = data[sector_part]
+    # Translating the entire buffer places parity bytes for the data bytes in
+    # the same positions as the data bytes themselves. (We don't mind that the
+    # rest of `parity` is nonsense.)
+    parity = buffer.translate(PARITY_TABLE)
+    for _, data_slots, parity_slots in self._slots:
+      buffer[parity_slots] = parity[data_slots]
+    return self._frames
+
+  @property
+  def frames(self) -> Tuple[memoryview, memoryview, memoryview]:
+    """The commands as filled by the last call to `encode`."""
+    return self._frames
+
+
+class ReadAhead:
+  """Prepares commands for sending upcoming sectors to PRU1 in advance.
+
+  Lisas booting and the Selector scanning catalogues mostly read sectors in
+  order. Once the emulator has served a read of sector N, it can encode sectors
+  N+1, N+2, ... into `PutSectorFrames` while it waits for the Apple's next
+  command, and if that command reads one of those sectors, the commands that
+  send it to PRU1 are ready to go.
+
+  Prepared sectors are copies of the disk image, so the emulator must call
+  `invalidate` whenever it writes a sector.
+
+  Attributes:
+    hits: Number of reads that found their sector already prepared.
+    misses: Number of reads that didn't.
+  """
+
+  def __init__(self, image: Image, window: int) -> None:
+    """Initialise a ReadAhead.
+
+    Args:
+      image: An Image object returned by `image_mmap`.
+      window: How many sectors to prepare after each read.
+
+    Raises:
+      ValueError: `window` was negative.
+    """
+    if window < 0: raise ValueError(
+        'The read-ahead window must not be negative; got {}.'.format(window))
+    self._image = image
+    self._window = window
+    self._ready = {}  # type: Dict[int, PutSectorFrames]
+    # Enough frames for a full window plus the frames being sent to PRU1.
+    self._spare = [PutSectorFrames() for _ in range(window + 1)]
+    self._num_sectors = image.image_size // SECTOR_SIZE
+    self.hits = 0
+    self.misses = 0
+
+  def frames(
+      self,
+      sector: int,
+  ) -> Tuple[memoryview, memoryview, memoryview]:
+    """Retrieve commands for sending disk image sector `sector` to PRU1.
+
+    Args:
+      sector: Index of the sector to send to PRU1.
+
+    Returns:
+      Commands in the form returned by `PutSectorFrames.encode`, good until
+      the next call to `prefetch`.
+    """
+    put_frames = self._ready.pop(sector, None)
+    if put_frames is None:
+      self.misses += 1
+      put_frames = self._spare[-1]
+      return put_frames.encode(image_get_sector(self._image, sector))
+    self.hits += 1
+    self._spare.append(put_frames)
+    return put_frames.frames
+
+  def prefetch(self, sector: int, rpmsg: Rpmsg) -> None:
+    """Prepare commands for sending the sectors after `sector` to PRU1.
+
+    Gives up early if a command from PRU1 arrives in the meantime, so that the
+    Apple doesn't wait on us to prepare sectors it may not want.
+
+    Args:
+      sector: Index of the sector the Apple just read.
+      rpmsg: An Rpmsg object returned by `rpmsg_io_init`.
+    """
+    first = sector + 1
+    last = min(sector + self._window, self._num_sectors - 1)
+    # Recycle frames for sectors outside the new window.
+    for stale in [s for s in self._ready if not first <= s <= last]:
+      self._spare.append(self._ready.pop(stale))
+
+    for upcoming in range(first, last + 1):
+      if upcoming in self._ready: continue
+      if rpmsg.poll_read.poll(0): return  # The Apple wants something now.
+      put_frames = self._spare.pop()
+      put_frames.encode(image_get_sector(self._image, upcoming))
+      self._ready[upcoming] = put_frames
+
+  def invalidate(self, sector: int) -> None:
+    """Discard any prepared commands for sector `sector`."""
+    put_frames = self._ready.pop(sector, None)
+    if put_frames is not None: self._spare.append(put_frames)
+
+
 def aphd_get_sector(rpmsg: Rpmsg) -> bytes:
   """Obtain contents of the Apple buffer from PRU1.
 
@@ -727,7 +2275,16 @@ def aphd_get_sector(rpmsg: Rpmsg) -> bytes:
     RuntimeError: The attempt to read all 532 bytes failed.
   """
   # The transfer takes place in two parts, since the RPMsg data buffer is
-  # too small to contain data for an entire sector.
+  # too small to contain data for an entire sector. A pipelined transfer asks
+  # for both parts at once, saving a round trip.
+  if rpmsg.pipelined:
+    result = _aphd_get_sector_pipelined(rpmsg)
+    if result is not None: return result
+    logging.warning('Pipelined transfer of the Apple buffer from PRU1 failed; '
+                    'retrying one part at a time.')
+    _count_retry(rpmsg, 'pipelined get')
+    rpmsg_drain(rpmsg)
+
   # Part 1: read the first 266 bytes of the buffer.
   rpmsg_write(rpmsg, APHD_COMMAND_GET_PART_1)
   part_1 = rpmsg_read(rpmsg, 266)
@@ -742,12 +2299,51 @@ def aphd_get_sector(rpmsg: Rpmsg) -> bytes:
   return result
 
 
-def aphd_put_sector(rpmsg: Rpmsg, data: bytes):
+def _aphd_get_sector_pipelined(rpmsg: Rpmsg) -> Optional[bytes]:
+  """Obtain contents of the Apple buffer from PRU1 in a pipelined transfer.
+
+  Both "get" commands go to PRU1 in a single RPMsg message, and then we collect
+  both replies. This requires PRU1 firmware that handles all of the commands
+  in a message, not just the first.
+
+  Replies from PRU1 carry no sequence numbers, so to be sure that each reply
+  is the half of the buffer that we think it is, we insist that we are the only
+  ones talking: no data from PRU1 may be waiting before we send the commands,
+  we must receive exactly two 266-byte replies, and no more data may arrive
+  after them. Any violation, and we give up so that the caller can start
+  again, one part at a time.
+
+  Args:
+    rpmsg: An Rpmsg object returned by `rpmsg_io_init`.
+
+  Returns:
+    Contents of the Apple buffer on PRU1, or None if the pipelined transfer
+    went awry.
+
+  Raises:
+    RuntimeError: Failed (probably timed out) whilst waiting for RPMsg data
+        from PRU1.
+  """
+  stale = rpmsg_drain(rpmsg)
+  if stale: logging.warning(
+      'Discarded %d bytes of stale data from PRU1 before a transfer.', stale)
+
+  rpmsg_write(rpmsg, APHD_COMMAND_GET_PARTS_1_AND_2)
+  part_1 = rpmsg_read_message(rpmsg)
+  if len(part_1) != 266: return None
+  part_2 = rpmsg_read_message(rpmsg)
+  if len(part_2) != 266: return None
+  if rpmsg_drain(rpmsg): return None
+  return part_1 + part_2
+
+
+def aphd_put_sector(rpmsg: Rpmsg, data: Union[bytes, memoryview]):
   """Store data (with added parity bytes) into the disk buffer on PRU1.
 
   Args:
     rpmsg: An Rpmsg object returned by `rpmsg_io_init`.
-    data: 532 bytes of data to store.
+    data: 532 bytes of data to store. A memoryview (e.g. from
+        `image_get_sector`) is copied only once: into the outgoing commands.
 
   Raises:
     ValueError: `data` was not exactly 532 bytes long.
@@ -756,20 +2352,28 @@ def aphd_put_sector(rpmsg: Rpmsg, data: bytes):
       'The data argument to aphd_put_sector was {} bytes long; it should be '
       '{} bytes.'.format(len(data), SECTOR_SIZE))
 
-  # Compute parity bytes for the data to place in the drive sector.
-  data = b''.join(bytes((c, PARITY[c])) for c in data)
+  aphd_put_frames(rpmsg, rpmsg.put_frames.encode(data))
+
+
+def aphd_put_frames(
+    rpmsg: Rpmsg,
+    frames: Tuple[memoryview, memoryview, memoryview],
+):
+  """Send commands that store sector data into the disk buffer on PRU1.
 
+  Args:
+    rpmsg: An Rpmsg object returned by `rpmsg_io_init`.
+    frames: Commands prepared by `PutSectorFrames.encode`.
+  """
   # The transfer takes place in three parts, since the RPMsg data buffer is
   # too small to contain data for an entire sector.
+  part_1, part_2, part_3 = frames
   # Part 1: write the first 354 bytes of the sector.
-  command = APHD_COMMAND_PUT_PART_1 + data[:354]
-  rpmsg_write(rpmsg, command)
+  rpmsg_write(rpmsg, part_1)
   # Part 2: write the next 354 bytes of the sector.
-  command = APHD_COMMAND_PUT_PART_2 + data[354:708]
-  rpmsg_write(rpmsg, command)
+  rpmsg_write(rpmsg, part_2)
   # Part 3: write the last 356 bytes of the sector.
-  command = APHD_COMMAND_PUT_PART_3 + data[708:]
-  rpmsg_write(rpmsg, command)
+  rpmsg_write(rpmsg, part_3)
 
 
 def aphd_goahead(rpmsg: Rpmsg):
@@ -807,6 +2411,7 @@ def aphd_await_command(rpmsg: Rpmsg) -> bytes:
   for _ in range(600):
     command = rpmsg_read(rpmsg, 6, delay=-1.0)  # Negative delays last forever.
     if len(command) == 6: return command
+    _count_retry(rpmsg, 'command')
   else:
     raise RuntimeError('Numerous attempts to read the 6-byte Apple command '
                        'from PRU1 have all failed.')
@@ -817,12 +2422,487 @@ def aphd_await_command(rpmsg: Rpmsg) -> bytes:
 ##########################
 
 
+class CommandSummary:
+  """Tallies the Apple's commands and logs a summary of them now and then.
+
+  Logging a line for every command costs the emulator much of its throughput
+  on a PocketBeagle, and fills the journal on the microSD card with lines no
+  one reads. At the INFO level, the emulator counts commands here instead, and
+  this object logs how many there were of each kind every so often. (At the
+  DEBUG level, the emulator logs every command as well.)
+  """
+
+  def __init__(self, interval: float = 1.0) -> None:
+    """Initialise a CommandSummary.
+
+    Args:
+      interval: Log a summary at most this often, in seconds. Summaries are
+          only logged when commands arrive, so an idle Apple brings none.
+    """
+    self._interval = interval
+    self._since = time.monotonic()
+    self._next = self._since + interval
+    self.reads = 0
+    self.writes = 0
+    self.plugin_calls = 0
+    self.others = 0
+
+  def note(self, op: int, sector: int) -> None:
+    """Count a command; log a summary if it's time.
+
+    Args:
+      op: ProFile operation byte.
+      sector: Sector the command read or wrote.
+    """
+    if 0xff0000 <= sector < 0xffff00:
+      self.plugin_calls += 1
+    elif op == PROFILE_READ:
+      self.reads += 1
+    elif op in ALL_PROFILE_WRITE_COMMANDS:
+      self.writes += 1
+    else:
+      self.others += 1
+    now = time.monotonic()
+    if now >= self._next: self.log(now)
+
+  def log(self, now: Optional[float] = None) -> None:
+    """Log a summary of the commands counted since the last one, if any."""
+    if now is None: now = time.monotonic()
+    if self.reads or self.writes or self.plugin_calls or self.others:
+      logging.info(
+          'Last %.1f s: %d reads, %d writes, %d plugin calls, %d other '
+          'commands.', now - self._since, self.reads, self.writes,
+          self.plugin_calls, self.others)
+    self.reads = self.writes = self.plugin_calls = self.others = 0
+    self._since = now
+    self._next = now + self._interval
+
+
+# Handles commands to a particular sector other than ordinary disk reads and
+# writes. Handlers are called like plugins (see `profile_plugins.Plugin`), and
+# like plugins they may raise `profile_plugins.Conclusion`.
+Handler = Callable[[int, int, int, int, Optional[bytes]], Optional[bytes]]
+
+# Names of ProFile operations, for metrics.
+_OP_NAMES = {
+    PROFILE_READ: 'read',
+    PROFILE_WRITE: 'write',
+    PROFILE_WRITE_VERIFY: 'write_verify',
+    PROFILE_WRITE_FORCE_SPARE: 'write_force_spare',
+}
+
+
+class Routes(NamedTuple(
+    'Routes', [('disk_sectors', int),
+               ('by_op', Dict[int, Dict[int, Handler]]),
+               ('plugin_read_aheads', Dict[int, 'PluginReadAhead']),
+               ('plugin_workers', Dict[int, 'PluginWorker']),
+               ('late_conclusions', List[bytes])])):
+  """How `profile` dispatches the Apple's commands; see `command_routes`.
+
+  Fields:
+    disk_sectors: Commands for sectors below this one read or write the disk
+        image, without consulting `by_op`.
+    by_op: For each ProFile operation, handlers for commands to other
+        sectors, keyed by sector. Commands to sectors with no handler read or
+        write the disk image too (which has its own idea of what to do with
+        sectors beyond its end).
+    plugin_read_aheads: `PluginReadAhead` handlers in `by_op`, keyed by
+        sector, so that `profile` can have them prepare replies.
+    plugin_workers: `PluginWorker` handlers in `by_op` (perhaps behind
+        `PluginReadAhead` handlers), keyed by sector, so that `profile` can
+        close them when the session ends.
+    late_conclusions: Conclusions raised by plugin calls that `PluginWorker`
+        handlers had to leave running; `profile` concludes the session with
+        the first of these once it's served the command it's working on.
+  """
+
+
+def command_routes(
+    image: Image,
+    plugins: Dict[int, profile_plugins.Plugin],
+    last_data: Callable[[], bytes],
+    flusher: Optional[ImageFlusher] = None,
+    metrics: Optional[profile_metrics.Registry] = None,
+    plugin_read_ahead: int = 0,
+    plugin_deadline: float = 0.0,
+) -> Routes:
+  """Work out how `profile` should dispatch commands, once per session.
+
+  The built-in "magic blocks" (the spare table, the drive's buffer, the
+  conclusion of the session, and plugin status) go into the same tables as
+  the plugins, so that `profile` can route any command with one comparison
+  and (for magic blocks only) a dict lookup or two, instead of a chain of
+  comparisons.
+
+  Args:
+    image: The disk image for the session.
+    plugins: "Magic block" plugins, keyed by sector. Only plugins for sectors
+        $FF0000..$FFFEFF are used.
+    last_data: Returns the last data read or written, for sector $FFFFFE.
+    flusher: `ImageFlusher` for writes to sector $FFFFFD that don't conclude
+        the session.
+    metrics: If not None, count plugin calls and their durations here.
+    plugin_read_ahead: If positive, have plugins that can prepare replies in
+        advance (see `profile_plugins.Plugin.prepare`) prepare this many at a
+        time; see `PluginReadAhead`.
+    plugin_deadline: If positive, call plugins on threads of their own and
+        wait no longer than this many seconds for them to finish with any
+        write; see `PluginWorker`.
+
+  Returns:
+    Routes for the session.
+  """
+  def spare_table(op, sector, retry_count, sparing_threshold, data):
+    del op, sector, retry_count, sparing_threshold, data  # Unused.
+    return image.spare_table
+
+  def buffer(op, sector, retry_count, sparing_threshold, data):
+    del op, sector, retry_count, sparing_threshold, data  # Unused.
+    return last_data()
+
+  def conclude(op, sector, retry_count, sparing_threshold, data):
+    del op  # Unused.
+    # The $FE retry count (254) and $AF sparing threshold (175) are the
+    # opposite of the IDEFile "magic numbers".
+    if retry_count == 0xfe and sparing_threshold == 0xaf:
+      raise profile_plugins.Conclusion(data)
+    image_put_sector(image, sector, data, flusher)  # Just an ordinary write.
+
+  def plugin_status(op, sector, retry_count, sparing_threshold, data):
+    del op, sector, data  # Unused.
+    worker = workers.get(0xff0000 + (retry_count << 8) + sparing_threshold)
+    return worker.status() if worker is not None else PluginWorker.IDLE
+
+  reads = {0xffffff: spare_table, 0xfffffe: buffer,
+           0xfffffc: plugin_status}  # type: Dict[int, Handler]
+  writes = {0xfffffd: conclude}  # type: Dict[int, Handler]
+  read_aheads = {}  # type: Dict[int, PluginReadAhead]
+  workers = {}  # type: Dict[int, PluginWorker]
+  late_conclusions = []  # type: List[bytes]
+  for sector, plugin in plugins.items():
+    if not 0xff0000 <= sector < 0xffff00: continue
+    handler = plugin  # type: Handler
+    if metrics is not None:
+      block = '{:06X}'.format(sector)
+      handler = _timed_plugin(plugin, metrics.counter(
+          'aphid_plugin_calls_total', 'Calls to "magic block" plugins.',
+          block=block), metrics.histogram(
+              'aphid_plugin_call_duration_seconds',
+              'How long "magic block" plugins took to handle calls.',
+              block=block))
+    worker = None  # type: Optional[PluginWorker]
+    if plugin_deadline > 0:
+      handler = worker = workers[sector] = PluginWorker(
+          handler, sector, plugin_deadline, late_conclusions,
+          None if metrics is None else metrics.counter(
+              'aphid_plugin_late_calls_total',
+              'Calls to "magic block" plugins that missed their deadline.',
+              block='{:06X}'.format(sector)))
+    if plugin_read_ahead > 0 and _may_prepare(plugin):
+      handler = read_aheads[sector] = PluginReadAhead(
+          plugin, handler, sector, plugin_read_ahead, worker)
+    reads[sector] = writes[sector] = handler
+
+  by_op = {PROFILE_READ: reads}
+  by_op.update((op, writes) for op in ALL_PROFILE_WRITE_COMMANDS)
+  return Routes(min(image.image_size // SECTOR_SIZE, 0xff0000), by_op,
+                read_aheads, workers, late_conclusions)
+
+
+class PluginReadAhead:
+  """Answers reads from a plugin's block with replies the plugin prepared.
+
+  Programs on the Apple often read a plugin's block with successive values of
+  the 16-bit concatenation of the retry count and sparing threshold
+  parameters, e.g. to download a directory listing from the filesystem
+  operations plugin. A PluginReadAhead is a `Handler` that stands in for a
+  plugin that implements `profile_plugins.Plugin.prepare`. While the emulator
+  waits for the next command after a read, `prefetch` asks the plugin to
+  prepare replies for the reads with the next several parameter values, all
+  in one call; those reads are then answered without calling the plugin. A
+  write to the plugin's block discards all prepared replies.
+
+  If the plugin has a `PluginWorker`, replies are only prepared while the
+  worker has no calls to the plugin outstanding, since plugins needn't
+  handle two calls at once.
+
+  A PluginReadAhead may also stand in for a `profile_plugins.LazyPlugin`
+  whose plugin hasn't been loaded yet. The first time it would prepare
+  replies (by which time the Apple has read from the block, loading the
+  plugin), it checks whether the plugin implements `prepare` after all; if
+  not, it just passes commands on to the plugin from then on.
+
+  Attributes:
+    hits: Reads answered with prepared replies.
+    misses: Reads that had to call the plugin.
+  """
+
+  def __init__(
+      self,
+      plugin: profile_plugins.Plugin,
+      handler: Handler,
+      block: int,
+      depth: int,
+      worker: Optional['PluginWorker'] = None,
+  ) -> None:
+    """Initialise a PluginReadAhead.
+
+    Args:
+      plugin: The plugin, for preparing replies.
+      handler: Calls the plugin (perhaps with some bookkeeping).
+      block: The plugin's block.
+      depth: How many replies to prepare at a time.
+      worker: The `PluginWorker` that calls the plugin, if any.
+    """
+    self._plugin = plugin
+    self._handler = handler
+    self._block = block
+    self._depth = depth
+    self._worker = worker
+    self._replies = {}  # type: Dict[int, bytes]  # Keyed by parameters.
+    self._last = None  # type: Optional[int]  # Parameters of the last read.
+    self._can_prepare = None  # type: Optional[bool]  # None if not known yet.
+    self.hits = 0
+    self.misses = 0
+
+  def __call__(
+      self,
+      op: int,
+      sector: int,
+      retry_count: int,
+      sparing_threshold: int,
+      data: Optional[bytes],
+  ) -> Optional[bytes]:
+    """Handle a command as the plugin would; see `profile_plugins.Plugin`."""
+    if op == PROFILE_READ:
+      self._last = parameters = (retry_count << 8) + sparing_threshold
+      reply = self._replies.pop(parameters, None)
+      if reply is not None:
+        self.hits += 1
+        return reply
+      if self._can_prepare is not False: self.misses += 1
+    else:
+      self._replies.clear()
+      self._last = None
+    return self._handler(op, sector, retry_count, sparing_threshold, data)
+
+  def prefetch(self) -> None:
+    """Prepare replies to the reads that may follow the last one, if needed."""
+    if self._last is None: return
+    first, self._last = self._last + 1, None
+    if first > 0xffff or first in self._replies: return  # Nothing to do.
+    if self._worker is not None and self._worker.busy(): return  # Not now.
+    if self._can_prepare is None:
+      self._can_prepare = _can_prepare(self._plugin)
+    if not self._can_prepare: return
+
+    self._replies.clear()
+    parameters = range(first, min(0x10000, first + self._depth))
+    try:
+      replies = self._plugin.prepare(
+          self._block, [(p >> 8, p & 0xff) for p in parameters])
+    except Exception:
+      logging.exception('While preparing replies from the plugin for block '
+                        '$%06X:', self._block)
+      return
+    for p, reply in zip(parameters, replies):
+      if reply is not None: self._replies[p] = reply
+
+
+class PluginWorker:
+  """Calls a plugin on a thread of its own, waiting only until a deadline.
+
+  Some plugins do slow work for some commands: the filesystem operations
+  plugin may copy a large disk image, for example, and the Selector rescue
+  plugin unpacks and writes an entire one. Meanwhile the Apple waits in the
+  middle of a ProFile transaction. A PluginWorker is a `Handler` that stands
+  in for a plugin, passing each command to the plugin on the worker's thread
+  and waiting at most `deadline` seconds for the plugin to finish with it.
+  (Each plugin gets a thread of its own, so commands to one plugin are
+  handled in order and never wait for another plugin's slow work.)
+
+  A write that misses its deadline keeps running, and the Apple gets its
+  reply at once, as if the write had finished. If the late write raises a
+  `profile_plugins.Conclusion`, the conclusion goes into `late_conclusions`,
+  for `profile` to act on. Reads always wait for the plugin's real reply
+  (and so for any late writes before them to finish), since the Apple would
+  have no way to tell a stand-in reply from real data.
+
+  Reading block $FFFFFC with the lower 16 bits of the plugin's block as the
+  retry count and sparing threshold parameters retrieves a status block
+  from the plugin's worker (see `status`), so programs on the Apple can wait
+  for slow work to finish and learn whether it worked.
+
+  Attributes:
+    late: How many writes missed their deadlines.
+    failures: How many of those raised an exception (besides a Conclusion).
+  """
+
+  # Status block for a plugin with nothing to do (or no PluginWorker at all).
+  IDLE = b'IDLE' + bytes(SECTOR_SIZE - 4)
+
+  def __init__(
+      self,
+      handler: Handler,
+      block: int,
+      deadline: float,
+      late_conclusions: List[bytes],
+      late_calls: Optional[profile_metrics.Counter] = None,
+  ) -> None:
+    """Initialise a PluginWorker.
+
+    Args:
+      handler: Calls the plugin (perhaps with some bookkeeping).
+      block: The plugin's block.
+      deadline: Seconds to wait for the plugin to finish with a write.
+      late_conclusions: Conclusions raised by late writes go here.
+      late_calls: If not None, count writes that missed their deadlines.
+    """
+    self._handler = handler
+    self._block = block
+    self._deadline = deadline
+    self._late_conclusions = late_conclusions
+    self._late_calls = late_calls
+    self._executor = concurrent.futures.ThreadPoolExecutor(
+        1, thread_name_prefix='plugin-{:06X}'.format(block))
+    self._lock = threading.Lock()  # Guards everything below.
+    self._outstanding = 0  # Commands given to the plugin but not finished.
+    self._failure = ''  # Description of the most recent failure.
+    self.late = 0
+    self.failures = 0
+
+  def __call__(
+      self,
+      op: int,
+      sector: int,
+      retry_count: int,
+      sparing_threshold: int,
+      data: Optional[bytes],
+  ) -> Optional[bytes]:
+    """Handle a command as the plugin would; see `profile_plugins.Plugin`."""
+    with self._lock: self._outstanding += 1
+    future = self._executor.submit(
+        self._handler, op, sector, retry_count, sparing_threshold, data)
+    future.add_done_callback(self._finished)
+    if op == PROFILE_READ: return future.result()  # No deadline for reads.
+
+    try:
+      return future.result(self._deadline)
+    except concurrent.futures.TimeoutError:
+      pass
+
+    # The plugin missed the deadline. Let it carry on without us.
+    logging.info('Plugin at $%06X: write (parameters $%02X%02X) still running '
+                 'after %.3f s; finishing it in the background.',
+                 self._block, retry_count, sparing_threshold, self._deadline)
+    with self._lock: self.late += 1
+    if self._late_calls is not None: self._late_calls.inc()
+    future.add_done_callback(self._late_outcome)
+    return None
+
+  def _finished(self, future: concurrent.futures.Future) -> None:
+    """Note that the plugin finished a command, on time or not."""
+    del future  # Unused.
+    with self._lock: self._outstanding -= 1
+
+  def _late_outcome(self, future: concurrent.futures.Future) -> None:
+    """Log a late write's outcome; note any failure or conclusion."""
+    exception = future.exception()
+    if isinstance(exception, profile_plugins.Conclusion):
+      logging.info('Plugin at $%06X: a late write concluded the session.',
+                   self._block)
+      self._late_conclusions.append(exception.conclusion)
+    elif exception is not None:
+      logging.error('Plugin at $%06X: a late write failed: %r', self._block,
+                    exception)
+      with self._lock:
+        self.failures += 1
+        self._failure = repr(exception)
+    else:
+      logging.info('Plugin at $%06X: a late write finished.', self._block)
+
+  def busy(self) -> bool:
+    """Whether the plugin has commands outstanding."""
+    with self._lock: return self._outstanding > 0
+
+  def status(self) -> bytes:
+    """A status block for the Apple. Its contents are:
+
+        Bytes   0-3: 'BUSY' if the plugin is still working on any commands
+                     (including late writes), otherwise 'IDLE'
+        Bytes   4-7: Number of writes that missed their deadlines
+                     (big-endian)
+        Bytes  8-11: Number of those that failed (big-endian)
+        Bytes 12-??: ASCII description of the most recent failure
+           Remainder: $00 bytes, so the description is null-terminated.
+    """
+    with self._lock:
+      data = b''.join([
+          b'BUSY' if self._outstanding else b'IDLE',
+          self.late.to_bytes(4, 'big'),
+          self.failures.to_bytes(4, 'big'),
+          self._failure.encode('ascii', errors='replace')[:SECTOR_SIZE - 13],
+      ])
+    return data + bytes(SECTOR_SIZE - len(data))
+
+  def close(self) -> None:
+    """Wait for any outstanding commands to finish, then stop the thread."""
+    if self.busy(): logging.info(
+        'Plugin at $%06X: waiting for late commands to finish...', self._block)
+    self._executor.shutdown(wait=True)
+
+
+def _can_prepare(plugin: Handler) -> bool:
+  """Whether a plugin implements `profile_plugins.Plugin.prepare`.
+
+  This loads a `profile_plugins.LazyPlugin`'s plugin to find out.
+  """
+  if isinstance(plugin, profile_plugins.LazyPlugin):
+    return plugin.can_prepare()
+  return isinstance(plugin, profile_plugins.Plugin) and (
+      type(plugin).prepare is not profile_plugins.Plugin.prepare)
+
+
+def _may_prepare(plugin: Handler) -> bool:
+  """Like `_can_prepare`, but without loading a plugin that isn't loaded.
+
+  A `profile_plugins.LazyPlugin` that hasn't loaded its plugin yet may be
+  able to prepare replies; `PluginReadAhead` finds out for sure later.
+  """
+  if isinstance(plugin, profile_plugins.LazyPlugin) and not plugin.loaded:
+    return True
+  return _can_prepare(plugin)
+
+
+def _timed_plugin(
+    plugin: profile_plugins.Plugin,
+    calls: profile_metrics.Counter,
+    seconds: profile_metrics.Histogram,
+) -> Handler:
+  """Wrap `plugin` in a Handler that counts and times its calls."""
+  def timed(op, sector, retry_count, sparing_threshold, data):
+    start = time.perf_counter()
+    try:
+      return plugin(op, sector, retry_count, sparing_threshold, data)
+    finally:
+      calls.inc()
+      seconds.observe(time.perf_counter() - start)
+  return timed
+
+
 def profile(
     image: Image,
     rpmsg: Rpmsg,
     leds: LEDs,
     plugins: Optional[Dict[int, profile_plugins.Plugin]] = None,
     flusher: Optional[ImageFlusher] = None,
+    read_ahead: Optional[ReadAhead] = None,
+    prefaulter: Optional[Prefaulter] = None,
+    trace: Optional[profile_trace.TraceRecorder] = None,
+    metrics: Optional[profile_metrics.Registry] = None,
+    plugin_read_ahead: int = 0,
+    plugin_deadline: float = 0.0,
 ) -> bytes:
   """Emulator core; broker data exchange between the Aphid and the disk image.
 
@@ -835,6 +2915,16 @@ def profile(
     rpmsg: An Rpmsg object returned by `rpmsg_io_init`.
     leds: An LEDs object.
     flusher: Optional `ImageFlusher` object initialised with `image`.
+    read_ahead: Optional `ReadAhead` object initialised with `image`.
+    prefaulter: Optional `Prefaulter` object initialised with `image`.
+    trace: Optional `TraceRecorder` for recording the Apple's commands.
+    metrics: Optional `profile_metrics.Registry` for counting and timing the
+        Apple's commands and plugin calls.
+    plugin_read_ahead: How many replies to have plugins prepare in advance,
+        for plugins that can; see `PluginReadAhead`. 0 disables this.
+    plugin_deadline: If positive, the longest the Apple should wait for a
+        plugin write, in seconds; see `PluginWorker`. 0 means plugins run in
+        this thread for as long as they like.
 
   Returns:
     A sector's worth of data when the Apple has commanded the emulator to end
@@ -849,12 +2939,28 @@ def profile(
         A bit of a strange way to represent this event, but it should be
         handled the same way as a user's Ctrl-C.
   """
+  # Work out where to send commands to the "magic blocks", if the Apple
+  # issues any. If the caller supplied no plugins, there are only built-ins.
+  # (The buffer handler reads last_data, defined below, when it's called.)
+  (disk_sectors, routes, plugin_read_aheads, plugin_workers,
+   late_conclusions) = command_routes(
+       image, plugins or {}, lambda: last_data, flusher, metrics,
+       plugin_read_ahead, plugin_deadline)
+  no_routes = {}  # type: Dict[int, Handler]
+
   # Set up signal handler that raises a KeyboardInterrupt on SIGTERM, allowing
   # us to shut down cleanly.
   def sigterm_handler(signal, frame):
     raise KeyboardInterrupt
   old_sigterm_handler = signal.signal(signal.SIGTERM, sigterm_handler)
 
+  # Log every command at the DEBUG level; at the INFO level, summarise them
+  # every second instead. The level is checked here, once, rather than for
+  # each command.
+  log_commands = logging.getLogger().isEnabledFor(logging.DEBUG)
+  summary = (CommandSummary()
+             if logging.getLogger().isEnabledFor(logging.INFO) else None)
+
   # Everything now takes place in a try: block so that we can restore the old
   # signal handler in a finally: before we exit this function.
   try:
@@ -870,8 +2976,15 @@ def profile(
     # can supply the same if requested.
     last_data = bytes(SECTOR_SIZE)
 
-    # If the caller supplied no plugins, swap in an empty plugin dict.
-    if plugins is None: plugins = {}
+    # Counters and latency histograms for each operation.
+    if metrics is not None:
+      served = {op: (
+          metrics.counter('aphid_commands_total',
+                          'Commands served, by ProFile operation.', op=name),
+          metrics.histogram('aphid_command_duration_seconds',
+                            'How long commands took to serve, by ProFile '
+                            'operation.', op=name))
+                for op, name in list(_OP_NAMES.items()) + [(-1, 'unknown')]}
 
     # MAIN LOOP :-)
     logging.info('Cameo/Aphid ProFile emulator ready.')
@@ -880,65 +2993,107 @@ def profile(
       leds.on()
       command = aphd_await_command(rpmsg)
       leds.off()
+      if flusher is not None: flusher.activity()  # The Apple is busy.
       if len(command) != 6: continue
+      if trace is not None: started = trace.start()
+      if metrics is not None: began = time.perf_counter()
 
       # Decode the command. Awkwardly, struct does not support unpacking
       # three-byte quantities like the sector identifier.
       op, sector_hi, sector_lo, retry_count, sparing_thresh = struct.unpack(
           '>BBHBB', command)
       sector = (sector_hi << 16) + sector_lo
+      if summary is not None: summary.note(op, sector)
 
-      # For logging.
-      hex_command = command.hex()
+      # Set to the sector just read if it came from the disk image.
+      read_ahead_after = None  # type: Optional[int]
+
+      # Find the handler for a "magic block" command, if that's what this is.
+      # Commands for the disk image---nearly all of them---need only the first
+      # comparison.
+      handler = (None if sector < disk_sectors else
+                 routes.get(op, no_routes).get(sector))
 
       # All we need to do is transfer data between PRU1 and the disk image
-      # depending on whether we're being told to read or write.
+      # (or a handler) depending on whether we're being told to read or write.
       if op == PROFILE_READ:
-        logging.info('[%s]  Read sector $%06X', hex_command, sector)
-        if sector == 0xffffff:    # Get the spare table
-          data = image.spare_table
-        elif sector == 0xfffffe:  # Get the last data read or written
-          data = last_data
-        elif 0xff0000 <= sector < 0xffff00 and sector in plugins:  # Plugin call
+        if log_commands:
+          logging.debug('[%s]  Read sector $%06X', command.hex(), sector)
+        if handler is None:       # Get a sector from the disk image
+          data = image_get_sector(image, sector)
+          read_ahead_after = sector
+          if prefaulter is not None: prefaulter.note_read(sector)
+        else:                     # Spare table, buffer, or plugin call
           try:
-            data = plugins[sector](
+            data = handler(
                 op, sector, retry_count, sparing_thresh, None)  # type: ignore
           except profile_plugins.Conclusion as e:   # Conclude if plugin says so
             data = conclusion = e.conclusion
           if len(data) != SECTOR_SIZE:                     # Enforce proper size
             data = data[:SECTOR_SIZE] + bytes(max(0, SECTOR_SIZE - len(data)))
-        else:                     # Get a sector from the disk image
-          data = image_get_sector(image, sector)
-        aphd_put_sector(rpmsg, data)  # Send to PRU1
+        if read_ahead is not None and read_ahead_after is not None:
+          aphd_put_frames(rpmsg, read_ahead.frames(sector))  # Maybe prepared
+        else:
+          aphd_put_sector(rpmsg, data)  # Send to PRU1
 
       elif op in ALL_PROFILE_WRITE_COMMANDS:
-        logging.info('[%s] Write sector $%06X', hex_command, sector)
+        if log_commands:
+          logging.debug('[%s] Write sector $%06X', command.hex(), sector)
         data = aphd_get_sector(rpmsg)  # Get sector data from PRU1
 
-        if (sector == 0xfffffd and    # Conclude this ProFile session
-            retry_count == 0xfe and   # (That's 254.) This is opposite of the
-            sparing_thresh == 0xaf):  # (That's 175.) IDEFile "magic numbers"
-          conclusion = data
-        elif 0xff0000 <= sector < 0xffff00 and sector in plugins:  # Plugin call
+        if handler is None:              # Just write this sector normally
+          image_put_sector(image, sector, data, flusher)  # Stow in the disk img
+          if read_ahead is not None: read_ahead.invalidate(sector)
+        else:                            # Conclusion or plugin call
           try:
-            _ = plugins[sector](op, sector, retry_count, sparing_thresh, data)
-          except profile_plugins.Conclusion as e:   # Conclude if plugin says so
+            _ = handler(op, sector, retry_count, sparing_thresh, data)
+          except profile_plugins.Conclusion as e:   # Conclude if told to
             conclusion = e.conclusion
-        else:                            # Just write this sector normally
-          image_put_sector(image, sector, data, flusher)  # Stow in the disk img
 
       else:
-        logging.warning('[%s] Unrecognised command, ignoring!', hex_command)
+        logging.warning('[%s] Unrecognised command, ignoring!', command.hex())
 
       # Tell the PRU to resume its processing.
       aphd_goahead(rpmsg)
+      if flusher is not None: flusher.activity()  # The Apple may now be idle.
+      if trace is not None:
+        trace.record(started, op, sector, retry_count, sparing_thresh, data)
+      if metrics is not None:
+        served_count, served_seconds = served.get(op, served[-1])
+        served_count.inc()
+        served_seconds.observe(time.perf_counter() - began)
       # Keep the last data read or written handy in case the Apple requests the
       # memory buffer contents.
       last_data = data
-
-  # We're no longer in the main emulation loop. Restore the old SIGTERM handler.
+      # While we wait for the next command, prepare the sectors (or plugin
+      # replies) that may follow.
+      if read_ahead is not None and read_ahead_after is not None:
+        read_ahead.prefetch(read_ahead_after, rpmsg)
+      elif handler is not None and op == PROFILE_READ:
+        plugin_read_ahead_handler = plugin_read_aheads.get(sector)
+        if plugin_read_ahead_handler is not None:
+          plugin_read_ahead_handler.prefetch()
+      # A plugin command that finished after its deadline may have concluded
+      # the session.
+      if late_conclusions and conclusion is None:
+        conclusion = late_conclusions[0]
+
+  # We're no longer in the main emulation loop. Restore the old SIGTERM handler,
+  # and let go of any views into the disk image so that it can be unmapped.
   finally:
     signal.signal(signal.SIGTERM, old_sigterm_handler)
+    data = last_data = None
+    for worker in plugin_workers.values(): worker.close()
+    if summary is not None: summary.log()
+    if read_ahead is not None: logging.info(
+        'Read-ahead: %d hits, %d misses.', read_ahead.hits, read_ahead.misses)
+    for sector, handler in plugin_read_aheads.items():
+      if handler.hits or handler.misses: logging.info(
+          'Plugin read-ahead for $%06X: %d hits, %d misses.', sector,
+          handler.hits, handler.misses)
+    if rpmsg.spin is not None: logging.info(
+        'Spin-waiting: data arrived in %d of %d spins; %.3f s of CPU time.',
+        rpmsg.spin.hits, rpmsg.spin.waits, rpmsg.spin.cpu_seconds)
 
   # Assuming we exited without an exception, return the session conclusion data.
   return conclusion
@@ -984,10 +3139,11 @@ def process_conclusion(
 
   elif command.startswith('IMAGE:'):
     next_image_path, next_image_file = os.path.split(command[6:])
-    if (next_image_path or                         # Files in cwd only.
-        not next_image_file or                     # Must specify a file.
-        not next_image_file.endswith('.image') or  # Must end in '.image'.
-        not os.path.exists(next_image_file)):      # Must exist.
+    if (next_image_path or                              # Files in cwd only.
+        not next_image_file or                          # Must specify a file.
+        not (next_image_file.endswith('.image') or      # Must end in '.image',
+             profile_dc42.is_dc42(next_image_file)) or  # or in '.dc42'.
+        not os.path.exists(next_image_file)):           # Must exist.
       return last_image_file
     else:
       return next_image_file
@@ -996,53 +3152,199 @@ def process_conclusion(
     return last_image_file
 
 
+#########################
+#### Start-up report ####
+#########################
+
+
+def seconds_since_start() -> Tuple[float, float]:
+  """Seconds since this process started, and since the system booted."""
+  since_boot = time.clock_gettime(time.CLOCK_BOOTTIME)
+  with open('/proc/self/stat', 'r') as f:
+    # The process's start time (in clock ticks since boot) is the 22nd field.
+    # Counting starts after the command name, which may contain spaces.
+    fields = f.read().rpartition(')')[2].split()
+  return since_boot - int(fields[19]) / os.sysconf('SC_CLK_TCK'), since_boot
+
+
+class StartupReport:
+  """Times the phases of the emulator's start-up, for a report in the log.
+
+  The Apple may want to boot from the emulator soon after it's switched on
+  (a Lisa 2/10 allows about 22 seconds), so start-up time matters. Parts of
+  start-up run at the same time in different threads; the report shows when
+  each began and ended, so that it's clear which of them were really holding
+  things up.
+  """
+
+  def __init__(self) -> None:
+    """Initialise a StartupReport, counting time from the process's start."""
+    self._lock = threading.Lock()  # Guards _phases.
+    now = time.monotonic()
+    self._start = now - seconds_since_start()[0]
+    # Phases: names, threads, start and end times.
+    self._phases = [('Python start-up and imports', 'MainThread', self._start,
+                     now)]  # type: List[Tuple[str, str, float, float]]
+
+  @contextlib.contextmanager
+  def phase(self, name: str) -> Iterator[None]:
+    """Within this context, time a phase of start-up called `name`."""
+    start = time.monotonic()
+    try:
+      yield
+    finally:
+      with self._lock:
+        self._phases.append((name, threading.current_thread().name, start,
+                             time.monotonic()))
+
+  def lines(self) -> List[str]:
+    """The report: each phase's start and end times, in seconds since the
+    process started, its duration, and the thread it ran in."""
+    with self._lock:
+      phases = sorted(self._phases, key=lambda phase: phase[2])
+    return ['  {:6.3f} s {:6.3f} s {:8.1f} ms  {:<12} {}'.format(
+        start - self._start, end - self._start, 1000 * (end - start),
+        thread, name) for name, thread, start, end in phases]
+
+  def log(self) -> None:
+    """Log the report, and how long start-up took, at the INFO level."""
+    since_start, since_boot = seconds_since_start()
+    logging.info('Ready %.2f s after the emulator started, %.1f s after the '
+                 'system booted. Start-up phases:', since_start, since_boot)
+    for line in self.lines(): logging.info(line)
+
+
 ######################
 #### Main program ####
 ######################
 
 
+def flush_policy(FLAGS: argparse.Namespace) -> FlushPolicy:
+  """Derive the `FlushPolicy` that command-line flags call for."""
+  policy = FLUSH_POLICIES[FLAGS.flush_policy]
+  if FLAGS.flush_delay is not None:
+    policy = policy._replace(delay=FLAGS.flush_delay)
+  if FLAGS.flush_max_dirty_kb is not None:
+    policy = policy._replace(max_dirty_bytes=FLAGS.flush_max_dirty_kb * 1024)
+  if FLAGS.flush_idle_ms is not None:
+    policy = policy._replace(idle=FLAGS.flush_idle_ms / 1000)
+  return policy
+
+
 def main(FLAGS: argparse.Namespace):
   # Verbose logging if desired.
-  if FLAGS.verbose: logging.getLogger().setLevel(logging.INFO)
+  if FLAGS.verbose: logging.getLogger().setLevel(
+      logging.DEBUG if FLAGS.verbose > 1 else logging.INFO)
+
+  # Time the phases of start-up, for a report once we're ready for the Apple.
+  startup = StartupReport()
+  paths = sysfs_paths(FLAGS.sysfs_root)
 
   # We'll read/write to this image file.
   image_file = FLAGS.image_file
+  if FLAGS.create_overlay and not os.path.exists(image_file):
+    profile_overlay.create_overlay(image_file, FLAGS.create_overlay)
 
   # This will store the error that kills us.
   terminating_error = None  # type: Optional[BaseException]
 
+  # Bringing up the PRUs is mostly a matter of waiting on the kernel, so it
+  # happens in the background, while we load plugins and open the disk image.
+  def setup_hardware():
+    # Set up the pinmux for the Aphid firmware.
+    if not FLAGS.skip_pin_setup:
+      with startup.phase('pin setup'): setup_pins(paths)
+    # (Re)start the Aphid firmware on the PRUs.
+    if not FLAGS.skip_pru_restart: setup_pru_firmware(
+        device=FLAGS.device,
+        load_firmware=(not FLAGS.skip_load_pru_firmware),
+        paths=paths, report=startup, settle=FLAGS.rpmsg_settle_s)
+
   # Open the all-important LEDs.
-  with LEDs() as leds:
-
-    # Have the LEDs cycling in the background as we set things up.
-    with leds.cycling_in_background():
-      # Set up the pinmux for the Aphid firmware.
-      if not FLAGS.skip_pin_setup: setup_pins()
-      # (Re)start the Aphid firmware on the PRUs.
-      if not FLAGS.skip_pru_restart: setup_pru_firmware(
-          device=FLAGS.device,
-          load_firmware=(not FLAGS.skip_load_pru_firmware))
-
-    # Open the PRU RPMsg device file.
+  with LEDs(enabled=not FLAGS.no_leds, prefix=paths.led_prefix) as leds:
+
     fd = None  # type: Optional[int]
     try:
-      fd = os.open(FLAGS.device, os.O_RDWR | os.O_DSYNC)
-      # Initialise low-level I/O for RPMsg.
-      rpmsg = rpmsg_io_init(fd)
+      # Counters and histograms for the --metrics_socket, if in use.
+      metrics = (profile_metrics.Registry() if FLAGS.metrics_socket else
+                 None)
+
+      def open_image(
+          path: str,
+          stack: contextlib.ExitStack,
+          journal: bool,
+      ) -> Tuple[Image, ImageFlusher]:
+        image = stack.enter_context(image_mmap(
+            path, FLAGS.create, journal, FLAGS.create_size, FLAGS.create_mode))
+        flusher = stack.enter_context(
+            ImageFlusher(image, flush_policy(FLAGS), metrics=metrics))
+        return image, flusher
 
       # Run back-to-back ProFile emulation sessions until there's an error.
+      # Plugins (and RPMsg I/O) last for all sessions; between sessions, the
+      # next session's disk image is taken from the pool of open disk images
+      # (or opened), and the last session's disk image stays in the pool (or
+      # is closed in the background).
       try:
-        while True:
-          # Load plugins, open disk image, commence a ProFile emulation session.
-          logging.info('Loading "magic block" plugins...')
-          with profile_plugins.plugins() as plugins:
+        with contextlib.ExitStack() as stack:
+          # Until we're ready for the Apple, have the LEDs cycling in the
+          # background as we set things up, and the PRUs coming up too.
+          booting = stack.enter_context(contextlib.ExitStack())
+          booting.enter_context(leds.cycling_in_background())
+          hardware = booting.enter_context(
+              concurrent.futures.ThreadPoolExecutor(
+                  1, thread_name_prefix='hardware')).submit(setup_hardware)
+          rpmsg = None  # type: Optional[Rpmsg]
+
+          if metrics is not None: stack.enter_context(
+              profile_metrics.MetricsServer(metrics, FLAGS.metrics_socket))
+          logging.info('%s "magic block" plugins...',
+                       'Loading' if FLAGS.eager_plugins else 'Finding')
+          with startup.phase('plugins'):
+            plugins = stack.enter_context(
+                profile_plugins.plugins(lazy=not FLAGS.eager_plugins))
+          closer = stack.enter_context(BackgroundCloser())
+          pool = stack.enter_context(
+              ImagePool(FLAGS.pool_mb << 20, closer, open_image, FLAGS.journal))
+          stack.enter_context(profile_plugins.providing('image_pool', pool))
+          trace = (stack.enter_context(profile_trace.TraceRecorder(
+              FLAGS.trace, FLAGS.trace_events, FLAGS.trace_data))
+                   if FLAGS.trace else None)
+          switch_start = None  # type: Optional[float]
+          while True:
+            # Open disk image, commence a ProFile emulation session.
             logging.info('Starting emulation with image file %s...', image_file)
-            with image_mmap(image_file, FLAGS.create) as image:
-              with ImageFlusher(image) as flusher:
-                conclusion = profile(image, rpmsg, leds, plugins, flusher)
-          # Process the session's "conclusion" before starting a new session.
-          logging.info('Emulation session ended. Processing conclusion...')
-          image_file = process_conclusion(image_file, conclusion)
+            with (startup.phase('disk image') if rpmsg is None else
+                  contextlib.nullcontext()):
+              image, flusher = pool.acquire(image_file)
+            flusher.also_flush = trace.dump if trace is not None else None
+            read_ahead = (ReadAhead(image, FLAGS.read_ahead)
+                          if FLAGS.read_ahead else None)
+            if switch_start is not None:
+              logging.info('Switched to image file %s in %.1f ms.', image_file,
+                           1000 * (time.monotonic() - switch_start))
+            with (Prefaulter(image, FLAGS.prefault)
+                  if FLAGS.prefault != 'none' else
+                  contextlib.nullcontext()) as prefaulter:
+              if rpmsg is None:
+                # Before the first session, wait for the PRUs to come up (the
+                # prefaulter, if any, carries on meanwhile), then open the
+                # PRU RPMsg device file and initialise low-level I/O for it.
+                with startup.phase('waiting for hardware'): hardware.result()
+                booting.close()
+                fd = os.open(FLAGS.device, os.O_RDWR | os.O_DSYNC)
+                rpmsg = rpmsg_io_init(
+                    fd, pipelined=FLAGS.pipelined_rpmsg,
+                    spin_window=FLAGS.spin_us / 1e6, metrics=metrics)
+                startup.log()
+              conclusion = profile(image, rpmsg, leds, plugins, flusher,
+                                   read_ahead, prefaulter, trace, metrics,
+                                   FLAGS.plugin_read_ahead,
+                                   FLAGS.plugin_deadline_ms / 1000)
+            # Process the session's "conclusion" before starting a new session.
+            logging.info('Emulation session ended. Processing conclusion...')
+            switch_start = time.monotonic()
+            image_file = process_conclusion(image_file, conclusion)
       except (Exception, KeyboardInterrupt) as error:
         # Interrupted. image_mmap will have saved and flushed the image.
         terminating_error = error
@@ -0,0 +1,1252 @@
+#!/usr/bin/python3
+"""Throughput and latency benchmarks for the Cameo/Aphid ProFile emulator.
+
+Forfeited into the public domain with NO WARRANTY. Read LICENSE for details.
+
+This program drives the emulator core in `profile.py` with synthetic Apple
+workloads and reports how quickly it serves them. The emulator talks to a
+simulated PRU1 (see `profile_simulator.py`), so no Cameo/Aphid hardware is
+needed: any Linux computer will do, though of course only numbers collected on
+a PocketBeagle say much about what the Apple will experience.
+
+Run with the --help flag for usage information. There are several benchmarks;
+the "session" benchmark is the main event. It runs one or more of these
+workloads through `profile.profile()`:
+
+   - boot: sequential reads from the start of the disk, as when a Lisa boots.
+   - writes: writes to random blocks, each later verified by a read.
+   - selector: a plugin-heavy session resembling the Selector's use of the
+     key/value store, filesystem operations, and system information plugins,
+     interspersed with ordinary disk reads.
+
+and then reports, for each kind of command, latency percentiles (measured from
+the moment the simulated PRU1 forwards an Apple command to the moment the
+emulator says "go ahead") alongside overall throughput in blocks per second.
+Data read back from the emulator is checked against what the disk image should
+contain.
+
+Ordinarily the emulator runs in this program's own process. With the --pty
+flag, the benchmark instead waits for a separate `profile.py` process to serve
+the workload via a pseudo-terminal, which includes emulator start-up and the
+command-line flag handling in the measurement.
+
+Other benchmarks are microbenchmarks of specific parts of the emulator:
+
+   - parity: the cost of encoding a sector with parity bytes for PRU1.
+   - dispatch: the cost of working out what to do with each command (read the
+     disk image, call a plugin, etc.) in the emulator's main loop.
+   - allocations: how much memory the emulator allocates (and so how much
+     data it copies) while exchanging sector data with PRU1.
+   - flush: the cost of saving a few changed sectors to a large disk image:
+     flushing the whole image, flushing just the changed pages, or syncing
+     a journal of the changes (see `profile_journal.py`).
+   - compressed: the on-card size of a mostly-empty disk image, and the time
+     taken to read its sectors, as an ordinary disk image file and as
+     compressed disk image files (see `profile_compressed.py`).
+   - prefault: how long the first reads from a disk image that isn't in
+     memory yet take, with and without the emulator's prefaulting (see
+     `Prefaulter` in `profile.py`).
+
+The "startup" benchmark measures how long the emulator takes to get going:
+loading "magic block" plugins, with and without putting off each plugin's
+loading until its first use, and starting a separate `profile.py` process
+until it serves the Apple's first command (and its first plugin command).
+It also runs the emulator's whole start-up sequence against a fake sysfs tree
+where PRU firmware takes a while to start, which shows how much of the other
+start-up work the emulator gets done while it waits.
+
+Finally, the "replay" benchmark is like the "session" benchmark, except that
+the workload is a trace of a real Apple's commands, recorded by the emulator
+with the --trace and --trace_data flags (see `profile_trace.py`). Given a copy
+of the disk image as it was when recording started, it replays the commands
+as fast as possible or at the pace they were recorded, and checks that the
+emulator still returns the recorded data for every read.
+"""
+
+import argparse
+import contextlib
+import os
+import random
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import profile
+import profile_compressed
+import profile_metrics
+import profile_plugins
+import profile_simulator
+import profile_trace
+
+
+# Where to find the plugins that the "selector" workload uses.
+PLUGIN_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# The Apple conclusion write that halts emulation.
+HALT = b'HALT' + bytes(profile.SECTOR_SIZE - 4)
+
+
+##############################
+#### Command-line parsing ####
+##############################
+
+
+def _define_flags() -> argparse.ArgumentParser:
+  """Defines an `ArgumentParser` for command-line flags used by this program."""
+
+  flags = argparse.ArgumentParser(
+      description='Cameo/Aphid ProFile emulator benchmarks.')
+  benchmarks = flags.add_subparsers(dest='benchmark', metavar='BENCHMARK')
+  benchmarks.required = True
+
+  session = benchmarks.add_parser('session', help=(
+      'Serve synthetic Apple workloads through the emulator core.'))
+  session.add_argument(
+      '-w', '--workload', choices=sorted(WORKLOADS) + ['all'], default='all',
+      help='Which workload to run. By default, all of them.')
+  session.add_argument(
+      '-n', '--commands', type=int, default=2000, help=(
+          'Approximate number of commands in each workload.'))
+  session.add_argument(
+      '--seed', type=int, default=0, help=(
+          'Random seed for the workloads.'))
+  _add_emulator_flags(session)
+  session.add_argument(
+      '--think_time', type=float, default=0.0, metavar='MICROSECONDS', help=(
+          'How long the simulated Apple idles between commands. A real Apple '
+          'spends about a millisecond moving a sector across the parallel '
+          'port, time in which the emulator may do work such as read-ahead. '
+          'By default, the Apple does not idle at all.'))
+  session.add_argument(
+      '--pty', action='store_true', help=(
+          'Serve the workload with a separate profile.py process connected '
+          'through a pseudo-terminal, instead of within this process.'))
+  session.add_argument(
+      '--image', type=str, default=None, help=(
+          'Where to create the disk image file for the benchmark. With --pty, '
+          'this is required, since the separate emulator process must open '
+          'it; otherwise a temporary file is used by default.'))
+
+  parity = benchmarks.add_parser('parity', help=(
+      'Measure the cost of encoding a sector with parity for PRU1.'))
+  parity.add_argument(
+      '-n', '--iterations', type=int, default=2000, help=(
+          'How many sectors to encode with each encoder.'))
+
+  dispatch = benchmarks.add_parser('dispatch', help=(
+      "Measure the cost of routing commands in the emulator's main loop."))
+  dispatch.add_argument(
+      '-n', '--commands', type=int, default=2000, help=(
+          'Approximate number of commands in each workload.'))
+  dispatch.add_argument(
+      '--seed', type=int, default=0, help=(
+          'Random seed for the workloads.'))
+
+  allocations = benchmarks.add_parser('allocations', help=(
+      'Measure memory allocated by the emulator while serving commands.'))
+  allocations.add_argument(
+      '-n', '--iterations', type=int, default=200, help=(
+          'How many commands of each kind to serve.'))
+
+  flush = benchmarks.add_parser('flush', help=(
+      'Measure the cost of saving changed sectors to the disk image file.'))
+  flush.add_argument(
+      '-n', '--iterations', type=int, default=20, help=(
+          'How many flushes to time with each method.'))
+  flush.add_argument(
+      '--image_mb', type=int, default=64, help=(
+          'Size of the disk image in megabytes.'))
+  flush.add_argument(
+      '--dirty', type=int, default=16, help=(
+          'How many randomly-chosen sectors to change before each flush.'))
+  flush.add_argument(
+      '--directory', type=str, default='.', help=(
+          'Where to make the temporary disk image. Results depend greatly on '
+          'the storage device: use the one that will hold real disk images.'))
+
+  compressed = benchmarks.add_parser('compressed', help=(
+      'Compare ordinary and compressed disk image files.'))
+  compressed.add_argument(
+      '-n', '--iterations', type=int, default=2000, help=(
+          'How many randomly-chosen sectors to read from each disk image.'))
+  compressed.add_argument(
+      '--image_mb', type=int, default=64, help=(
+          'Size of the disk image in megabytes.'))
+  compressed.add_argument(
+      '--used', type=float, default=0.1, help=(
+          'Fraction of the disk image that holds data; the rest is $00 bytes.'))
+  compressed.add_argument(
+      '--directory', type=str, default='.', help=(
+          'Where to make the temporary disk images.'))
+
+  prefault = benchmarks.add_parser('prefault', help=(
+      'Measure first reads from a disk image that is not in memory yet.'))
+  prefault.add_argument(
+      '-n', '--reads', type=int, default=500, help=(
+          'How many sectors to read: half sequentially from the start of the '
+          'disk image, as when the Apple boots, half at random.'))
+  prefault.add_argument(
+      '--image_mb', type=int, default=64, help=(
+          'Size of the disk image in megabytes.'))
+  prefault.add_argument(
+      '--delay', type=float, default=100.0, metavar='MS', help=(
+          'How long the Apple takes to issue its first read after the '
+          'emulator session starts.'))
+  prefault.add_argument(
+      '--directory', type=str, default='.', help=(
+          'Where to make the temporary disk image. Results depend greatly on '
+          'the storage device: use the one that will hold real disk images.'))
+
+  startup = benchmarks.add_parser('startup', help=(
+      'Measure how long the emulator takes to start serving the Apple.'))
+  startup.add_argument(
+      '-n', '--iterations', type=int, default=5, help=(
+          'How many times to load plugins and start the emulator, with and '
+          'without --eager_plugins.'))
+  startup.add_argument(
+      '--firmware_delay_ms', type=float, default=1000.0, help=(
+          'Also start the emulator without skipping pin setup and PRU '
+          'firmware start-up, against a fake sysfs tree (see '
+          'profile_simulator.FakeSysfs) in which PRU firmware takes this '
+          'long to start running. 0 skips this measurement.'))
+  startup.add_argument(
+      '--ignored_probes', type=int, default=2, help=(
+          'When starting PRU firmware in the fake sysfs tree, have the '
+          'simulated firmware ignore this many of the emulator\'s attempts '
+          'to make contact, as if it were still starting up.'))
+
+  replay = benchmarks.add_parser('replay', help=(
+      'Replay a trace of Apple commands through the emulator core.'))
+  _add_emulator_flags(replay)
+  replay.add_argument(
+      '--pace', choices=('fast', 'recorded'), default='fast', help=(
+          'Issue commands as fast as possible, or at the pace they were '
+          'recorded.'))
+  replay.add_argument(
+      '--pty', action='store_true', help=(
+          'Serve the workload with a separate profile.py process connected '
+          'through a pseudo-terminal, instead of within this process.'))
+  replay.add_argument(
+      'trace_file', type=str, help=(
+          'Trace recorded by profile.py --trace. Without --trace_data, writes '
+          'write $00 bytes and reads are not checked.'))
+  replay.add_argument(
+      'image_file', type=str, help=(
+          'The disk image as it was when recording started. The benchmark '
+          'works on a temporary copy.'))
+
+  return flags
+
+
+def _add_emulator_flags(parser: argparse.ArgumentParser) -> None:
+  """Add flags that configure the emulator to a benchmark's flag parser."""
+  parser.add_argument(
+      '--pipelined_rpmsg', action='store_true', help=(
+          "Use the emulator's pipelined RPMsg transfer mode."))
+  parser.add_argument(
+      '--flush_policy', choices=sorted(profile.FLUSH_POLICIES),
+      default='balanced', help=(
+          "The emulator's policy for saving changes to the disk image."))
+  parser.add_argument(
+      '--flush_delay', type=float, default=None, metavar='SECONDS', help=(
+          'Adjust the flush policy: see profile.py --help.'))
+  parser.add_argument(
+      '--flush_max_dirty_kb', type=int, default=None, metavar='KB', help=(
+          'Adjust the flush policy: see profile.py --help.'))
+  parser.add_argument(
+      '--flush_idle_ms', type=float, default=None, metavar='MS', help=(
+          'Adjust the flush policy: see profile.py --help.'))
+  parser.add_argument(
+      '--journal', action='store_true', help=(
+          "Use the emulator's journal mode for writes."))
+  parser.add_argument(
+      '--spin_us', type=int, default=0, metavar='MICROSECONDS', help=(
+          'Have the emulator spin for up to this long waiting for data from '
+          'PRU1 before polling for it.'))
+  parser.add_argument(
+      '--read_ahead', type=int, default=0, metavar='N', help=(
+          'Have the emulator prepare the N sectors following each read.'))
+  parser.add_argument(
+      '--eager_plugins', action='store_true', help=(
+          'Load all "magic block" plugins before the workload starts, rather '
+          'than when the workload first uses them.'))
+  parser.add_argument(
+      '--plugin_read_ahead', type=int, default=0, metavar='N', help=(
+          'Have "magic block" plugins that can prepare replies in advance '
+          'prepare N at a time.'))
+  parser.add_argument(
+      '--plugin_deadline_ms', type=float, default=0.0, metavar='MS', help=(
+          'Run "magic block" plugins on threads of their own, acknowledging '
+          'plugin writes after at most MS milliseconds.'))
+  parser.add_argument(
+      '--trace', type=str, default=None, metavar='FILE', help=(
+          "Have the emulator record a trace of the workload's commands in "
+          'FILE (see profile_trace.py). With several workloads, only the last '
+          "workload's trace remains."))
+  parser.add_argument(
+      '--trace_data', action='store_true', help=(
+          'With --trace, also record the data of each sector read or written.'))
+  parser.add_argument(
+      '--metrics', action='store_true', help=(
+          'Have the emulator keep the metrics it would serve with profile.py '
+          '--metrics_socket, and print them (without histogram buckets) '
+          'afterwards. Not available with --pty.'))
+
+
+###################
+#### Workloads ####
+###################
+
+
+class Command(NamedTuple(
+    'Command', [('kind', str),
+                ('op', int),
+                ('sector', int),
+                ('retry_count', int),
+                ('sparing_threshold', int),
+                ('data', Optional[bytes])])):
+  """One Apple command in a synthetic workload.
+
+  Fields:
+    kind: Category of the command for reporting, e.g. 'read' or 'plugin read'.
+    op: ProFile operation byte.
+    sector: Block to read or write.
+    retry_count: Retry count parameter.
+    sparing_threshold: Sparing threshold parameter.
+    data: Data to write for writes, else None.
+  """
+
+
+def pattern(sector: int) -> bytes:
+  """Initial contents of a sector in the benchmark disk image."""
+  return struct.pack('>L', sector) * (profile.SECTOR_SIZE // 4)
+
+
+def read(sector: int, kind: str = 'read') -> Command:
+  """Make a read Command."""
+  return Command(kind, profile.PROFILE_READ, sector, 0, 0, None)
+
+
+def write(sector: int, data: bytes, kind: str = 'write') -> Command:
+  """Make a write Command."""
+  return Command(kind, profile.PROFILE_WRITE, sector, 0, 0, data)
+
+
+def plugin_command(
+    sector: int, param: int, data: Optional[bytes] = None) -> Command:
+  """Make a plugin read (if `data` is None) or write Command."""
+  return Command(
+      'plugin read' if data is None else 'plugin write',
+      profile.PROFILE_READ if data is None else profile.PROFILE_WRITE,
+      sector, param >> 8, param & 0xff, data)
+
+
+def workload_boot(num_commands: int, rng: random.Random) -> List[Command]:
+  """Sequential reads from the start of the disk, as when booting."""
+  del rng  # Unused.
+  return ([read(0xffffff, 'spare table')] +
+          [read(s) for s in range(num_commands - 1)])
+
+
+def workload_writes(num_commands: int, rng: random.Random) -> List[Command]:
+  """Random writes, each followed (eventually) by a verifying read."""
+  sectors = [rng.randrange(profile.IMAGE_SIZE_P5 // profile.SECTOR_SIZE)
+             for _ in range(num_commands // 2)]
+  commands = [write(s, bytes(rng.getrandbits(8)
+                             for _ in range(profile.SECTOR_SIZE)))
+              for s in sectors]
+  rng.shuffle(sectors)
+  return commands + [read(s) for s in sectors]
+
+
+def workload_selector(num_commands: int, rng: random.Random) -> List[Command]:
+  """A plugin-heavy session like those the Selector conducts."""
+  commands = [read(0xffffff, 'spare table')]
+  # Load the Selector itself from the disk.
+  commands.extend(read(s) for s in range(num_commands // 4))
+  # Fill the key/value store, then load its entries into the cache.
+  keys = [rng.getrandbits(160).to_bytes(20, 'big') for _ in range(24)]
+  for i, key in enumerate(keys):
+    value = bytes(rng.getrandbits(8) for _ in range(512))
+    commands.append(plugin_command(0xfffeff, i, key + value))
+  load = bytes([len(keys)]) + b''.join(
+      struct.pack('>H', i) + key for i, key in enumerate(keys))
+  commands.append(plugin_command(
+      0xfffeff, 0xffff, load + bytes(profile.SECTOR_SIZE - len(load))))
+  # The rest of the session: catalogue listings, key/value store lookups,
+  # status checks, and the occasional disk read.
+  while len(commands) < num_commands:
+    choice = rng.random()
+    if choice < 0.4:
+      commands.extend(plugin_command(0xfffefe, i) for i in range(8))
+    elif choice < 0.7:
+      commands.extend(plugin_command(0xfffeff, i) for i in range(len(keys)))
+    elif choice < 0.8:
+      commands.append(plugin_command(0xfffefd, 0))
+    else:
+      start = rng.randrange(1000)
+      commands.extend(read(s) for s in range(start, start + 16))
+  return commands
+
+
+WORKLOADS = {
+    'boot': workload_boot,
+    'writes': workload_writes,
+    'selector': workload_selector,
+}  # type: Dict[str, Callable[[int, random.Random], List[Command]]]
+
+
+#################
+#### Results ####
+#################
+
+
+def percentile(ordered: List[float], fraction: float) -> float:
+  """Nearest-rank percentile of an already-sorted list."""
+  return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def report(
+    name: str,
+    latencies: Dict[str, List[float]],
+    elapsed: float,
+) -> None:
+  """Print latency percentiles and throughput for a workload.
+
+  Args:
+    name: Name of the workload.
+    latencies: Per-command latencies in seconds, keyed by command kind.
+    elapsed: Wall-clock time to serve the entire workload in seconds.
+  """
+  total = sum(len(l) for l in latencies.values())
+  print('Workload {}: {} commands in {:.3f} s, {:.1f} blocks/s'.format(
+      name, total, elapsed, total / elapsed))
+  print('  {:<14} {:>7} {:>9} {:>9} {:>9} {:>9}   (microseconds)'.format(
+      'command', 'count', 'p50', 'p90', 'p99', 'max'))
+  for kind, values in sorted(latencies.items()):
+    ordered = sorted(values)
+    print('  {:<14} {:>7} {:>9.0f} {:>9.0f} {:>9.0f} {:>9.0f}'.format(
+        kind, len(ordered), *(1e6 * percentile(ordered, f)
+                              for f in (0.5, 0.9, 0.99, 1.0))))
+
+
+#################################
+#### The "session" benchmark ####
+#################################
+
+
+def make_image(path: str) -> None:
+  """Create a 5 MB disk image whose sectors hold `pattern` data."""
+  with open(path, 'wb') as f:
+    f.write(b''.join(pattern(s) for s in range(
+        profile.IMAGE_SIZE_P5 // profile.SECTOR_SIZE)))
+
+
+def drive(
+    pru: profile_simulator.SimulatedPru1,
+    commands: List[Command],
+    think_time: float = 0.0,
+    expected: Optional[List[Optional[bytes]]] = None,
+    offsets: Optional[List[float]] = None,
+) -> Tuple[Dict[str, List[float]], float]:
+  """Issue a workload's commands via a simulated PRU1, then halt emulation.
+
+  Args:
+    pru: Simulated PRU1 connected to the emulator.
+    commands: Workload to issue.
+    think_time: Seconds to wait before issuing each command.
+    expected: If not None, the data that each command should read (or None
+        for commands whose results shouldn't be checked), in place of checking
+        reads against what the synthetic workload wrote to the disk image.
+    offsets: If not None, when to issue each command, in seconds since the
+        first command was issued, in place of `think_time`. Commands are
+        issued as soon as possible if the emulator falls behind.
+
+  Returns:
+    A tuple of per-command latencies in seconds, keyed by command kind, and
+    the time in seconds taken to serve the entire workload.
+
+  Raises:
+    profile_simulator.SimulationError: data read from the emulator didn't
+        match the expected contents of the disk image.
+  """
+  written = {}  # type: Dict[int, bytes]
+  latencies = {}  # type: Dict[str, List[float]]
+  workload_start = time.perf_counter()
+  for i, command in enumerate(commands):
+    if offsets is not None:
+      delay = workload_start + offsets[i] - time.perf_counter()
+      if delay > 0: time.sleep(delay)
+    elif think_time:
+      time.sleep(think_time)
+    start = time.perf_counter()
+    data = pru.command(*command[1:])
+    latencies.setdefault(command.kind, []).append(time.perf_counter() - start)
+
+    if expected is not None:
+      if expected[i] is not None and data != expected[i]:
+        raise profile_simulator.SimulationError(
+            'Command {} (sector ${:06X}) read different data than was '
+            'recorded'.format(i, command.sector))
+    elif command.kind == 'write':
+      written[command.sector] = command.data  # type: ignore
+    elif command.kind == 'read':
+      if data != written.get(command.sector, pattern(command.sector)):
+        raise profile_simulator.SimulationError(
+            'Read incorrect data from sector ${:06X}'.format(command.sector))
+  elapsed = time.perf_counter() - workload_start
+
+  pru.command(profile.PROFILE_WRITE, 0xfffffd, 0xfe, 0xaf, HALT)
+  return latencies, elapsed
+
+
+def serve_in_process(
+    image_file: str,
+    commands: List[Command],
+    FLAGS: argparse.Namespace,
+    expected: Optional[List[Optional[bytes]]] = None,
+    offsets: Optional[List[float]] = None,
+) -> Tuple[Dict[str, List[float]], float]:
+  """Serve a workload with `profile.profile()` running in this process.
+
+  The emulator runs in the main thread (it installs a signal handler) and the
+  simulated PRU1 runs in a background thread.
+
+  Args:
+    image_file: Disk image file for the emulator.
+    commands: Workload to serve.
+    FLAGS: Command-line flags, some of which configure the emulator.
+    expected: Passed to `drive`.
+    offsets: Passed to `drive`.
+
+  Returns:
+    Same as `drive`.
+  """
+  emulator_fd, pru_fd = profile_simulator.socketpair()
+  results = []  # type: List[Tuple[Dict[str, List[float]], float]]
+  errors = []  # type: List[BaseException]
+
+  def pru_thread():
+    try:
+      results.append(drive(profile_simulator.SimulatedPru1(pru_fd), commands,
+                           FLAGS.think_time / 1e6, expected, offsets))
+    except BaseException as e:
+      errors.append(e)
+      # Hanging up on the emulator makes it fail too, instead of waiting for
+      # more commands forever.
+      with socket.fromfd(pru_fd, socket.AF_UNIX, socket.SOCK_SEQPACKET) as s:
+        s.shutdown(socket.SHUT_RDWR)
+
+  thread = threading.Thread(target=pru_thread, name='simulated-pru1')
+  metrics = profile_metrics.Registry() if FLAGS.metrics else None
+  try:
+    rpmsg = profile.rpmsg_io_init(
+        emulator_fd, pipelined=FLAGS.pipelined_rpmsg,
+        spin_window=FLAGS.spin_us / 1e6, metrics=metrics)
+    with contextlib.ExitStack() as stack:
+      leds = stack.enter_context(profile.LEDs(enabled=False))
+      plugins = stack.enter_context(profile_plugins.plugins(
+          PLUGIN_DIRECTORY, lazy=not FLAGS.eager_plugins))
+      image = stack.enter_context(
+          profile.image_mmap(image_file, False, FLAGS.journal))
+      flusher = stack.enter_context(profile.ImageFlusher(
+          image, profile.flush_policy(FLAGS), metrics=metrics))
+      read_ahead = (profile.ReadAhead(image, FLAGS.read_ahead)
+                    if FLAGS.read_ahead else None)
+      trace = (stack.enter_context(profile_trace.TraceRecorder(
+          FLAGS.trace, data=FLAGS.trace_data)) if FLAGS.trace else None)
+      flusher.also_flush = trace.dump if trace is not None else None
+      thread.start()
+      try:
+        profile.profile(image, rpmsg, leds, plugins, flusher, read_ahead,
+                        trace=trace, metrics=metrics,
+                        plugin_read_ahead=FLAGS.plugin_read_ahead,
+                        plugin_deadline=FLAGS.plugin_deadline_ms / 1000)
+      except RuntimeError:
+        if not errors: raise  # Otherwise the simulator's error is more useful.
+      if read_ahead is not None:
+        print('Read-ahead: {} hits, {} misses'.format(
+            read_ahead.hits, read_ahead.misses))
+      for line in flusher.flush_times.lines() + flusher.dirty_ages.lines():
+        print(line)
+      if rpmsg.spin is not None:
+        print('Spin-waiting: data arrived in {} of {} spins; {:.3f} s of CPU '
+              'time'.format(rpmsg.spin.hits, rpmsg.spin.waits,
+                            rpmsg.spin.cpu_seconds))
+      if metrics is not None:
+        for line in metrics.exposition().splitlines():
+          if '_bucket{' not in line and not line.startswith('#'): print(line)
+  finally:
+    if thread.ident is not None: thread.join()
+    os.close(emulator_fd)
+    os.close(pru_fd)
+
+  if errors: raise errors[0]
+  return results[0]
+
+
+def serve_via_pty(
+    image_file: str,
+    commands: List[Command],
+    FLAGS: argparse.Namespace,
+    expected: Optional[List[Optional[bytes]]] = None,
+    offsets: Optional[List[float]] = None,
+) -> Tuple[Dict[str, List[float]], float]:
+  """Serve a workload with a separate emulator process.
+
+  Prints instructions for starting the emulator, then waits for the user to
+  press Enter before issuing commands.
+
+  Args:
+    image_file: Disk image file for the emulator.
+    commands: Workload to serve.
+    FLAGS: Command-line flags, some of which configure the emulator.
+    expected: Passed to `drive`.
+    offsets: Passed to `drive`.
+
+  Returns:
+    Same as `drive`.
+  """
+  master_fd, slave_fd, device = profile_simulator.open_pty()
+  try:
+    command = [sys.executable, os.path.join(PLUGIN_DIRECTORY, 'profile.py'),
+               '--device', device, '--no_leds', '--skip_pin_setup',
+               '--skip_pru_restart'] + emulator_flags(FLAGS) + [
+                   os.path.abspath(image_file)]
+    print('Start the emulator in another terminal with this command, then '
+          'press Enter here:\n\n  {}\n'.format(' '.join(command)))
+    input()
+    return drive(profile_simulator.SimulatedPru1(master_fd), commands,
+                 FLAGS.think_time / 1e6, expected, offsets)
+  finally:
+    os.close(slave_fd)
+    os.close(master_fd)
+
+
+def emulator_flags(FLAGS: argparse.Namespace) -> List[str]:
+  """profile.py command-line flags equivalent to our emulator configuration."""
+  flags = []
+  if FLAGS.pipelined_rpmsg: flags.append('--pipelined_rpmsg')
+  if FLAGS.journal: flags.append('--journal')
+  flags.append('--flush_policy={}'.format(FLAGS.flush_policy))
+  for flag in ('flush_delay', 'flush_max_dirty_kb', 'flush_idle_ms'):
+    value = getattr(FLAGS, flag)
+    if value is not None: flags.append('--{}={}'.format(flag, value))
+  if FLAGS.spin_us: flags.append('--spin_us={}'.format(FLAGS.spin_us))
+  if FLAGS.read_ahead: flags.append('--read_ahead={}'.format(FLAGS.read_ahead))
+  if FLAGS.eager_plugins: flags.append('--eager_plugins')
+  flags.append('--plugin_read_ahead={}'.format(FLAGS.plugin_read_ahead))
+  if FLAGS.plugin_deadline_ms:
+    flags.append('--plugin_deadline_ms={}'.format(FLAGS.plugin_deadline_ms))
+  if FLAGS.trace:
+    flags.append('--trace={}'.format(os.path.abspath(FLAGS.trace)))
+  if FLAGS.trace_data: flags.append('--trace_data')
+  return flags
+
+
+def benchmark_session(FLAGS: argparse.Namespace) -> None:
+  """Run the "session" benchmark as directed by command-line flags."""
+  if FLAGS.pty and not FLAGS.image: raise ValueError(
+      'The --image flag is required when using --pty.')
+  if FLAGS.pty and FLAGS.metrics: raise ValueError(
+      'The --metrics flag is not available with --pty.')
+
+  names = sorted(WORKLOADS) if FLAGS.workload == 'all' else [FLAGS.workload]
+  if FLAGS.trace: FLAGS.trace = os.path.abspath(FLAGS.trace)
+  serve = serve_via_pty if FLAGS.pty else serve_in_process
+
+  with tempfile.TemporaryDirectory() as tempdir:
+    # Plugins like the filesystem operations plugin work in the current
+    # directory, so we'd better make it somewhere harmless.
+    cwd = os.getcwd()
+    os.chdir(tempdir)
+    try:
+      for name in names:
+        image_file = os.path.join(cwd, FLAGS.image) if FLAGS.image else (
+            os.path.join(tempdir, 'benchmark.image'))
+        make_image(image_file)
+        commands = WORKLOADS[name](FLAGS.commands, random.Random(FLAGS.seed))
+        latencies, elapsed = serve(image_file, commands, FLAGS)
+        report(name, latencies, elapsed)
+    finally:
+      os.chdir(cwd)
+
+
+################################
+#### The "parity" benchmark ####
+################################
+
+
+def encode_sector_per_byte(data: bytes) -> Tuple[bytes, bytes, bytes]:
+  """The original per-byte parity encoder, for comparison."""
+  data = b''.join(bytes((c, profile.PARITY[c])) for c in data)
+  return (profile.APHD_COMMAND_PUT_PART_1 + data[:354],
+          profile.APHD_COMMAND_PUT_PART_2 + data[354:708],
+          profile.APHD_COMMAND_PUT_PART_3 + data[708:])
+
+
+def benchmark_parity(FLAGS: argparse.Namespace) -> None:
+  """Run the "parity" benchmark as directed by command-line flags."""
+  data = bytes(random.Random(0).getrandbits(8)
+               for _ in range(profile.SECTOR_SIZE))
+  encoders = [
+      ('per-byte', encode_sector_per_byte),
+      ('batched', profile.PutSectorFrames().encode),
+  ]  # type: List[Tuple[str, Callable[[bytes], Tuple[Any, Any, Any]]]]
+
+  expected = encode_sector_per_byte(data)
+  print('Parity encoding: {} sectors per encoder'.format(FLAGS.iterations))
+  for name, encoder in encoders:
+    if tuple(bytes(c) for c in encoder(data)) != expected: raise RuntimeError(
+        'The {} encoder produced incorrect commands'.format(name))
+    elapsed = min(timeit.repeat(
+        lambda: encoder(data), number=FLAGS.iterations, repeat=3))
+    print('  {:<10} {:>9.1f} microseconds/sector'.format(
+        name, 1e6 * elapsed / FLAGS.iterations))
+
+
+##################################
+#### The "dispatch" benchmark ####
+##################################
+
+
+def dispatch_by_comparisons(
+    commands: List[Tuple[int, int, int, int]],
+    plugins: Dict[int, Any],
+) -> int:
+  """Route commands with the original chain of comparisons, for comparison.
+
+  Args:
+    commands: (op, sector, retry count, sparing threshold) tuples.
+    plugins: "Magic block" plugins, keyed by sector.
+
+  Returns:
+    How many commands read or wrote the disk image.
+  """
+  disk = 0
+  for op, sector, retry_count, sparing_threshold in commands:
+    if op == profile.PROFILE_READ:
+      if sector == 0xffffff: pass
+      elif sector == 0xfffffe: pass
+      elif 0xff0000 <= sector < 0xffff00 and sector in plugins: pass
+      else: disk += 1
+    elif op in profile.ALL_PROFILE_WRITE_COMMANDS:
+      if (sector == 0xfffffd and retry_count == 0xfe and
+          sparing_threshold == 0xaf): pass
+      elif 0xff0000 <= sector < 0xffff00 and sector in plugins: pass
+      else: disk += 1
+  return disk
+
+
+def dispatch_by_routes(
+    commands: List[Tuple[int, int, int, int]],
+    routes: profile.Routes,
+) -> int:
+  """Route commands as `profile.profile()` does. Args and returns as above."""
+  disk_sectors, by_op = routes.disk_sectors, routes.by_op
+  no_routes = {}  # type: Dict[int, profile.Handler]
+  disk = 0
+  for op, sector, _, _ in commands:
+    handler = (None if sector < disk_sectors else
+               by_op.get(op, no_routes).get(sector))
+    if op == profile.PROFILE_READ:
+      if handler is None: disk += 1
+    elif op in profile.ALL_PROFILE_WRITE_COMMANDS:
+      if handler is None: disk += 1
+  return disk
+
+
+def benchmark_dispatch(FLAGS: argparse.Namespace) -> None:
+  """Run the "dispatch" benchmark as directed by command-line flags."""
+  plugins = {sector: lambda *args: None
+             for sector in (0xfffefc, 0xfffefd, 0xfffefe, 0xfffeff)}
+
+  def loop_only(commands, _):
+    for _ in commands: pass
+
+  with tempfile.TemporaryDirectory() as tempdir:
+    image_file = os.path.join(tempdir, 'benchmark.image')
+    make_image(image_file)
+    with profile.image_mmap(image_file, False) as image:
+      routes = profile.command_routes(image, plugins, lambda: HALT)
+      print('Command dispatch: {} commands per workload'.format(
+          FLAGS.commands))
+      for name in sorted(WORKLOADS):
+        commands = [c[1:5] for c in WORKLOADS[name](
+            FLAGS.commands, random.Random(FLAGS.seed))]
+        if (dispatch_by_comparisons(commands, plugins) !=
+            dispatch_by_routes(commands, routes)): raise RuntimeError(
+                'The dispatchers disagree about the {} workload'.format(name))
+        times = {
+            dispatcher.__name__: min(timeit.repeat(
+                lambda: dispatcher(commands, argument), number=20,
+                repeat=5)) / (20 * len(commands))
+            for dispatcher, argument in ((loop_only, None),
+                                         (dispatch_by_comparisons, plugins),
+                                         (dispatch_by_routes, routes))}
+        for dispatcher in ('dispatch_by_comparisons', 'dispatch_by_routes'):
+          print('  {:<9} {:<24} {:>6.1f} ns/command'.format(
+              name, dispatcher,
+              1e9 * (times[dispatcher] - times['loop_only'])))
+
+
+#####################################
+#### The "allocations" benchmark ####
+#####################################
+
+
+def benchmark_allocations(FLAGS: argparse.Namespace) -> None:
+  """Run the "allocations" benchmark as directed by command-line flags.
+
+  Python offers no simple way to count individual memory allocations, so we
+  use `tracemalloc` to measure the peak memory allocated while the emulator
+  handles the sector data for one command. This is mostly the space taken by
+  temporary copies of sector data, so it shows how many copies are made.
+  Everything happens in this thread: the PRU1 end of the connection is not
+  simulated, just drained (or for writes, pre-loaded with sector data).
+  """
+  emulator_fd, pru_fd = profile_simulator.socketpair()
+  os.set_blocking(pru_fd, False)
+  rpmsg = profile.rpmsg_io_init(emulator_fd)
+
+  def drain():
+    try:
+      while os.read(pru_fd, 4096): pass
+    except BlockingIOError:
+      pass
+
+  def read_original(image, sector):  # The emulator's original read path.
+    data = image.mapped[sector * 532:(sector + 1) * 532]
+    for command in encode_sector_per_byte(data):
+      profile.rpmsg_write(rpmsg, command)
+    profile.aphd_goahead(rpmsg)
+
+  def read_current(image, sector):  # The emulator's read path now.
+    profile.aphd_put_sector(rpmsg, profile.image_get_sector(image, sector))
+    profile.aphd_goahead(rpmsg)
+
+  def write_current(image, sector):  # The emulator's write path now.
+    profile.image_put_sector(image, sector, profile.aphd_get_sector(rpmsg),
+                             flusher)
+    profile.aphd_goahead(rpmsg)
+
+  paths = [
+      ('read (original)', read_original),
+      ('read', read_current),
+      ('write', write_current),
+  ]
+
+  print('Peak bytes allocated while handling sector data for one command:')
+  print('  {:<16} {:>9} {:>9}'.format('command', 'mean', 'max'))
+  with tempfile.TemporaryDirectory() as tempdir:
+    image_file = os.path.join(tempdir, 'benchmark.image')
+    make_image(image_file)
+    with profile.image_mmap(image_file, False) as image:
+      with profile.ImageFlusher(image) as flusher:
+        tracemalloc.start()
+        try:
+          for name, path in paths:
+            peaks = []
+            for sector in range(FLAGS.iterations):
+              drain()
+              if name == 'write':  # Pre-load Apple data for aphd_get_sector.
+                os.write(pru_fd, bytes(266))
+                os.write(pru_fd, bytes(266))
+              tracemalloc.reset_peak()
+              baseline = tracemalloc.get_traced_memory()[0]
+              path(image, sector)
+              peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+            print('  {:<16} {:>9.0f} {:>9}'.format(
+                name, sum(peaks) / len(peaks), max(peaks)))
+        finally:
+          tracemalloc.stop()
+          drain()
+
+  os.close(emulator_fd)
+  os.close(pru_fd)
+
+
+###############################
+#### The "flush" benchmark ####
+###############################
+
+
+def benchmark_flush(FLAGS: argparse.Namespace) -> None:
+  """Run the "flush" benchmark as directed by command-line flags."""
+  rng = random.Random(0)
+  with tempfile.TemporaryDirectory(dir=FLAGS.directory) as tempdir:
+    image_file = os.path.join(tempdir, 'benchmark.image')
+    with open(image_file, 'wb') as f:
+      f.truncate(FLAGS.image_mb << 20)
+
+    with profile.image_mmap(image_file, False) as image:
+      num_sectors = image.image_size // profile.SECTOR_SIZE
+      # We call the flusher's internals ourselves instead of starting its
+      # thread, the better to time them.
+      flusher = profile.ImageFlusher(image)
+
+      def change_sectors():
+        for _ in range(FLAGS.dirty):
+          sector = rng.randrange(num_sectors)
+          profile.image_put_sector(image, sector, pattern(rng.getrandbits(32)),
+                                   flusher)
+
+      def flush_everything():
+        flusher._dirty_ranges()  # Forget what changed.
+        image.mapped.flush()
+
+      def time_flushes(name, flush):
+        elapsed = []
+        for _ in range(FLAGS.iterations):
+          change_sectors()
+          start = time.perf_counter()
+          flush()
+          elapsed.append(time.perf_counter() - start)
+        elapsed.sort()
+        print('  {:<14} p50 {:>9.0f} max {:>9.0f} microseconds'.format(
+            name, 1e6 * percentile(elapsed, 0.5), 1e6 * elapsed[-1]))
+
+      print('Flushing {} changed sectors in a {} MB disk image:'.format(
+          FLAGS.dirty, FLAGS.image_mb))
+      time_flushes('whole image', flush_everything)
+      time_flushes('changed pages', flusher._flush)
+
+    with profile.image_mmap(image_file, False, journal=True) as image:
+      flusher = profile.ImageFlusher(
+          image, checkpoint_records=FLAGS.iterations * FLAGS.dirty + 1)
+      time_flushes('journal', flusher._flush)
+      start = time.perf_counter()
+      checkpointed = image.journal.checkpoint()  # type: ignore
+      print('  Checkpointing the journal\'s {} sectors took {:.0f} '
+            'microseconds.'.format(
+                checkpointed, 1e6 * (time.perf_counter() - start)))
+
+
+####################################
+#### The "compressed" benchmark ####
+####################################
+
+
+def benchmark_compressed(FLAGS: argparse.Namespace) -> None:
+  """Run the "compressed" benchmark as directed by command-line flags."""
+  rng = random.Random(0)
+  num_sectors = (FLAGS.image_mb << 20) // profile.SECTOR_SIZE
+  # Data is clustered at the start of the disk, as it usually is.
+  used_sectors = int(FLAGS.used * num_sectors)
+  sectors = [rng.randrange(num_sectors) for _ in range(FLAGS.iterations)]
+
+  with tempfile.TemporaryDirectory(dir=FLAGS.directory) as tempdir:
+    raw_file = os.path.join(tempdir, 'raw.image')
+    with open(raw_file, 'wb') as f:
+      f.write(b''.join(pattern(s) for s in range(used_sectors)))
+      f.write(bytes((num_sectors - used_sectors) * profile.SECTOR_SIZE))
+
+    image_files = [('ordinary', raw_file)]
+    for codec in sorted(profile_compressed.CODECS):
+      image_file = os.path.join(tempdir, codec + '.image')
+      start = time.perf_counter()
+      with open(raw_file, 'rb') as f:
+        profile_compressed.write_compressed(
+            image_file, num_sectors * profile.SECTOR_SIZE,
+            lambda offset, length: os.pread(f.fileno(), length, offset), codec)
+      print('  (Compressing with {} took {:.1f} seconds.)'.format(
+          codec, time.perf_counter() - start))
+      image_files.append((codec, image_file))
+
+    print('Reading {} random sectors from a {} MB disk image that is {:.0%} '
+          'used:'.format(FLAGS.iterations, FLAGS.image_mb, FLAGS.used))
+    for name, image_file in image_files:
+      on_card = os.stat(image_file).st_blocks * 512
+      with profile.image_mmap(image_file, False) as image:
+        elapsed = []
+        for sector in sectors:
+          start = time.perf_counter()
+          data = bytes(profile.image_get_sector(image, sector))
+          elapsed.append(time.perf_counter() - start)
+          if data != (pattern(sector) if sector < used_sectors else
+                      bytes(profile.SECTOR_SIZE)): raise RuntimeError(
+              'Read the wrong data from sector {} of the {} disk image.'.format(
+                  sector, name))
+      elapsed.sort()
+      print('  {:<9} {:>9} KB on the card; read p50 {:>6.0f} p99 {:>6.0f} max '
+            '{:>6.0f} microseconds'.format(
+                name, on_card >> 10, 1e6 * percentile(elapsed, 0.5),
+                1e6 * percentile(elapsed, 0.99), 1e6 * elapsed[-1]))
+
+
+##################################
+#### The "prefault" benchmark ####
+##################################
+
+
+def benchmark_prefault(FLAGS: argparse.Namespace) -> None:
+  """Run the "prefault" benchmark as directed by command-line flags."""
+  rng = random.Random(0)
+  num_sectors = (FLAGS.image_mb << 20) // profile.SECTOR_SIZE
+  sequential = list(range(FLAGS.reads // 2))
+  scattered = [rng.randrange(num_sectors)
+               for _ in range(FLAGS.reads - len(sequential))]
+
+  with tempfile.TemporaryDirectory(dir=FLAGS.directory) as tempdir:
+    image_file = os.path.join(tempdir, 'benchmark.image')
+    with open(image_file, 'wb') as f:
+      for _ in range(FLAGS.image_mb):
+        f.write(os.urandom(1 << 20))
+
+    print('First reads from a {} MB disk image, {:.0f} ms after the session '
+          'starts:'.format(FLAGS.image_mb, FLAGS.delay))
+    for region in ('none', 'boot', 'all'):
+      # Evict the disk image from the page cache.
+      with open(image_file, 'rb') as f:
+        os.fsync(f.fileno())
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+      with profile.image_mmap(image_file, False) as image:
+        with (profile.Prefaulter(image, region) if region != 'none' else
+              contextlib.nullcontext()) as prefaulter:
+          time.sleep(FLAGS.delay / 1000)
+          for name, sectors in (('sequential', sequential),
+                                ('scattered', scattered)):
+            elapsed = []
+            for sector in sectors:
+              start = time.perf_counter()
+              bytes(profile.image_get_sector(image, sector))
+              elapsed.append(time.perf_counter() - start)
+              if prefaulter is not None: prefaulter.note_read(sector)
+            elapsed.sort()
+            print('  prefault {:<4} {:<10} total {:>7.1f} ms, p50 {:>5.0f} '
+                  'max {:>6.0f} microseconds'.format(
+                      region, name, 1000 * sum(elapsed),
+                      1e6 * percentile(elapsed, 0.5), 1e6 * elapsed[-1]))
+
+
+#################################
+#### The "startup" benchmark ####
+#################################
+
+
+def time_to_ready(
+    image_file: str,
+    eager_plugins: bool,
+    firmware_delay: Optional[float] = None,
+    ignore_probes: int = 0,
+) -> Tuple[float, float]:
+  """Start a separate emulator process and time its first replies.
+
+  Args:
+    image_file: Disk image file for the emulator, in a directory holding the
+        plugins for the emulator to load.
+    eager_plugins: Whether to start the emulator with --eager_plugins.
+    firmware_delay: If not None, the emulator sets up pins and starts PRU
+        firmware in a fake sysfs tree, where the firmware takes this many
+        seconds to start running. Otherwise it skips both.
+    ignore_probes: With `firmware_delay`, ignore this many of the emulator's
+        attempts to make contact with PRU1.
+
+  Returns:
+    Seconds from starting the process to the reply to the Apple's first
+    command (a read of the spare table), and seconds taken to serve the
+    Apple's first plugin command after that (a read from the key/value store,
+    the slowest of the usual plugins to load).
+  """
+  master_fd, slave_fd, device = profile_simulator.open_pty()
+  try:
+    sysfs_root = tempfile.mkdtemp() if firmware_delay is not None else None
+    sysfs = (profile_simulator.FakeSysfs(
+        sysfs_root, profile.PRU_INPUT_PINS + profile.PRU_OUTPUT_PINS +
+        tuple(pin for pin, _ in profile.GPIO_INPUT_PINS),
+        [gpio for _, gpio in profile.GPIO_INPUT_PINS], firmware_delay)
+             if sysfs_root is not None else contextlib.nullcontext())
+    command = [sys.executable, os.path.join(PLUGIN_DIRECTORY, 'profile.py'),
+               '--device', device, '--no_leds'] + (
+                   ['--sysfs_root', sysfs_root] if sysfs_root is not None else
+                   ['--skip_pin_setup', '--skip_pru_restart']) + (
+                       ['--eager_plugins'] if eager_plugins else []) + [
+                           image_file]
+    with sysfs:
+      start = time.perf_counter()
+      process = subprocess.Popen(
+          command, cwd=os.path.dirname(image_file), stdout=subprocess.DEVNULL,
+          stderr=subprocess.DEVNULL)
+      try:
+        pru = profile_simulator.SimulatedPru1(master_fd, timeout=60.0)
+        if sysfs_root is not None: pru.await_bootup(ignore_probes)
+        pru.command(profile.PROFILE_READ, 0xffffff)
+        ready = time.perf_counter() - start
+        start = time.perf_counter()
+        pru.command(profile.PROFILE_READ, 0xfffeff)
+        first_plugin = time.perf_counter() - start
+      finally:
+        # Even after a clean shutdown, the emulator idles until it's killed,
+        # so we may as well skip the shutdown. Nothing in its directory
+        # matters.
+        process.kill()
+        process.wait()
+    return ready, first_plugin
+  finally:
+    if sysfs_root is not None: shutil.rmtree(sysfs_root)
+    os.close(slave_fd)
+    os.close(master_fd)
+
+
+def benchmark_startup(FLAGS: argparse.Namespace) -> None:
+  """Run the "startup" benchmark as directed by command-line flags."""
+  with tempfile.TemporaryDirectory() as tempdir:
+    # The key/value store plugin makes its database in the current directory,
+    # so we'd better make it somewhere harmless.
+    cwd = os.getcwd()
+    os.chdir(tempdir)
+    try:
+      print('Loading plugins in this process (the first time includes '
+            'importing the modules that plugins use):')
+      for lazy in (False, True):
+        elapsed = []
+        for _ in range(FLAGS.iterations):
+          start = time.perf_counter()
+          with profile_plugins.plugins(PLUGIN_DIRECTORY, lazy):
+            elapsed.append(time.perf_counter() - start)
+        print('  {:<6} first {:>7.1f} ms, then p50 {:>7.1f} ms'.format(
+            'lazy' if lazy else 'eager', 1000 * elapsed[0],
+            1000 * percentile(sorted(elapsed[1:] or elapsed), 0.5)))
+
+      # The emulator loads plugins from its current directory.
+      for path in profile_plugins.find_plugins(PLUGIN_DIRECTORY).values():
+        shutil.copy(path, tempdir)
+      image_file = os.path.join(tempdir, 'benchmark.image')
+      make_image(image_file)
+      print('Starting profile.py until it serves the first command:')
+      firmware_delay = FLAGS.firmware_delay_ms / 1000
+      for eager, delay in ((True, None), (False, None)) + (
+          ((True, firmware_delay), (False, firmware_delay))
+          if firmware_delay else ()):
+        readies, first_plugins = [], []  # type: List[float], List[float]
+        for _ in range(FLAGS.iterations):
+          ready, first_plugin = time_to_ready(
+              image_file, eager, delay, FLAGS.ignored_probes)
+          readies.append(ready)
+          first_plugins.append(first_plugin)
+        readies.sort()
+        first_plugins.sort()
+        print('  {:<6} {:<22} ready p50 {:>7.1f} ms, max {:>7.1f} ms; first '
+              'plugin command p50 {:>6.1f} ms, max {:>6.1f} ms'.format(
+                  'eager' if eager else 'lazy',
+                  'no PRU start-up' if delay is None else
+                  '{:.0f} ms PRU start-up'.format(1000 * delay),
+                  1000 * percentile(readies, 0.5), 1000 * readies[-1],
+                  1000 * percentile(first_plugins, 0.5),
+                  1000 * first_plugins[-1]))
+    finally:
+      os.chdir(cwd)
+
+
+################################
+#### The "replay" benchmark ####
+################################
+
+
+def trace_workload(
+    path: str,
+) -> Tuple[List[Command], List[Optional[bytes]], List[float]]:
+  """Convert a trace file into a workload for `drive`.
+
+  The workload ends just before the first command that would conclude the
+  emulation session, since the emulator would switch disk images then.
+
+  Args:
+    path: Path to a trace file recorded by profile.py --trace.
+
+  Returns:
+    The workload's commands, the data that each command should read (None
+    where it can't be checked), and when each command was issued in seconds
+    since the first command.
+  """
+  _, records, payloads = profile_trace.read_trace(path)
+  commands = []  # type: List[Command]
+  expected = []  # type: List[Optional[bytes]]
+  offsets = []  # type: List[float]
+  for i, (micros, sector, op, retry_count, sparing, _) in enumerate(records):
+    if op not in (profile.PROFILE_READ,) + profile.ALL_PROFILE_WRITE_COMMANDS:
+      continue  # The emulator ignores these.
+    if (op != profile.PROFILE_READ and sector == 0xfffffd and
+        retry_count == 0xfe and sparing == 0xaf):
+      print('Replaying the {} commands before the session concluded; {} more '
+            'are not replayed.'.format(len(commands), len(records) - i))
+      break
+    payload = payloads[i] if payloads is not None else None
+    plugin = 0xff0000 <= sector < 0xffff00
+    if op == profile.PROFILE_READ:
+      kind = ('plugin read' if plugin else
+              'spare table' if sector == 0xffffff else 'read')
+      # Plugins like the system information plugin needn't be repeatable.
+      expected.append(None if plugin else payload)
+      payload = None
+    else:
+      kind = 'plugin write' if plugin else 'write'
+      expected.append(None)
+      if payload is None: payload = bytes(profile.SECTOR_SIZE)
+    commands.append(Command(kind, op, sector, retry_count, sparing, payload))
+    offsets.append((micros - records[0][0]) / 1e6)
+  return commands, expected, offsets
+
+
+def benchmark_replay(FLAGS: argparse.Namespace) -> None:
+  """Run the "replay" benchmark as directed by command-line flags."""
+  if FLAGS.pty and FLAGS.metrics: raise ValueError(
+      'The --metrics flag is not available with --pty.')
+  commands, expected, offsets = trace_workload(FLAGS.trace_file)
+  if not any(e is not None for e in expected): print(
+      'The trace holds no sector data, so reads will not be checked.')
+  FLAGS.think_time = 0.0
+  if FLAGS.trace: FLAGS.trace = os.path.abspath(FLAGS.trace)
+  serve = serve_via_pty if FLAGS.pty else serve_in_process
+
+  with tempfile.TemporaryDirectory() as tempdir:
+    # As in the "session" benchmark, keep plugins away from anything useful.
+    image_file = os.path.join(tempdir, os.path.basename(FLAGS.image_file))
+    shutil.copyfile(FLAGS.image_file, image_file)
+    cwd = os.getcwd()
+    os.chdir(tempdir)
+    try:
+      latencies, elapsed = serve(
+          image_file, commands, FLAGS, expected,
+          offsets if FLAGS.pace == 'recorded' else None)
+    finally:
+      os.chdir(cwd)
+  report('replay of {}'.format(FLAGS.trace_file), latencies, elapsed)
+
+
+######################
+#### Main program ####
+######################
+
+
+BENCHMARKS = {
+    'session': benchmark_session,
+    'parity': benchmark_parity,
+    'dispatch': benchmark_dispatch,
+    'allocations': benchmark_allocations,
+    'flush': benchmark_flush,
+    'compressed': benchmark_compressed,
+    'prefault': benchmark_prefault,
+    'startup': benchmark_startup,
+    'replay': benchmark_replay,
+}  # type: Dict[str, Callable[[argparse.Namespace], None]]
+
+
+def main(FLAGS: argparse.Namespace):
+  BENCHMARKS[FLAGS.benchmark](FLAGS)
+
+
+if __name__ == '__main__':
+  flags = _define_flags()
+  FLAGS = flags.parse_args()
+  main(FLAGS)
@@ -0,0 +1,401 @@
+#!/usr/bin/python3
+"""Compressed disk images for the ProFile emulator.
+
+Forfeited into the public domain with NO WARRANTY. Read LICENSE for details.
+
+Most of a typical disk image is empty space: long runs of $00 bytes. A
+compressed disk image file stores the same data in far less room on the
+microSD card. The emulator in `profile.py` recognises a compressed disk image
+file by the magic number at its beginning, so compressed files can have the
+same `.image` suffix as ordinary disk image files, and the Apple can select
+them in the usual way.
+
+A compressed disk image is divided into "chunks" of consecutive sectors (64 by
+default), each compressed independently with `zlib` or `lzma`, so that reading
+any sector only means decompressing its own chunk. The emulator keeps recently
+used chunks decompressed in memory. Sectors the Apple writes change these
+decompressed chunks, which are compressed and saved again when the emulator
+flushes its changes (see `ImageFlusher` in `profile.py`).
+
+A compressed disk image file starts with a 512-byte header: the magic number
+`b'Cameo/Aphid compressed 0001\\0'`, then the size of the uncompressed disk
+image in bytes, the number of sectors in a chunk, the compression method, the
+file offset of the chunk index, and a CRC-32 of the chunk index (see
+`_HEADER_FIELDS`), then $00 padding. The chunk index has a 12-byte entry for
+each chunk: the chunk's file offset and its compressed length. A chunk of
+nothing but $00 bytes has length 0 and is not stored at all.
+
+Saving changes never overwrites data that the header refers to: new chunk data
+and a new chunk index are appended to the file, and only once they're safely
+on the card does the header change to point at the new index. Superseded chunk
+data is left behind as garbage, which is tidied away when the image is closed
+if there is enough of it.
+
+Run this module as a program to convert disk image files to and from the
+compressed format; use the --help flag for details.
+"""
+
+import argparse
+import collections
+import logging
+import lzma
+import os
+import struct
+import threading
+import zlib
+
+from typing import Callable, Dict, Iterator, List, Tuple, Union
+
+
+SECTOR_SIZE = 532  # Sector size in bytes. Cf. "block size" in spare tables.
+
+COMPRESSED_MAGIC = b'Cameo/Aphid compressed 0001\x00'
+DEFAULT_CHUNK_SECTORS = 64  # Sectors per chunk for new compressed images.
+DEFAULT_CACHE_CHUNKS = 32  # How many decompressed chunks to keep in memory.
+
+# Compression methods: name -> (header code, compressor, decompressor).
+_Codec = Tuple[int, Callable[[bytes], bytes], Callable[[bytes], bytes]]
+CODECS = {
+    'zlib': (1, zlib.compress, zlib.decompress),
+    'lzma': (2, lzma.compress, lzma.decompress),
+}  # type: Dict[str, _Codec]
+
+# Header fields after the magic number: uncompressed image size, sectors per
+# chunk, compression method code, chunk index offset, chunk index CRC-32.
+_HEADER_FIELDS = struct.Struct('<QLLQL')
+_HEADER_SIZE = 512
+_INDEX_ENTRY = struct.Struct('<QL')  # Chunk offset, chunk compressed length.
+
+# Tidy away garbage on close once it's larger than this and larger than the
+# chunk data that's still in use.
+_COMPACT_MIN_GARBAGE = 1 << 20
+
+
+def is_compressed(path: str) -> bool:
+  """Is the file at `path` a compressed disk image file?"""
+  with open(path, 'rb') as f:
+    return f.read(len(COMPRESSED_MAGIC)) == COMPRESSED_MAGIC
+
+
+def _codec_name(code: int) -> str:
+  """Find the name of the compression method with header code `code`."""
+  for name, (codec_code, _, _) in CODECS.items():
+    if codec_code == code: return name
+  raise ValueError('Unknown compression method code {}.'.format(code))
+
+
+def write_compressed(
+    path: str,
+    image_size: int,
+    read_chunk: Callable[[int, int], bytes],
+    codec: str = 'zlib',
+    chunk_sectors: int = DEFAULT_CHUNK_SECTORS,
+) -> None:
+  """Write a new compressed disk image file.
+
+  The file is written under a temporary name, then renamed to `path`, so a
+  file at `path` is either complete or (if there was one) untouched.
+
+  Args:
+    path: Path to the new compressed disk image file. Any existing file there
+        will be replaced.
+    image_size: Size of the uncompressed disk image in bytes.
+    read_chunk: Called with a byte offset and a length; returns that much
+        uncompressed disk image data from that offset.
+    codec: Name of the compression method to use (a key in `CODECS`).
+    chunk_sectors: How many sectors to compress together into each chunk.
+  """
+  code, compress, _ = CODECS[codec]
+  chunk_size = chunk_sectors * SECTOR_SIZE
+  temp_path = path + '.new'
+  with open(temp_path, 'wb') as f:
+    f.write(bytes(_HEADER_SIZE))
+    index = []
+    for start in range(0, image_size, chunk_size):
+      data = read_chunk(start, min(chunk_size, image_size - start))
+      if data.count(0) == len(data):  # All $00 bytes: don't store it.
+        index.append(_INDEX_ENTRY.pack(0, 0))
+      else:
+        index.append(_INDEX_ENTRY.pack(f.tell(), f.write(compress(data))))
+    index_offset = f.tell()
+    index_data = b''.join(index)
+    f.write(index_data)
+    f.seek(0)
+    f.write(COMPRESSED_MAGIC + _HEADER_FIELDS.pack(
+        image_size, chunk_sectors, code, index_offset, zlib.crc32(index_data)))
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(temp_path, path)
+
+
+class CompressedImage:
+  """An open compressed disk image file.
+
+  See the file header comment for an overview. `get` and `put` are meant to be
+  called from the emulator's main thread; `flush` may be called from another
+  thread (e.g. the `ImageFlusher` thread).
+
+  Attributes:
+    path: Path to the compressed disk image file.
+    image_size: Size of the uncompressed disk image in bytes.
+    chunk_sectors: How many sectors are compressed together in each chunk.
+    codec: Name of the compression method (a key in `CODECS`).
+    hits: How many sector reads and writes found their chunk in memory.
+    misses: How many sector reads and writes had to decompress their chunk.
+  """
+
+  def __init__(
+      self,
+      path: str,
+      cache_chunks: int = DEFAULT_CACHE_CHUNKS,
+  ) -> None:
+    """Open a compressed disk image file.
+
+    Args:
+      path: Path to the compressed disk image file.
+      cache_chunks: How many decompressed chunks to keep in memory (in
+          addition to any chunks with changes not yet saved).
+
+    Raises:
+      ValueError: The file at `path` isn't a compressed disk image file, or
+          it is damaged.
+    """
+    self.path = path
+    self._cache_chunks = cache_chunks
+    self._fd = os.open(path, os.O_RDWR)
+    try:
+      header = os.pread(self._fd, _HEADER_SIZE, 0)
+      if not header.startswith(COMPRESSED_MAGIC): raise ValueError(
+          '{} is not a compressed disk image file.'.format(path))
+      (self.image_size, self.chunk_sectors, code, index_offset,
+       index_crc) = _HEADER_FIELDS.unpack_from(header, len(COMPRESSED_MAGIC))
+      self.codec = _codec_name(code)
+      _, self._compress, self._decompress = CODECS[self.codec]
+
+      self._chunk_size = self.chunk_sectors * SECTOR_SIZE
+      num_chunks = -(-self.image_size // self._chunk_size)
+      index_data = os.pread(
+          self._fd, num_chunks * _INDEX_ENTRY.size, index_offset)
+      if (len(index_data) != num_chunks * _INDEX_ENTRY.size or
+          zlib.crc32(index_data) != index_crc): raise ValueError(
+              'The chunk index in {} is damaged.'.format(path))
+      self._index = [
+          _INDEX_ENTRY.unpack_from(index_data, i * _INDEX_ENTRY.size)
+          for i in range(num_chunks)]  # type: List[Tuple[int, int]]
+      self._end = os.fstat(self._fd).st_size  # Where to append new data.
+    except BaseException:
+      os.close(self._fd)
+      raise
+
+    # Decompressed chunks, least recently used first, and the chunks among
+    # them with changes not yet saved, mapped to a count of those changes.
+    self._cache = (
+        collections.OrderedDict()
+    )  # type: collections.OrderedDict[int, bytearray]
+    self._dirty = {}  # type: Dict[int, int]
+    self._lock = threading.Lock()  # Guards all of the above.
+    self._flush_lock = threading.Lock()  # Serialises writes to the file.
+
+    self.hits = 0
+    self.misses = 0
+    logging.info('Opened the %d-byte %s-compressed disk image %s.',
+                 self.image_size, self.codec, path)
+
+  def close(self) -> None:
+    """Save changes, tidy away garbage if there's enough, then close."""
+    self.flush()
+    live = sum(length for _, length in self._index)
+    garbage = self._end - _HEADER_SIZE - live - len(self._index) * (
+        _INDEX_ENTRY.size)
+    os.close(self._fd)
+    if garbage > max(live, _COMPACT_MIN_GARBAGE):
+      logging.info('Compacting %s to discard %d bytes of old chunk data.',
+                   self.path, garbage)
+      with open(self.path, 'rb') as f:
+        def read_chunk(start: int, length: int) -> bytes:
+          offset, compressed_length = self._index[start // self._chunk_size]
+          if not compressed_length: return bytes(length)
+          f.seek(offset)
+          return self._decompress(f.read(compressed_length))
+        write_compressed(self.path, self.image_size, read_chunk, self.codec,
+                         self.chunk_sectors)
+
+  def get(self, sector: int) -> memoryview:
+    """Retrieve a sector from the disk image.
+
+    As with sectors in an mmap'd disk image, the data is not copied: it will
+    change if the sector is written.
+
+    Args:
+      sector: Index of the sector to retrieve. Must be within the disk image.
+
+    Returns:
+      532 bytes of sector data.
+    """
+    chunk, offset = divmod(sector * SECTOR_SIZE, self._chunk_size)
+    with self._lock:
+      data = self._chunk(chunk)
+    return memoryview(data)[offset:offset + SECTOR_SIZE]
+
+  def put(self, sector: int, data: Union[bytes, memoryview]) -> None:
+    """Store a sector in the disk image.
+
+    The change isn't saved to the file until `flush` is called.
+
+    Args:
+      sector: Index of the sector written. Must be within the disk image.
+      data: 532 bytes of data written to the sector.
+    """
+    chunk, offset = divmod(sector * SECTOR_SIZE, self._chunk_size)
+    with self._lock:
+      self._chunk(chunk)[offset:offset + SECTOR_SIZE] = data
+      self._dirty[chunk] = self._dirty.get(chunk, 0) + 1
+
+  def chunks(self) -> Iterator[bytes]:
+    """Yield the uncompressed disk image data a chunk at a time, in order.
+
+    Each chunk is a copy, so later writes don't change it. The last chunk may
+    be shorter than the others.
+    """
+    for chunk in range(len(self._index)):
+      with self._lock:
+        data = bytes(self._chunk(chunk))
+      yield data
+
+  def flush(self) -> int:
+    """Compress and save changed chunks, then point the header at them.
+
+    Returns:
+      The number of chunks saved.
+    """
+    with self._flush_lock:
+      # Copy the changed chunks, then compress them without holding the lock,
+      # so the emulator isn't kept waiting.
+      with self._lock:
+        changes = dict(self._dirty)
+        chunks = {chunk: bytes(self._cache[chunk]) for chunk in changes}
+      if not chunks: return 0
+
+      new_entries = {}  # type: Dict[int, Tuple[int, int]]
+      for chunk in sorted(chunks):
+        data = chunks[chunk]
+        if data.count(0) == len(data):
+          new_entries[chunk] = (0, 0)
+        else:
+          compressed = self._compress(data)
+          os.pwrite(self._fd, compressed, self._end)
+          new_entries[chunk] = (self._end, len(compressed))
+          self._end += len(compressed)
+
+      # Append the new chunk index, and once it and the chunks are on the
+      # card, update the header to refer to it.
+      with self._lock:
+        self._index = [new_entries.get(chunk, entry)
+                       for chunk, entry in enumerate(self._index)]
+        index_data = b''.join(_INDEX_ENTRY.pack(*e) for e in self._index)
+        # Chunks changed again while we were busy still need saving.
+        for chunk, count in changes.items():
+          if self._dirty.get(chunk) == count: del self._dirty[chunk]
+      index_offset = self._end
+      os.pwrite(self._fd, index_data, index_offset)
+      self._end += len(index_data)
+      os.fdatasync(self._fd)
+      os.pwrite(self._fd, _HEADER_FIELDS.pack(
+          self.image_size, self.chunk_sectors, CODECS[self.codec][0],
+          index_offset, zlib.crc32(index_data)), len(COMPRESSED_MAGIC))
+      os.fdatasync(self._fd)
+      return len(chunks)
+
+  def _chunk(self, chunk: int) -> bytearray:
+    """Fetch a decompressed chunk, decompressing it if needed.
+
+    Must be called with `self._lock` held.
+    """
+    data = self._cache.get(chunk)
+    if data is not None:
+      self.hits += 1
+      self._cache.move_to_end(chunk)
+      return data
+
+    self.misses += 1
+    length = min(self._chunk_size, self.image_size - chunk * self._chunk_size)
+    offset, compressed_length = self._index[chunk]
+    if compressed_length:
+      data = bytearray(self._decompress(
+          os.pread(self._fd, compressed_length, offset)))
+    else:
+      data = bytearray(length)
+    self._cache[chunk] = data
+
+    # Forget the least recently used chunks that have no unsaved changes.
+    excess = len(self._cache) - self._cache_chunks
+    if excess > 0:
+      for old in [c for c in self._cache if c not in self._dirty][:excess]:
+        del self._cache[old]
+    return data
+
+
+############################
+#### Conversion program ####
+############################
+
+
+def _define_flags() -> argparse.ArgumentParser:
+  """Defines an `ArgumentParser` for command-line flags used by this program."""
+
+  flags = argparse.ArgumentParser(
+      description='Convert ProFile disk image files to or from the compressed '
+                  'disk image format.')
+  flags.add_argument(
+      '-d', '--decompress', action='store_true', help=(
+          'Convert a compressed disk image file into an ordinary one. By '
+          'default, ordinary disk image files are compressed.'))
+  flags.add_argument(
+      '--codec', choices=sorted(CODECS), default='zlib', help=(
+          'Compression method. lzma makes smaller files, but reading them is '
+          'slower.'))
+  flags.add_argument(
+      '--chunk_sectors', type=int, default=DEFAULT_CHUNK_SECTORS, help=(
+          'How many sectors to compress together. Larger chunks compress '
+          'better, but take longer to read.'))
+  flags.add_argument(
+      'source', type=str, help='Disk image file to convert.')
+  flags.add_argument(
+      'destination', type=str, help=(
+          'Where to write the converted disk image file. There must not be a '
+          'file there already.'))
+
+  return flags
+
+
+def main(FLAGS: argparse.Namespace):
+  if os.path.exists(FLAGS.destination): raise FileExistsError(
+      'Not overwriting the existing file {}.'.format(FLAGS.destination))
+
+  if FLAGS.decompress:
+    image = CompressedImage(FLAGS.source)
+    try:
+      with open(FLAGS.destination, 'xb') as f:
+        for data in image.chunks(): f.write(data)
+    finally:
+      image.close()
+
+  else:
+    if is_compressed(FLAGS.source): raise ValueError(
+        '{} is already compressed.'.format(FLAGS.source))
+    with open(FLAGS.source, 'rb') as f:
+      def read_chunk(start: int, length: int) -> bytes:
+        f.seek(start)
+        return f.read(length)
+      write_compressed(FLAGS.destination, os.fstat(f.fileno()).st_size,
+                       read_chunk, FLAGS.codec, FLAGS.chunk_sectors)
+
+  print('{}: {} bytes; {}: {} bytes'.format(
+      FLAGS.source, os.stat(FLAGS.source).st_size,
+      FLAGS.destination, os.stat(FLAGS.destination).st_size))
+
+
+if __name__ == '__main__':
+  flags = _define_flags()
+  FLAGS = flags.parse_args()
+  main(FLAGS)
@@ -0,0 +1,244 @@
+"""DiskCopy 4.2 disk image files for the ProFile emulator.
+
+Forfeited into the public domain with NO WARRANTY. Read LICENSE for details.
+
+Lisa software is widely distributed as Apple DiskCopy 4.2 ("dc42") disk image
+files, like the `selector.3.5inch.dc42` served by the Selector rescue plugin.
+The emulator in `profile.py` can serve a dc42 file directly as if it were an
+ordinary disk image file, as long as its filename ends in `.dc42`.
+
+A dc42 file has an 84-byte header (a disk name, the sizes of the data and tag
+regions, checksums of both regions, and some format information), then the
+512-byte data parts of all of the disk's sectors, then the tag parts of all of
+the disk's sectors. A ProFile block is 20 tag bytes followed by 512 data bytes,
+so the emulator gathers each block from the two regions of the file. Lisa
+floppy disk images have only 12 tag bytes per sector; these blocks have $00
+bytes in place of the missing tag bytes, and the Apple's writes to those
+bytes are discarded.
+
+The header's checksums cover every byte of the data region, and all but the
+first 12 bytes of the tag region. Each checksum folds 16-bit big-endian words
+into a 32-bit sum that is rotated one bit rightward after each word, so
+changing any sector changes how all the following words contribute to it, and
+there is no way to patch a checksum for a change in the middle. Instead, a
+`Dc42Image` remembers the state of each checksum at the start of every sector,
+so that it can refold the checksums from the first changed sector onward.
+
+Refolding is slow work for Python, so it happens a bounded number of sectors at
+a time, usually on the `ImageFlusher` thread: each flush advances the checksums
+by at most `_FOLD_SECTORS` sectors, and the checksums in the file's header are
+only rewritten once they have caught up with every change. Closing the file
+finishes the job, so the header's checksums are only guaranteed to be correct
+after the emulator closes the file. Checksums are not checked when a dc42 file
+is opened, and an unchanged file's header is left alone. Sectors that are
+entirely $00 bytes (common on freshly-formatted disks) only rotate a checksum,
+so they are folded all at once.
+"""
+
+import array
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+
+from typing import Optional, Union
+
+
+SECTOR_SIZE = 532  # Sector size in bytes. Cf. "block size" in spare tables.
+
+DC42_SUFFIX = '.dc42'  # Filenames of dc42 files must end with this.
+
+_DATA_SIZE = 512  # Data bytes per sector.
+_TAG_SIZE = SECTOR_SIZE - _DATA_SIZE  # Tag bytes per ProFile block.
+_TAG_CHECKSUM_SKIP = 12  # The tag checksum ignores this many leading bytes.
+_FOLD_SECTORS = 256  # A flush refolds checksums for at most this many sectors.
+
+# Header fields after the disk name: data region size, tag region size, data
+# checksum, tag checksum, disk format, format byte, "private" word ($0100).
+_HEADER = struct.Struct('>LLLLBBH')
+_HEADER_OFFSET = 64
+_CHECKSUMS_OFFSET = 72
+_DATA_OFFSET = 84
+
+
+def is_dc42(path: str) -> bool:
+  """Is the file at `path` a dc42 file? (Only its filename is checked.)"""
+  return path.lower().endswith(DC42_SUFFIX)
+
+
+def _fold(data: Union[bytes, memoryview], checksum: int) -> int:
+  """Fold `data` (of even length) into a dc42 checksum."""
+  data = bytes(data)
+  if data.count(0) == len(data):  # $0000 words just rotate the checksum.
+    turns = len(data) // 2 % 32
+    return ((checksum >> turns) | (checksum << (32 - turns))) & 0xffffffff
+  words = array.array('H')
+  words.frombytes(data)
+  if sys.byteorder == 'little': words.byteswap()
+  for word in words:  # Add, then rotate right by one bit (see above).
+    checksum = (checksum + word & 0xffffffff) * 0x100000001 >> 1 & 0xffffffff
+  return checksum
+
+
+class Dc42Image:
+  """An open, memory-mapped dc42 disk image file.
+
+  See the file header comment for an overview. `get` and `put` are meant to be
+  called from the emulator's main thread; `flush` may be called from another
+  thread (e.g. the `ImageFlusher` thread), which will do the checksum work.
+
+  Attributes:
+    image_size: Size in bytes of the disk image as the emulator serves it,
+        i.e. 532 bytes for each sector in the dc42 file.
+    tag_bytes: How many tag bytes each sector has in the dc42 file.
+  """
+
+  def __init__(self, path: str) -> None:
+    """Open and map a dc42 file.
+
+    The checksums in the file aren't checked: see the file header comment.
+
+    Args:
+      path: Path to the dc42 file.
+
+    Raises:
+      ValueError: The file at `path` isn't a dc42 file, or it's damaged.
+    """
+    self._file = open(path, 'rb+')
+    try:
+      file_size = os.fstat(self._file.fileno()).st_size
+      if file_size < _DATA_OFFSET: raise ValueError(
+          '{} is too small to be a dc42 file.'.format(path))
+      self._mapped = mmap.mmap(self._file.fileno(), file_size)
+      (data_size, tag_size, _, _, _, _, private) = _HEADER.unpack_from(
+          self._mapped, _HEADER_OFFSET)
+
+      sectors = data_size // _DATA_SIZE
+      self.tag_bytes = tag_size // sectors if sectors else 0
+      if (private != 0x0100 or data_size % _DATA_SIZE or
+          tag_size != sectors * self.tag_bytes or self.tag_bytes > _TAG_SIZE or
+          self.tag_bytes % 2 or
+          _DATA_OFFSET + data_size + tag_size > file_size): raise ValueError(
+              '{} is not a valid dc42 file.'.format(path))
+      self.image_size = sectors * SECTOR_SIZE
+      self._tags_offset = _DATA_OFFSET + data_size
+
+      # Each checksum's state at the start of every sector (and at the end).
+      self._data_states = array.array('L', [0]) * (sectors + 1)
+      self._tag_states = array.array('L', [0]) * (sectors + 1)
+      self._lock = threading.Lock()
+      self._folded = 0  # States are current for sectors before this one.
+      self._dirty_from = None  # type: Optional[int]  # First changed sector.
+      self._changed = False  # Has the disk image changed since it was opened?
+    except BaseException:
+      self._file.close()
+      raise
+    logging.info('Opened the dc42 file %s: %d sectors with %d tag bytes each.',
+                 path, sectors, self.tag_bytes)
+
+  def close(self) -> None:
+    """Finish updating the checksums, save changes, and close the dc42 file."""
+    self._save(None)
+    self._mapped.close()
+    self._file.close()
+
+  def get(self, sector: int) -> bytes:
+    """Retrieve a sector from the dc42 file.
+
+    Args:
+      sector: Index of the sector to retrieve. Must be within the disk image.
+
+    Returns:
+      532 bytes of sector data: tag bytes, then data bytes.
+    """
+    mapped = self._mapped
+    tags = self._tags_offset + sector * self.tag_bytes
+    data = _DATA_OFFSET + sector * _DATA_SIZE
+    return b''.join((mapped[tags:tags + self.tag_bytes],
+                     bytes(_TAG_SIZE - self.tag_bytes),
+                     mapped[data:data + _DATA_SIZE]))
+
+  def put(self, sector: int, data: Union[bytes, memoryview]) -> None:
+    """Store a sector in the dc42 file.
+
+    The change isn't saved to the file, nor are the checksums updated, until
+    `flush` or `close` is called.
+
+    Args:
+      sector: Index of the sector written. Must be within the disk image.
+      data: 532 bytes of sector data: tag bytes, then data bytes. Tag bytes
+          that the dc42 file has no room for are discarded.
+    """
+    tags = self._tags_offset + sector * self.tag_bytes
+    start = _DATA_OFFSET + sector * _DATA_SIZE
+    with self._lock:
+      self._mapped[tags:tags + self.tag_bytes] = data[:self.tag_bytes]
+      self._mapped[start:start + _DATA_SIZE] = data[_TAG_SIZE:]
+      if self._dirty_from is None or sector < self._dirty_from:
+        self._dirty_from = sector
+      self._changed = True
+
+  def flush(self) -> None:
+    """Save all changes to the dc42 file, and refold some of the checksums.
+
+    The header's checksums are rewritten only when they have caught up with
+    every change to the disk image; see the file header comment.
+    """
+    self._save(_FOLD_SECTORS)
+
+  def _save(self, limit: Optional[int]) -> None:
+    """Refold checksums, update them if they're current, and flush the file.
+
+    Args:
+      limit: Refold checksums for at most this many sectors, or for as many
+          as it takes to catch up with every change if None.
+    """
+    if self._changed and self._update_checksums(limit):
+      struct.pack_into('>LL', self._mapped, _CHECKSUMS_OFFSET,
+                       self._data_states[-1], self._tag_states[-1])
+    self._mapped.flush()
+
+  def _update_checksums(self, limit: Optional[int]) -> bool:
+    """Refold checksum states, starting from the first out-of-date sector.
+
+    Args:
+      limit: Refold checksums for at most this many sectors, or for all
+          sectors that need it if None.
+
+    Returns:
+      True iff the checksum states are current for all sectors.
+    """
+    sectors = len(self._data_states) - 1
+    with self._lock:
+      if self._dirty_from is not None:
+        self._folded = min(self._folded, self._dirty_from)
+        self._dirty_from = None
+      first = self._folded
+    last = sectors if limit is None else min(sectors, first + limit)
+
+    mapped = memoryview(self._mapped)
+    try:
+      data_state = self._data_states[first]
+      tag_state = self._tag_states[first]
+      for sector in range(first, last):
+        start = _DATA_OFFSET + sector * _DATA_SIZE
+        data_state = _fold(mapped[start:start + _DATA_SIZE], data_state)
+        self._data_states[sector + 1] = data_state
+        # The tag checksum skips the first few bytes of the tag region.
+        start = max(sector * self.tag_bytes, _TAG_CHECKSUM_SKIP)
+        end = (sector + 1) * self.tag_bytes
+        if start < end: tag_state = _fold(
+            mapped[self._tags_offset + start:self._tags_offset + end],
+            tag_state)
+        self._tag_states[sector + 1] = tag_state
+    finally:
+      mapped.release()
+
+    # Sectors changed while we were folding will need refolding next time.
+    with self._lock:
+      self._folded = last
+      if self._dirty_from is not None:
+        self._folded = min(self._folded, self._dirty_from)
+      return self._folded == sectors
@@ -0,0 +1,264 @@
+"""Write-ahead journal for sector writes to a ProFile emulator disk image.
+
+Forfeited into the public domain with NO WARRANTY. Read LICENSE for details.
+
+Ordinarily the ProFile emulator in `profile.py` stores each sector the Apple
+writes directly into its memory-mapped disk image, and the `ImageFlusher`
+saves changed pages of the map to the disk image file every few seconds. The
+Apple's writes are scattered all over the disk image, so every flush rewrites
+scattered pages of the microSD card, which is both slow and hard on the card.
+
+In journal mode, the emulator instead appends each sector the Apple writes to
+a journal file alongside the disk image, and it keeps the latest data for
+each of those sectors in memory, where reads of those sectors find it. Making
+sure that the journal is on the card is a cheap, sequential write. From time
+to time---ideally when the Apple has stopped writing for a while---the
+emulator "checkpoints" the journal: it copies all the sectors in memory into
+the disk image in sector order, saves the disk image, and empties the journal.
+If the Apple writes more sectors during a checkpoint, the journal is replaced
+by a new journal holding just the records for those writes.
+
+Each journal record is a 16-byte header followed by 532 bytes of sector data.
+The header holds a magic number, a sequence number that counts up by one for
+each record (even across checkpoints), the sector index, and a CRC-32 of the
+rest of the record. If the emulator stops before checkpointing a journal, the
+next `Journal` opened for the disk image replays the journal's records into
+the disk image, in order, up to the first record that is torn or corrupt.
+
+The journal for a disk image file called `foo.image` is `foo.image.journal`.
+While it isn't empty, the disk image file on its own is out of date, so the
+journal should go wherever the disk image goes.
+"""
+
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from typing import Dict, List, Optional, Tuple, Union
+
+
+SECTOR_SIZE = 532  # Sector size in bytes. Cf. "block size" in spare tables.
+
+JOURNAL_SUFFIX = '.journal'  # Journal filename: disk image filename + this.
+
+# Journal records: magic number, sequence number, sector index, CRC-32 of the
+# rest of the record (i.e. everything that follows), then sector data.
+_RECORD_MAGIC = b'APJ1'
+_RECORD_HEADER = struct.Struct('<4sLLL')
+_RECORD_SIZE = _RECORD_HEADER.size + SECTOR_SIZE
+_RECORD_SEQUENCE_AND_SECTOR = struct.Struct('<LL')
+
+
+def journal_path(image_path: str) -> str:
+  """The path to the journal file for the disk image file at `image_path`."""
+  return image_path + JOURNAL_SUFFIX
+
+
+def _record(sequence: int, sector: int, data: bytes) -> bytes:
+  """Assemble a journal record."""
+  sequence_and_sector = _RECORD_SEQUENCE_AND_SECTOR.pack(sequence, sector)
+  crc = zlib.crc32(data, zlib.crc32(sequence_and_sector))
+  return _RECORD_HEADER.pack(_RECORD_MAGIC, sequence, sector, crc) + data
+
+
+def _read_records(contents: bytes) -> Tuple[List[Tuple[int, int, bytes]], int]:
+  """Parse valid records from the beginning of a journal.
+
+  Args:
+    contents: Entire contents of a journal file.
+
+  Returns:
+    A tuple of a list of (sequence, sector, data) tuples for each valid record
+    in order, and the number of bytes that those records span. Parsing stops
+    at the first record that is incomplete, fails its CRC check, or is out of
+    sequence.
+  """
+  records = []  # type: List[Tuple[int, int, bytes]]
+  offset = 0
+  while offset + _RECORD_SIZE <= len(contents):
+    magic, sequence, sector, crc = _RECORD_HEADER.unpack_from(contents, offset)
+    data = contents[offset + _RECORD_HEADER.size:offset + _RECORD_SIZE]
+    if magic != _RECORD_MAGIC: break
+    if records and sequence != (records[-1][0] + 1) & 0xffffffff: break
+    if crc != zlib.crc32(data, zlib.crc32(
+        _RECORD_SEQUENCE_AND_SECTOR.pack(sequence, sector))): break
+    records.append((sequence, sector, data))
+    offset += _RECORD_SIZE
+  return records, offset
+
+
+class Journal:
+  """A write-ahead journal for sector writes to a memory-mapped disk image.
+
+  See the file header comment for an overview. `append` and `get` are meant to
+  be called from the emulator's main thread; `sync` and `checkpoint` may be
+  called from another thread (e.g. the `ImageFlusher` thread).
+  """
+
+  def __init__(self, path: str, mapped: mmap.mmap, image_size: int) -> None:
+    """Initialise a Journal, replaying any existing journal first.
+
+    If there is a journal file at `path` already, its valid records are
+    replayed into `mapped`, which is then flushed to disk; only after that is
+    the journal file emptied.
+
+    Args:
+      path: Path to the journal file. It will be created if necessary.
+      mapped: A writeable mmap of the disk image file.
+      image_size: Size of the disk image in bytes.
+    """
+    self._path = path
+    self._mapped = mapped
+    self._image_size = image_size
+    self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o664)
+    self._lock = threading.Lock()  # Guards everything below.
+    self._sectors = {}  # type: Dict[int, bytes]  # Not yet in the disk image.
+    self._sequence = 0  # Sequence number of the next record.
+    self._records = 0   # Number of records in the journal file.
+
+    # Replay the existing journal, if any.
+    with open(path, 'rb') as f:
+      contents = f.read()
+    if contents:
+      records, valid = _read_records(contents)
+      logging.info('Replaying %d journal records from %s.', len(records), path)
+      if valid != len(contents): logging.warning(
+          'Ignoring %d bytes of incomplete or corrupt records at the end of '
+          'journal %s.', len(contents) - valid, path)
+      for _, sector, data in records:
+        self._copy_to_image(sector, data)
+      mapped.flush()
+      if records: self._sequence = (records[-1][0] + 1) & 0xffffffff
+    os.ftruncate(self._fd, 0)
+    os.fsync(self._fd)
+
+  def close(self) -> None:
+    """Checkpoint the journal and close the journal file."""
+    self.checkpoint()
+    os.close(self._fd)
+
+  @property
+  def records(self) -> int:
+    """How many records are in the journal file."""
+    return self._records
+
+  def append(self, sector: int, data: Union[bytes, memoryview]) -> None:
+    """Append a sector write to the journal.
+
+    The journal isn't synced to disk until `sync` is called.
+
+    Args:
+      sector: Index of the sector written. Must be within the disk image.
+      data: 532 bytes of data written to the sector.
+    """
+    data = bytes(data)
+    with self._lock:
+      os.write(self._fd, _record(self._sequence, sector, data))
+      self._sequence = (self._sequence + 1) & 0xffffffff
+      self._records += 1
+      self._sectors[sector] = data
+
+  def get(self, sector: int) -> Optional[bytes]:
+    """Retrieve data for a sector from the journal.
+
+    Args:
+      sector: Index of the sector to retrieve.
+
+    Returns:
+      The last data written to `sector` if it hasn't made it into the disk
+      image yet, otherwise None.
+    """
+    return self._sectors.get(sector)
+
+  def sync(self) -> None:
+    """Ensure that all records appended so far are on the disk."""
+    # A checkpoint may replace the journal file meanwhile (see `_rotate`), but
+    # the new file is synced when it's made, with all of the records it has.
+    with self._lock:
+      fd = os.dup(self._fd)
+    try:
+      os.fdatasync(fd)
+    finally:
+      os.close(fd)
+
+  def checkpoint(self) -> int:
+    """Copy sectors in the journal into the disk image, then empty the journal.
+
+    Sectors are copied in sector order, and the disk image is flushed (from
+    the first changed page to the last) before the journal is emptied. If
+    sectors are appended to the journal during the checkpoint, their records
+    are the only saved copy of those sectors, so instead of emptying the
+    journal, the checkpoint replaces it with a new journal file holding just
+    those records (see `_rotate`).
+
+    Returns:
+      The number of sectors copied into the disk image.
+    """
+    with self._lock:
+      sectors = dict(self._sectors)
+      records = self._records
+    if not records: return 0
+
+    # Copy to the disk image in sector order, then flush the changed span.
+    ordered = sorted(sectors)
+    for sector in ordered:
+      self._copy_to_image(sector, sectors[sector])
+    if ordered:
+      start = ordered[0] * SECTOR_SIZE // mmap.PAGESIZE * mmap.PAGESIZE
+      end = min(self._image_size, (ordered[-1] + 1) * SECTOR_SIZE)
+      self._mapped.flush(start, end - start)
+
+    # Forget the sectors copied, unless they were written again meanwhile, and
+    # empty the journal of their records.
+    with self._lock:
+      for sector, data in sectors.items():
+        if self._sectors.get(sector) is data: del self._sectors[sector]
+      if self._records == records:
+        os.ftruncate(self._fd, 0)
+        os.fsync(self._fd)
+      else:
+        self._rotate(records)
+      self._records -= records
+    logging.info('Checkpointed %d sectors from the journal.', len(sectors))
+    return len(sectors)
+
+  def _rotate(self, checkpointed: int) -> None:
+    """Replace the journal file with one lacking its first records.
+
+    The new journal file is written and synced alongside the old one, then
+    renamed over it, so the journal on the disk always holds every record
+    not yet checkpointed. Must be called with `self._lock` held.
+
+    Args:
+      checkpointed: How many records at the start of the journal file to
+          leave out of the new one.
+    """
+    start = checkpointed * _RECORD_SIZE
+    remaining = os.pread(
+        self._fd, (self._records - checkpointed) * _RECORD_SIZE, start)
+    new_path = self._path + '.new'
+    new_fd = os.open(new_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC |
+                     os.O_APPEND, 0o664)
+    try:
+      os.write(new_fd, remaining)
+      os.fsync(new_fd)
+      os.rename(new_path, self._path)
+    except BaseException:
+      os.close(new_fd)
+      raise
+    directory = os.open(os.path.dirname(self._path) or '.', os.O_RDONLY)
+    try:
+      os.fsync(directory)
+    finally:
+      os.close(directory)
+    os.close(self._fd)
+    self._fd = new_fd
+
+  def _copy_to_image(self, sector: int, data: bytes) -> None:
+    """Copy sector data into the disk image, ignoring out-of-bounds sectors."""
+    start = sector * SECTOR_SIZE
+    if start + SECTOR_SIZE <= self._image_size:
+      self._mapped[start:start + SECTOR_SIZE] = data
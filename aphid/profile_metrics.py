@@ -0,0 +1,219 @@
+"""Metrics for the ProFile emulator, served over a Unix domain socket.
+
+Forfeited into the public domain with NO WARRANTY. Read LICENSE for details.
+
+With the --metrics_socket flag, the emulator in `profile.py` keeps counters
+and latency histograms in a `Registry`: commands served for each ProFile
+operation and how long each took, calls to each "magic block" plugin and how
+long those took, RPMsg retries and short reads, and flushes of the disk image
+and how long those took. A `MetricsServer` thread answers each connection to
+the socket with all of the metrics in the Prometheus text exposition format,
+so scraping never involves the emulator's main thread. Clients that send an
+HTTP request (e.g. `curl --unix-socket`) get an HTTP response; others (e.g.
+`socat - UNIX-CONNECT:...`) get just the text.
+
+Histograms use the same power-of-two buckets of microseconds as the emulator's
+own duration histograms (`profile.Histogram`), up to about 16 seconds.
+
+Updating a metric is a few attribute operations in the updating thread, with
+no locking: a scrape may see a histogram that's one observation ahead of its
+count, which Prometheus tolerates.
+"""
+
+import logging
+import os
+import select
+import socket
+import threading
+
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+
+_BUCKETS = 25  # Histogram buckets: < 1 us, < 2 us, ... < 2**24 us (~16 s).
+_HTTP_WAIT = 0.1  # Seconds to wait for a client to send an HTTP request.
+
+
+class Counter:
+  """A count that only goes up."""
+
+  __slots__ = ('value',)
+
+  def __init__(self) -> None:
+    self.value = 0
+
+  def inc(self, amount: int = 1) -> None:
+    """Add `amount` to the count."""
+    self.value += amount
+
+
+class Histogram:
+  """A histogram of durations, with power-of-two buckets of microseconds."""
+
+  __slots__ = ('counts', 'sum')
+
+  def __init__(self) -> None:
+    self.counts = [0] * _BUCKETS  # Not cumulative, unlike Prometheus buckets.
+    self.sum = 0.0
+
+  def observe(self, seconds: float) -> None:
+    """Count a duration of `seconds` seconds."""
+    self.counts[min(_BUCKETS - 1, int(seconds * 1e6).bit_length())] += 1
+    self.sum += seconds
+
+
+Metric = Union[Counter, Histogram]
+# A family of metrics: type, help text, and metrics by their label values.
+_Family = Tuple[str, str, Dict[Tuple[Tuple[str, str], ...], Metric]]
+
+
+class Registry:
+  """All of the emulator's metrics, by name and labels.
+
+  Code that updates a metric often should obtain it once from `counter` or
+  `histogram` and keep it, rather than looking it up every time.
+  """
+
+  def __init__(self) -> None:
+    self._lock = threading.Lock()  # Guards _families.
+    self._families = {}  # type: Dict[str, _Family]  # Families by name.
+
+  def counter(self, name: str, help_text: str, **labels: str) -> Counter:
+    """Retrieve (or create) a counter.
+
+    Args:
+      name: Name of the metric family, e.g. 'aphid_flushes_total'.
+      help_text: Description of the metric family.
+      **labels: Label values that distinguish this counter from others in the
+          same family.
+
+    Returns:
+      The counter.
+    """
+    return self._metric(Counter, 'counter', name, help_text, labels)
+
+  def histogram(self, name: str, help_text: str, **labels: str) -> Histogram:
+    """Retrieve (or create) a histogram of durations in seconds.
+
+    Args: as for `counter`.
+
+    Returns:
+      The histogram.
+    """
+    return self._metric(Histogram, 'histogram', name, help_text, labels)
+
+  def _metric(self, cls, kind: str, name: str, help_text: str,
+              labels: Dict[str, str]) -> Any:
+    """Implementation of `counter` and `histogram`."""
+    key = tuple(sorted(labels.items()))
+    with self._lock:
+      family_kind, _, metrics = self._families.setdefault(
+          name, (kind, help_text, {}))
+      if family_kind != kind: raise ValueError(
+          'Metric {} is a {}, not a {}.'.format(name, family_kind, kind))
+      metric = metrics.get(key)
+      if metric is None: metric = metrics[key] = cls()
+    return metric
+
+  def exposition(self) -> str:
+    """All metrics in the Prometheus text exposition format."""
+    with self._lock:
+      families = [(name, kind, help_text, list(metrics.items()))
+                  for name, (kind, help_text, metrics)
+                  in sorted(self._families.items())]
+
+    lines = []  # type: List[str]
+    for name, kind, help_text, metrics in families:
+      lines.append('# HELP {} {}'.format(name, help_text))
+      lines.append('# TYPE {} {}'.format(name, kind))
+      for key, metric in sorted(metrics, key=lambda item: item[0]):
+        labels = ','.join('{}="{}"'.format(k, v) for k, v in key)
+        if isinstance(metric, Counter):
+          lines.append('{}{} {}'.format(
+              name, '{' + labels + '}' if labels else '', metric.value))
+          continue
+        counts = list(metric.counts)
+        le_prefix = labels + ',' if labels else ''
+        cumulative = 0
+        for bucket, count in enumerate(counts[:-1]):
+          cumulative += count
+          lines.append('{}_bucket{{{}le="{:g}"}} {}'.format(
+              name, le_prefix, (1 << bucket) / 1e6, cumulative))
+        cumulative += counts[-1]
+        lines.append('{}_bucket{{{}le="+Inf"}} {}'.format(
+            name, le_prefix, cumulative))
+        suffix = '{' + labels + '}' if labels else ''
+        lines.append('{}_sum{} {!r}'.format(name, suffix, metric.sum))
+        lines.append('{}_count{} {}'.format(name, suffix, cumulative))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+  """Serves a `Registry`'s metrics on a Unix domain socket.
+
+  This context manager runs a thread that answers each connection to the
+  socket with the registry's `exposition`, then hangs up.
+  """
+
+  def __init__(self, registry: Registry, path: str) -> None:
+    """Initialise a MetricsServer.
+
+    Args:
+      registry: Metrics to serve.
+      path: Path to the Unix domain socket. Any file already there is replaced.
+    """
+    self._registry = registry
+    self._path = path
+    self._socket = None  # type: Optional[socket.socket]
+    self._thread = None  # type: Optional[threading.Thread]
+    self._wake_read, self._wake_write = -1, -1
+
+  def _serve(self, connection: socket.socket) -> None:
+    """Answer one connection."""
+    with connection:
+      body = self._registry.exposition().encode()
+      # Answer HTTP requests in kind; other clients just get the metrics.
+      connection.settimeout(_HTTP_WAIT)
+      try:
+        request = connection.recv(4096)
+      except socket.timeout:
+        request = b''
+      if request.split(b' ', 1)[0] in (b'GET', b'HEAD'):
+        header = ('HTTP/1.0 200 OK\r\n'
+                  'Content-Type: text/plain; version=0.0.4\r\n'
+                  'Content-Length: {}\r\n\r\n'.format(len(body))).encode()
+        body = header + (body if request.startswith(b'GET') else b'')
+      connection.settimeout(None)
+      connection.sendall(body)
+
+  def __enter__(self) -> 'MetricsServer':
+    """Context manager entry. Open the socket and start serving."""
+    if os.path.exists(self._path): os.unlink(self._path)
+    self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self._socket.bind(self._path)
+    self._socket.listen()
+    self._wake_read, self._wake_write = os.pipe()
+
+    def thread():
+      while True:
+        ready, _, _ = select.select([self._socket, self._wake_read], [], [])
+        if self._wake_read in ready: break  # Time to quit.
+        connection, _ = self._socket.accept()
+        try:
+          self._serve(connection)
+        except OSError as e:
+          logging.warning('Metrics: failed to serve a client: %s', e)
+
+    self._thread = threading.Thread(target=thread, name='metrics')
+    self._thread.start()
+    logging.info('Metrics: serving on %s', self._path)
+    return self
+
+  def __exit__(self, ex_type, ex_value, traceback):
+    """Context manager exit. Stop serving and remove the socket."""
+    del ex_type, ex_value, traceback  # Unused
+    os.write(self._wake_write, b'.')
+    self._thread.join()
+    self._socket.close()
+    os.close(self._wake_read)
+    os.close(self._wake_write)
+    os.unlink(self._path)
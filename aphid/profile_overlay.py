@@ -0,0 +1,179 @@
+"""Copy-on-write overlay disk images for the ProFile emulator.
+
+Forfeited into the public domain with NO WARRANTY. Read LICENSE for details.
+
+An overlay disk image file lets many users share one pristine "base" disk
+image without copying it. The overlay file holds only those sectors that have
+been written since the overlay was made; all other sectors come from the base
+disk image, which the emulator maps read-only and never changes. Making an
+overlay takes the same (tiny) amount of time no matter how large the base is.
+
+The emulator in `profile.py` recognises an overlay file by the magic number at
+its beginning, so overlay files can have the same `.image` suffix as ordinary
+disk image files, and the Apple can select them in the usual way.
+
+An overlay file starts with a 1,024-byte header: the magic number
+`b'Cameo/Aphid overlay 0001\\0'`, then the filename of the base disk image
+(encoded in UTF-8 and null-terminated), then $00 padding. The base disk image
+must be in the same directory as the overlay, and it must be an ordinary disk
+image file, not another overlay, a compressed disk image (see
+`profile_compressed.py`), or a DiskCopy 4.2 file. (Deleting, changing, or
+renaming the base disk image will break any overlays made from it!) The rest of
+the overlay file is a sequence of 536-byte records: a 32-bit little-endian
+sector index and the 532 bytes of data most recently written to that sector.
+Each sector has at most one record, which is overwritten in place when the
+sector is written again.
+"""
+
+import logging
+import os
+
+import profile_compressed
+import profile_dc42
+
+from typing import Dict, Optional, Union
+
+
+SECTOR_SIZE = 532  # Sector size in bytes. Cf. "block size" in spare tables.
+
+OVERLAY_MAGIC = b'Cameo/Aphid overlay 0001\x00'
+_HEADER_SIZE = 1024
+_RECORD_SIZE = 4 + SECTOR_SIZE
+
+
+def is_overlay(path: str) -> bool:
+  """Is the file at `path` an overlay disk image file?"""
+  with open(path, 'rb') as f:
+    return f.read(len(OVERLAY_MAGIC)) == OVERLAY_MAGIC
+
+
+def create_overlay(path: str, base_path: str) -> None:
+  """Create a new, empty overlay disk image file.
+
+  Args:
+    path: Path to the new overlay file. There must not be a file there
+        already.
+    base_path: Path to the base disk image file. Must be in the same directory
+        as `path`, and must be an ordinary disk image file.
+
+  Raises:
+    FileExistsError: There's already a file at `path`.
+    ValueError: The base disk image isn't in the same directory as the
+        overlay, or it's an overlay, compressed, or a dc42 file itself, or its
+        filename is too long.
+  """
+  if (os.path.abspath(os.path.dirname(base_path)) !=
+      os.path.abspath(os.path.dirname(path))): raise ValueError(
+          'The base image {} must be in the same directory as the overlay '
+          '{}.'.format(base_path, path))
+  if is_overlay(base_path): raise ValueError(
+      "Can't make an overlay of {}, which is itself an overlay.".format(
+          base_path))
+  if (profile_compressed.is_compressed(base_path) or
+      profile_dc42.is_dc42(base_path)): raise ValueError(
+          "Can't make an overlay of {}, which is not an ordinary disk image "
+          "file.".format(base_path))
+
+  base_name = os.path.basename(base_path).encode('utf-8') + b'\x00'
+  header = OVERLAY_MAGIC + base_name
+  if len(header) > _HEADER_SIZE: raise ValueError(
+      'The base image filename {} is too long.'.format(base_path))
+  with open(path, 'xb') as f:
+    f.write(header + bytes(_HEADER_SIZE - len(header)))
+
+
+class Overlay:
+  """An open overlay disk image file.
+
+  See the file header comment for an overview. The emulator reads sectors
+  from the base disk image itself, after calling `get` to check whether the
+  overlay has a newer version.
+  """
+
+  def __init__(self, path: str) -> None:
+    """Open an overlay disk image file, indexing its sectors.
+
+    Args:
+      path: Path to the overlay file.
+
+    Raises:
+      ValueError: The file at `path` isn't an overlay, or its base disk image
+          isn't an ordinary disk image file.
+    """
+    self._fd = os.open(path, os.O_RDWR)
+    try:
+      header = os.pread(self._fd, _HEADER_SIZE, 0)
+      if not header.startswith(OVERLAY_MAGIC): raise ValueError(
+          '{} is not an overlay disk image file.'.format(path))
+      base_name = header[len(OVERLAY_MAGIC):].split(b'\x00', 1)[0]
+      self.base_path = os.path.join(
+          os.path.dirname(path), base_name.decode('utf-8'))
+      if is_overlay(self.base_path): raise ValueError(
+          'The base image {} of overlay {} is also an overlay.'.format(
+              self.base_path, path))
+      if (profile_compressed.is_compressed(self.base_path) or
+          profile_dc42.is_dc42(self.base_path)): raise ValueError(
+              'The base image {} of overlay {} is not an ordinary disk image '
+              'file.'.format(self.base_path, path))
+
+      # Index the overlay's records, discarding any incomplete record at the
+      # end (left by an untimely power cut, perhaps).
+      self._offsets = {}  # type: Dict[int, int]  # Sector -> data offset.
+      size = os.fstat(self._fd).st_size
+      self._end = _HEADER_SIZE + (size - _HEADER_SIZE) // _RECORD_SIZE * (
+          _RECORD_SIZE)
+      if self._end != size:
+        logging.warning('Discarding an incomplete record at the end of '
+                        'overlay %s.', path)
+        os.ftruncate(self._fd, self._end)
+      with open(path, 'rb') as f:
+        f.seek(_HEADER_SIZE)
+        for offset in range(_HEADER_SIZE, self._end, _RECORD_SIZE):
+          sector = int.from_bytes(f.read(_RECORD_SIZE)[:4], 'little')
+          self._offsets[sector] = offset + 4
+    except BaseException:
+      os.close(self._fd)
+      raise
+    logging.info('Overlay %s on %s has %d sectors of its own.',
+                 path, self.base_path, len(self._offsets))
+
+  def close(self) -> None:
+    """Sync and close the overlay file."""
+    self.sync()
+    os.close(self._fd)
+
+  def get(self, sector: int) -> Optional[bytes]:
+    """Retrieve a sector from the overlay.
+
+    Args:
+      sector: Index of the sector to retrieve.
+
+    Returns:
+      The last data written to `sector`, or None if it has never been written,
+      meaning that the base disk image has the data.
+    """
+    offset = self._offsets.get(sector)
+    if offset is None: return None
+    return os.pread(self._fd, SECTOR_SIZE, offset)
+
+  def put(self, sector: int, data: Union[bytes, memoryview]) -> None:
+    """Store a sector in the overlay.
+
+    The overlay isn't synced to disk until `sync` is called.
+
+    Args:
+      sector: Index of the sector written. Must be within the disk image.
+      data: 532 bytes of data written to the sector.
+    """
+    offset = self._offsets.get(sector)
+    if offset is not None:
+      os.pwrite(self._fd, data, offset)
+    else:
+      os.pwrite(self._fd, sector.to_bytes(4, 'little') + bytes(data),
+                self._end)
+      self._offsets[sector] = self._end + 4
+      self._end += _RECORD_SIZE
+
+  def sync(self) -> None:
+    """Ensure that all sectors stored so far are on the disk."""
+    os.fdatasync(self._fd)
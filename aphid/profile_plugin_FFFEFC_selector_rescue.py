@@ -81,7 +81,7 @@ import logging
 import os
 import pathlib
 
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Sequence, Tuple
 
 import profile_plugins
 
@@ -133,6 +133,32 @@ class SelectorRescuePlugin(profile_plugins.Plugin):
     else:
       return bytes(SECTOR_SIZE)  # Return zero blocks for 0x3000 and higher
 
+  def prepare(
+      self,
+      block: int,
+      parameters: Sequence[Tuple[int, int]],
+  ) -> List[Optional[bytes]]:
+    """Prepare blocks of Selector disk images the Apple may read next.
+
+    See `profile_plugins.Plugin.prepare`. Only blocks from disk images that
+    have already been loaded are prepared: loading one takes a while, and the
+    Apple may never ask. Restoring the Selector is never prepared, of course.
+    """
+    replies = []  # type: List[Optional[bytes]]
+    for retry_count, sparing_threshold in parameters:
+      command = (retry_count << 8) + sparing_threshold
+      if command == 0xffff:    # Restore the Selector: never prepared.
+        ready = False
+      elif command >= 0x3000:  # Zero blocks: always ready.
+        ready = True
+      else:                    # Disk image data: ready if loaded.
+        ready = (IMAGE_PROFILE if command < 0x1000 else
+                 IMAGE_3_5INCH if command < 0x2000 else
+                 IMAGE_TWIGGY) in self._image_cache
+      replies.append(self(PROFILE_READ, block, retry_count, sparing_threshold,
+                          None) if ready else None)
+    return replies
+
   def _restore_selector(self):
     """Restore `profile.image` as described in the file header comment."""
     import zipfile  # Import here to avoid delaying initial emulator start-up.
@@ -21,6 +21,18 @@ Operations:
         Bytes 39-45: ASCII null-terminated 15-minute load average
         Bytes 46-50: ASCII null-terminated number of processes running
         Bytes 51-55: ASCII null-terminated number of total processes
+        Bytes 56-65: ASCII right-aligned space-padded number of disk images
+                     found already open in the emulator's pool of open disk
+                     images (see `ImagePool` in profile.py) when the Apple
+                     switched to them ("hits")
+        Bytes 66-75: ASCII right-aligned space-padded number of disk images
+                     that had to be opened when the Apple switched to them
+                     ("misses")
+        Bytes 76-80: ASCII null-terminated number of disk images in the pool
+        Bytes 81-95: ASCII right-aligned space-padded total size of the disk
+                     images in the pool, in bytes
+
+     If the emulator has no pool, bytes 56-95 report an empty pool.
 
    - ProFile writes to $FFFEFD: do nothing at all.
 """
@@ -75,6 +87,13 @@ class SystemInfoPlugin(profile_plugins.Plugin):
       l_1min, l_5min, l_15min, l_processes, _ = f.read().split(' ')
     l_running, l_total = l_processes.split('/')
 
+    # The emulator's pool of open disk images.
+    pool = profile_plugins.service('image_pool')
+    pool_stats = pool.stats() if pool is not None else dict(
+        hits=0, misses=0, images=0, bytes=0)
+    pool_text = '{:10d}{:10d}'.format(pool_stats['hits'], pool_stats['misses'])
+    pool_bytes = '{:15d}'.format(pool_stats['bytes'])
+
     # Helper: convert to binary and zero-pad to the right.
     def encode_and_pad(s: str, l: int) -> bytes:
       se = s.encode()[:l-1]
@@ -88,6 +107,9 @@ class SystemInfoPlugin(profile_plugins.Plugin):
         encode_and_pad(l_15min, 7),
         encode_and_pad(l_running, 5),
         encode_and_pad(l_total, 5),
+        pool_text.encode(),
+        encode_and_pad(str(pool_stats['images']), 5),
+        pool_bytes.encode(),
     ])
     return data[:532] + bytes(max(0, 532 - len(data)))
 
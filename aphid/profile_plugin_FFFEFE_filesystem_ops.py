@@ -44,6 +44,11 @@ Operations:
      times or file sizes; the program will need to download a complete listing
      again if it's important to keep that data up-to-date.)
 
+     Since the Apple may soon want to use a file it has just listed, the
+     plugin offers each listed file to the emulator's pool of open disk images
+     (see `ImagePool` in profile.py), which opens it ahead of time in the
+     background if there's room.
+
      If the program specifies an n greater than or equal to the number of
      (suffix-limited) files in the directory, the reply will list an empty
      0-byte file with a length-0 filename.
@@ -62,6 +67,15 @@ Operations:
        a null-terminated destination filename immediately following. There must
        be no existing file at the destination.
 
+     - 'ov': make a copy-on-write "overlay" copy of a disk image file (see
+       profile_overlay.py). Parameters are a null-terminated source filename
+       and a null-terminated destination filename immediately following, as
+       for 'cp'. The copy is made instantly and takes up almost no space until
+       it's written to, but it depends on the source file: deleting, moving,
+       or changing the source will break the copy. The source may not itself
+       be an overlay, a compressed disk image, or a DiskCopy 4.2 file. There
+       must be no existing file at the destination.
+
      - 'mv': move a file. Parameters are a null-terminated source filename and
        a null-terminated destination filename immediately following. There must
        be no existing file at the destination.
@@ -85,7 +99,11 @@ Operations:
 
      The plugin gives no feedback about the success of any of these operations.
      For any that modify the filesystem, one workaround is to perform a read
-     and see whether the nonce has changed.
+     and see whether the nonce has changed. (If the emulator was started with
+     the --plugin_deadline_ms flag, slow operations like copying a large file
+     may finish after the write that ordered them; reading block $FFFFFC with
+     parameters $FEFE reports whether they are still running, and whether
+     any failed.)
 
      The plugin will do some validation to filenames listed as arguments,
      including checking for unprintable characters and '/', checking for the
@@ -110,8 +128,11 @@ import pathlib
 import shutil
 import time
 
-from typing import Callable, Iterable, Optional, Sequence, Tuple
+from typing import Callable, Iterable, List, Optional, Sequence, Tuple
 
+import profile_compressed
+import profile_dc42
+import profile_overlay
 import profile_plugins
 
 
@@ -123,6 +144,7 @@ PROFILE_READ = 0x00   # The ProFile protocol op byte that means "read a block"
 # performed by this plugin, at least not by default.
 PROTECTED_FILES = (
     'profile.image',                   # Cameo/Aphid default disk image
+    'profile.image.journal',           # (Its journal, in journal mode)
     'profile.py',                      # Cameo/Aphid emulator software
     'profile_plugins.py',              # Cameo/Aphid emulator plugin library
     'profile_key_value_store.db',      # Key/value store plugin data storage
@@ -137,6 +159,7 @@ PROTECTED_FILES = (
 
 # Command bytes that the Apple uses to specify a filesystem operation.
 _COMMAND_COPY = int.from_bytes(b'cp', byteorder='big')  # Copy a file
+_COMMAND_OVERLAY = int.from_bytes(b'ov', byteorder='big')  # Copy-on-write cp
 _COMMAND_MOVE = int.from_bytes(b'mv', byteorder='big')  # Rename a file
 _COMMAND_CREATE = int.from_bytes(b'mk', byteorder='big')  # Create a new image
 _COMMAND_CREATE_EX = int.from_bytes(b'mx', byteorder='big')  # New image w/size
@@ -204,6 +227,22 @@ class FilesystemOpsPlugin(profile_plugins.Plugin):
           'Filesystem ops plugin: ignoring operation %02X with no data', op)
       return bytes(532)
 
+  def prepare(
+      self,
+      block: int,
+      parameters: Sequence[Tuple[int, int]],
+  ) -> List[Optional[bytes]]:
+    """Prepare upcoming directory listing entries for the emulator.
+
+    See `profile_plugins.Plugin.prepare`. A file added to or removed from the
+    directory by some other program between this call and the Apple's reads
+    will go unnoticed by those reads, but the Apple's next read after that
+    will show the new nonce.
+    """
+    del block  # Unused.
+    return [self._read(retry_count, sparing_threshold)
+            for retry_count, sparing_threshold in parameters]
+
   def _read(
       self,
       retry_count: int,
@@ -236,6 +275,9 @@ class FilesystemOpsPlugin(profile_plugins.Plugin):
       file_size_text = bytes('{:10d}'.format(stat.st_size), encoding=_CODEC)
       file_human_size_text = _human_readable_size(stat.st_size)
       file_name_text = bytes(entry.name, encoding=_CODEC)
+      # The Apple may want this disk image soon: have it ready if possible.
+      pool = profile_plugins.service('image_pool')
+      if pool is not None: pool.offer(str(entry))
 
     # Assemble and return the file information record.
     data = b''.join([
@@ -275,6 +317,13 @@ class FilesystemOpsPlugin(profile_plugins.Plugin):
         if _have_room(pathlib.Path(args[0]).stat().st_size):
           shutil.copyfile(args[0], args[1])
 
+    elif command == _COMMAND_OVERLAY:          # Copy a file, copy-on-write
+      if _check_filesystem_op_args(
+          args,
+          [suffix_ok, _cwa_file_exists, _cwa_can_overlay],
+          [suffix_ok, _cwa_does_not_exist, _cwa_name_ok, can_touch]):
+        profile_overlay.create_overlay(args[1], args[0])
+
     elif command == _COMMAND_MOVE:             # Rename a file
       if _check_filesystem_op_args(
           args,
@@ -361,6 +410,9 @@ def _check_filesystem_op_args(
 
 _cwa_file_exists = lambda p: p.exists() and p.is_file()  # Is a file that exists
 _cwa_does_not_exist = lambda p: not p.exists()  # Nothing has that filename
+_cwa_can_overlay = lambda p: not (profile_overlay.is_overlay(str(p)) or  # Ok
+    profile_compressed.is_compressed(str(p)) or        # base for COW copies
+    profile_dc42.is_dc42(str(p)))
 _cwa_name_ok = lambda p: (p.name.isprintable() and '/' not in p.name  # Filename
                           and len(p.name.encode('utf-8')) <= 255)     # validity
 
@@ -60,7 +60,7 @@ import collections
 import logging
 import dbm
 
-from typing import Dict, MutableMapping, Optional
+from typing import Dict, List, MutableMapping, Optional, Sequence, Tuple
 
 import profile_plugins
 
@@ -141,6 +141,20 @@ class KeyValueStorePlugin(profile_plugins.FlushingPlugin):
           'Key/value store plugin: ignoring operation %02X with no data', op)
       return _532_NULS
 
+  def prepare(
+      self,
+      block: int,
+      parameters: Sequence[Tuple[int, int]],
+  ) -> List[Optional[bytes]]:
+    """Prepare: look up cache entries the Apple may read next.
+
+    See `profile_plugins.Plugin.prepare`. Only writes change the cache, so the
+    entries stay current until the Apple's next write.
+    """
+    del block  # Unused.
+    return [self._cache.get((retry_count << 8) + sparing_threshold, _532_NULS)
+            for retry_count, sparing_threshold in parameters]
+
   def flush(self) -> None:
     """Flush: save pending permanent key/value store changes to disk."""
     self._db.sync()  # type: ignore
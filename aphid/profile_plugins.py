@@ -31,7 +31,16 @@ addresses, the lower bound may be adjusted downward.
 (As a final note, Cameo/Aphid does implement a few "magic" blocks natively.
 $FFFFFF and $FFFFFE were already magical for the ProFile: they retrieve the
 spare table and the ProFile's memory buffer respectively. Writes to $FFFFFD
-can be used to restart or end ProFile emulation: see README.md for details.)
+can be used to restart or end ProFile emulation: see README.md for details.
+Reads from $FFFFFC report on plugin commands that the emulator finished in
+the background because they took too long: see `PluginWorker` in profile.py.)
+
+Plugins needn't be thread-safe: the emulator never calls a plugin's
+`__call__` or `prepare` methods while another call to either is in progress,
+even when it runs plugins on threads of their own (see --plugin_deadline_ms).
+Nor must they load quickly: the emulator loads each plugin only when the Apple
+first uses its block (see `LazyPlugin`), unless told otherwise with the
+--eager_plugins flag. Plugins last for all of the emulator's sessions.
 """
 
 import abc
@@ -40,8 +49,9 @@ import importlib.util
 import logging
 import pathlib
 import threading
+import time
 
-from typing import Dict, Generator, Optional
+from typing import Any, Dict, Generator, List, Optional, Sequence, Tuple
 
 
 SECTOR_SIZE = 532  # Sector size in bytes. Cf. "block size" in spare tables.
@@ -85,6 +95,42 @@ class Plugin(abc.ABC):
     """
     pass
 
+  def prepare(
+      self,
+      block: int,
+      parameters: Sequence[Tuple[int, int]],
+  ) -> List[Optional[bytes]]:
+    """Prepare replies to reads that the Apple is likely to issue next.
+
+    Programs on the Apple often read a plugin's block over and over, counting
+    through values of the 16-bit concatenation of the retry count and sparing
+    threshold parameters (to download a directory listing, for example). After
+    such a read, and while it waits for the Apple's next command, the emulator
+    may call this method with the parameters of the reads it expects next. If
+    the Apple then issues one of those reads before it next writes to the
+    block, the emulator answers it with the prepared reply, without calling
+    `__call__` at all.
+
+    So a plugin should only prepare replies that `__call__` would return if
+    the reads came now, and only if reads have no side effects (or their side
+    effects don't matter); and it should not implement this method at all if
+    its replies can change for reasons besides writes to the block (e.g. the
+    passage of time). Plugins that don't implement this method are never
+    asked to prepare anything.
+
+    Args:
+      block: Block the Apple is reading, as for `__call__`.
+      parameters: (retry count, sparing threshold) parameters of the reads that
+          the Apple may issue next, most likely first.
+
+    Returns:
+      A list with 532 bytes of reply data for each of the reads in
+      `parameters`, or None in place of any reply the plugin won't prepare.
+      The list may be shorter than `parameters`.
+    """
+    del block, parameters  # Unused.
+    return []
+
   def close(self) -> None:
     """Cease operation of the plugin.
 
@@ -166,28 +212,104 @@ class FlushingPlugin(Plugin):
       self.flush()
 
 
-def load_plugins(directory: str = '.') -> Dict[int, Plugin]:
-  """Collect instantiated plugins from the specified directory.
+class LazyPlugin(Plugin):
+  """Stands in for a plugin that hasn't been loaded from its module yet.
 
-  This function will attempt to load plugins from all files whose name
-  "fullmatches" the regex
+  Loading some plugins takes a while (the key/value store opens its database,
+  for example), and the Apple may never use most of them. A LazyPlugin loads
+  its plugin when the Apple first reads or writes the plugin's block, then
+  passes that command and all later ones to it. If loading the plugin fails,
+  the exception is logged, reads get blocks of $00 bytes, and writes are
+  ignored.
 
-     profile_plugin_[0-9A-F]{6}.*\.py
+  A LazyPlugin implements `prepare` on behalf of any plugin, but it only
+  passes calls on to plugins that implement `prepare` themselves; use
+  `can_prepare` to find out whether the plugin does.
 
-  It will attempt to load these files as python modules and invoke a callable
-  called `plugin` inside with no arguments. Exceptions that occur at any point
-  when trying to load a module are logged and ignored.
+  Attributes:
+    load_seconds: How long loading the plugin took, or None if it hasn't been
+        loaded.
+  """
 
-  It us up to the caller to call these plugins' `close` methods when the
-  plugins are no longer required. The `plugins` context manager in this module
-  automates this process.
+  def __init__(self, path: pathlib.Path, block: int) -> None:
+    """Initialise a LazyPlugin.
+
+    Args:
+      path: Path to the plugin's module.
+      block: Block that the plugin will enchant.
+    """
+    self._path = path
+    self._block = block
+    self._plugin = None  # type: Optional[Plugin]
+    self._failed = False
+    self.load_seconds = None  # type: Optional[float]
+
+  def load(self) -> Optional[Plugin]:
+    """Load the plugin if it isn't loaded already, and return it.
+
+    Returns:
+      The plugin, or None if it can't be loaded.
+    """
+    if self._plugin is None and not self._failed:
+      start = time.monotonic()
+      self._plugin = _load_plugin(self._path, self._block)
+      self.load_seconds = time.monotonic() - start
+      self._failed = self._plugin is None
+      logging.info('Plugins: loaded the plugin for block $%06X on first use '
+                   'in %.1f ms.', self._block, 1000 * self.load_seconds)
+    return self._plugin
+
+  @property
+  def loaded(self) -> bool:
+    """Whether an attempt to load the plugin has been made."""
+    return self._plugin is not None or self._failed
+
+  def can_prepare(self) -> bool:
+    """Whether the plugin implements `prepare`, loading it if necessary."""
+    plugin = self._plugin or self.load()
+    return plugin is not None and (
+        type(plugin).prepare is not Plugin.prepare)
+
+  def __call__(
+      self,
+      op: int,
+      block: int,
+      retry_count: int,
+      sparing_threshold: int,
+      data: Optional[bytes],
+  ) -> Optional[bytes]:
+    """Pass the command to the plugin, loading it first if necessary."""
+    plugin = self._plugin or self.load()
+    if plugin is None: return bytes(SECTOR_SIZE) if data is None else None
+    return plugin(op, block, retry_count, sparing_threshold, data)
+
+  def prepare(
+      self,
+      block: int,
+      parameters: Sequence[Tuple[int, int]],
+  ) -> List[Optional[bytes]]:
+    """Have the plugin prepare replies, loading it first if necessary."""
+    if not self.can_prepare(): return []
+    return self._plugin.prepare(block, parameters)  # type: ignore
+
+  def close(self) -> None:
+    """Close the plugin, if it was ever loaded."""
+    if self._plugin is not None: self._plugin.close()
+
+
+def find_plugins(directory: str = '.') -> Dict[int, pathlib.Path]:
+  r"""Find plugin modules in the specified directory without loading them.
+
+  Plugin modules are files whose name "fullmatches" the regex
+
+     profile_plugin_[0-9A-F]{6}.*\.py
 
   Args:
-    directory: Directory to load plugins from.
+    directory: Directory to look for plugins in.
 
   Returns:
-    All plugins loaded from the directory, keyed by the block number specified
-    in their filenames.
+    Paths to all plugin modules in the directory, keyed by the block number
+    specified in their filenames.
 
   Raises:
     ValueError: `directory` was not a directory.
@@ -196,30 +318,73 @@ def load_plugins(directory: str = '.') -> Dict[int, Plugin]:
   if not path.is_dir(): raise ValueError(
       '{} is not a directory'.format(directory))
 
-  plugins = {}  # type: Dict[int, Plugin]
+  paths = {}  # type: Dict[int, pathlib.Path]
   for item in path.glob('profile_plugin_??????*.py'):
     # Get block number for the plugin---again, all hex digits must be uppercase.
     hex_digits = item.name[15:21]
     if not all(d in '0123456789ABCDEF' for d in hex_digits): continue
-    block = int(hex_digits, 16)
-
-    # Try to load and instantiate the plugin. We log and ignore any exception.
-    try:
-      logging.info('Plugins: loading %s...', item.stem)
-      module_spec = importlib.util.spec_from_file_location(item.stem, str(item))
-      module = importlib.util.module_from_spec(module_spec)
-      module_spec.loader.exec_module(module)  # type: ignore
-      plugin = module.plugin()  # type: ignore
-      plugins[block] = plugin
-    except Exception:
-      logging.exception('While attempting to load the plugin for block $%06X '
-                        'from %s', block, item.name)
+    paths[int(hex_digits, 16)] = item
+  return paths
+
+
+def _load_plugin(item: pathlib.Path, block: int) -> Optional[Plugin]:
+  """Load and instantiate a plugin, or log why we couldn't and return None."""
+  try:
+    logging.info('Plugins: loading %s...', item.stem)
+    module_spec = importlib.util.spec_from_file_location(item.stem, str(item))
+    module = importlib.util.module_from_spec(module_spec)
+    module_spec.loader.exec_module(module)  # type: ignore
+    return module.plugin()  # type: ignore
+  except Exception:
+    logging.exception('While attempting to load the plugin for block $%06X '
+                      'from %s', block, item.name)
+    return None
+
+
+def load_plugins(
+    directory: str = '.',
+    lazy: bool = False,
+) -> Dict[int, Plugin]:
+  """Collect instantiated plugins from the specified directory.
+
+  This function will attempt to load plugins from all files that
+  `find_plugins` finds. It will attempt to load these files as python modules
+  and invoke a callable called `plugin` inside with no arguments. Exceptions
+  that occur at any point when trying to load a module are logged and ignored.
+
+  With `lazy`, nothing is loaded yet: each plugin is a `LazyPlugin` that loads
+  the real plugin when the Apple first uses its block.
+
+  It us up to the caller to call these plugins' `close` methods when the
+  plugins are no longer required. The `plugins` context manager in this module
+  automates this process.
+
+  Args:
+    directory: Directory to load plugins from.
+    lazy: Whether to put off loading each plugin until its first use.
+
+  Returns:
+    All plugins loaded from the directory, keyed by the block number specified
+    in their filenames.
 
+  Raises:
+    ValueError: `directory` was not a directory.
+  """
+  plugins = {}  # type: Dict[int, Plugin]
+  for block, item in find_plugins(directory).items():
+    if lazy:
+      plugins[block] = LazyPlugin(item, block)
+    else:
+      plugin = _load_plugin(item, block)
+      if plugin is not None: plugins[block] = plugin
   return plugins
 
 
 @contextlib.contextmanager
-def plugins(directory: str = '.') -> Generator[Dict[int, Plugin], None, None]:
+def plugins(
+    directory: str = '.',
+    lazy: bool = False,
+) -> Generator[Dict[int, Plugin], None, None]:
   """A context manager that loads and automatically closes plugins.
 
   Wraps `load_plugins` in a context manager that calls the `close` method on
@@ -228,14 +393,15 @@ def plugins(directory: str = '.') -> Generator[Dict[int, Plugin], None, None]:
 
   Args:
     directory: Directory to load plugins from.
+    lazy: Passed to `load_plugins`.
 
   Yields:
-    The plugins dict returned by `load_plugins(directory)`.
+    The plugins dict returned by `load_plugins(directory, lazy)`.
 
   Raises:
     ValueError: `directory` was not a directory.
   """
-  plugins = load_plugins(directory)
+  plugins = load_plugins(directory, lazy)
   try:
     yield plugins
   finally:
@@ -246,6 +412,38 @@ def plugins(directory: str = '.') -> Generator[Dict[int, Plugin], None, None]:
         logging.exception('While closing the plugin for block $%06X:', block)
 
 
+# Services that the emulator offers to plugins, by name. See `providing`.
+_services = {}  # type: Dict[str, Any]
+
+
+@contextlib.contextmanager
+def providing(name: str, service: Any) -> Generator[None, None, None]:
+  """A context manager that offers plugins a service from the emulator.
+
+  The emulator uses this to make some of its own objects available to plugins
+  that might want to use or report on them. Within the context, `service(name)`
+  returns `service`. Services that `profile.py` provides include:
+
+     - 'image_pool': the `profile.ImagePool` of open disk images. Plugins can
+       call its `offer` method to suggest disk image files for it to open, and
+       its `stats` method to learn how well it's working.
+
+  Args:
+    name: Name of the service.
+    service: The service itself.
+  """
+  _services[name] = service
+  try:
+    yield
+  finally:
+    del _services[name]
+
+
+def service(name: str) -> Optional[Any]:
+  """Retrieve a service that the emulator offers, or None if it doesn't."""
+  return _services.get(name)
+
+
 class Conclusion(Exception):
   """An exception that concludes the current emulation session.
 
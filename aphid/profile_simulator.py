@@ -0,0 +1,413 @@
+"""A software stand-in for the Aphid PRU1 firmware's side of the RPMsg link.
+
+Forfeited into the public domain with NO WARRANTY. Read LICENSE for details.
+
+The ProFile emulator in `profile.py` only ever talks to the Cameo/Aphid
+hardware through the RPMsg character device that the PRU1 firmware exposes.
+This module imitates PRU1's half of that conversation closely enough for
+`profile.py` to serve an imaginary Apple, which lets us exercise, measure, and
+regress the emulator's hot path on any Linux computer---no PocketBeagle
+required.
+
+A `SimulatedPru1` plays both the Apple and the PRU1 firmware:
+
+   - Acting for the Apple, its `command` method sends the emulator a six-byte
+     ProFile command exactly as PRU1 would forward it.
+
+   - Acting as PRU1, it then services the emulator's requests to get the
+     Apple's sector buffer (`APHD_COMMAND_GET_PART_*` in `profile.py`) and to
+     put data into the drive's sector buffer (`APHD_COMMAND_PUT_PART_*`)
+     until the emulator sends the "go ahead" command (`APHD_COMMAND_GOAHEAD`).
+     The framing of these commands is identical to the framing the firmware
+     expects; see `aphd_pru1_interrupt_and_buffer_handler.cc`.
+
+The simulator needs a file descriptor connected to the emulator. Two kinds are
+supported, and this module has helpers for making either:
+
+   - `socketpair()`: a pair of connected `SOCK_SEQPACKET` Unix sockets, which
+     preserve message boundaries much as the RPMsg character device does. One
+     end goes to `profile.rpmsg_io_init`, the other to `SimulatedPru1`. This is
+     the right choice for driving `profile.profile()` within one process.
+
+   - `open_pty()`: a pseudo-terminal in raw mode. Its slave device path can be
+     handed to a separately-running `profile.py` with the `--device` flag
+     (alongside `--no_leds`, `--skip_pin_setup`, and `--skip_pru_restart`).
+     A pty carries a byte stream with no message boundaries; the simulator
+     copes by parsing the stream into commands, since every command announces
+     its own length.
+
+Like the firmware, the simulator handles every command in a message, not just
+the first, so it also supports the emulator's pipelined transfer mode (see
+`--pipelined_rpmsg` in `profile.py`).
+
+A simulated PRU1 is infinitely fast and infinitely patient: it never drops a
+command or loses data that a busy PRU might. It also ignores everything about
+the Apple parallel port bus itself, including timing.
+
+A separately-running `profile.py` can also go through its whole start-up
+sequence---pin setup, starting the PRU firmware, and waiting for it to come
+up---against a `FakeSysfs`: a directory tree standing in for the parts of
+sysfs that the emulator uses (see `--sysfs_root` in `profile.py`). A thread
+plays the kernel's remoteproc driver, bringing "firmware" up a little while
+after the emulator starts it. `SimulatedPru1.await_bootup` then receives the
+emulator's "bootup" message and answers its handshake.
+
+See `profile_benchmark.py` for a program that uses this simulator to measure
+emulator throughput and start-up time.
+"""
+
+import os
+import pty
+import select
+import socket
+import struct
+import threading
+import time
+import tty
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+SECTOR_SIZE = 532  # Sector size in bytes. Cf. "block size" in spare tables.
+
+# Command magic numbers from the PRU1 firmware. These are the little-endian
+# byte encodings of the kCommand* constants in
+# aphd_pru1_interrupt_and_buffer_handler.cc.
+COMMAND_GET_APPLE_SECTOR_DATA = b'\x8c\xa9\x37\xf1'
+COMMAND_PUT_DRIVE_SECTOR_DATA = b'\xdb\x95\x4b\xc7'
+COMMAND_CHECKSUM_DRIVE_SECTOR_DATA = b'\x9d\xb9\x5b\xa3'
+COMMAND_GO_AHEAD = b'\xa6\x93\x73\xea'
+ALL_COMMANDS = (
+    COMMAND_GET_APPLE_SECTOR_DATA, COMMAND_PUT_DRIVE_SECTOR_DATA,
+    COMMAND_CHECKSUM_DRIVE_SECTOR_DATA, COMMAND_GO_AHEAD)
+
+# Largest RPMsg message payload: 512 bytes, less a 16-byte header.
+RPMSG_MAX_PAYLOAD = 496
+
+# Precomputed even parity lookup table, as a `bytes.translate` table.
+PARITY_TABLE = bytes(
+    0x00 if bin(c).count('1') % 2 else 0xff for c in range(256))
+
+
+class SimulationError(Exception):
+  """The emulator did something that real PRU1 firmware would not abide."""
+
+
+def socketpair() -> Tuple[int, int]:
+  """Make a connected pair of message-preserving sockets.
+
+  Returns:
+    A tuple of two file descriptors. Give the first to the emulator (e.g. via
+    `profile.rpmsg_io_init`) and the second to `SimulatedPru1`. The caller is
+    responsible for closing both.
+  """
+  emulator_end, pru_end = socket.socketpair(
+      socket.AF_UNIX, socket.SOCK_SEQPACKET)
+  return emulator_end.detach(), pru_end.detach()
+
+
+def open_pty() -> Tuple[int, int, str]:
+  """Make a raw-mode pseudo-terminal for an emulator in another process.
+
+  Returns:
+    A tuple of the master file descriptor (for `SimulatedPru1`), the slave file
+    descriptor, and the path to the slave device (for the emulator's
+    `--device` flag). Keep the slave descriptor open for as long as the pty is
+    in use: this keeps the pty alive (and in raw mode) until the emulator opens
+    it. The caller is responsible for closing both descriptors.
+  """
+  master_fd, slave_fd = pty.openpty()
+  tty.setraw(slave_fd)
+  return master_fd, slave_fd, os.ttyname(slave_fd)
+
+
+class FakeSysfs:
+  """A stand-in for the sysfs objects that `profile.py` uses, in a directory.
+
+  This context manager creates files for pinmux states, GPIO directions, the
+  remoteproc state and firmware of both PRUs, and the user LEDs' brightness
+  beneath a root directory, then runs a thread that plays the remoteproc
+  driver: it changes a PRU's state from "start" to "running" `boot_delay`
+  seconds after the emulator writes "start", and from "stop" to "offline"
+  straight away. Pass the root directory to `profile.py --sysfs_root`.
+
+  Attributes:
+    root: The root directory.
+    boots: How many times PRU firmware has been started.
+  """
+
+  def __init__(
+      self,
+      root: str,
+      pinmux_pins: Iterable[str],
+      gpios: Iterable[str],
+      boot_delay: float = 0.0,
+  ) -> None:
+    """Initialise a FakeSysfs.
+
+    Args:
+      root: Directory to make the sysfs objects in, e.g. a temporary directory.
+      pinmux_pins: Header pins with pinmux objects, e.g. 'P1_02'.
+      gpios: GPIO numbers with GPIO objects, e.g. '110'.
+      boot_delay: Seconds that PRU firmware takes to start running.
+    """
+    self.root = root
+    self.boots = 0
+    self._boot_delay = boot_delay
+    remoteprocs = ['sys/class/remoteproc/remoteproc{}/'.format(i)
+                   for i in (1, 2)]
+    self._files = (
+        ['sys/devices/platform/ocp/ocp:{}_pinmux/state'.format(p)
+         for p in pinmux_pins] +
+        ['sys/class/gpio/gpio{}/direction'.format(g) for g in gpios] +
+        ['sys/class/leds/beaglebone:green:usr{}/brightness'.format(i)
+         for i in range(4)] +
+        [r + 'firmware' for r in remoteprocs])
+    self._states = [os.path.join(root, r + 'state') for r in remoteprocs]
+    self._stop = threading.Event()
+    self._thread = None  # type: Optional[threading.Thread]
+
+  def _remoteproc(self) -> None:
+    """Play the remoteproc driver until told to stop."""
+    starting = {}  # type: Dict[str, float]  # When each PRU was started.
+    while not self._stop.wait(0.01):
+      for path in self._states:
+        with open(path, 'r') as f: state = f.read()
+        if state == 'start\n':
+          if path not in starting: self.boots += 1
+          started = starting.setdefault(path, time.monotonic())
+          if time.monotonic() - started < self._boot_delay: continue
+          state = 'running\n'
+        elif state == 'stop\n':
+          state = 'offline\n'
+        else:
+          continue
+        starting.pop(path, None)
+        with open(path, 'w') as f: f.write(state)
+
+  def __enter__(self) -> 'FakeSysfs':
+    """Context manager entry. Make the sysfs objects and start the thread."""
+    for path in self._files:
+      path = os.path.join(self.root, path)
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      with open(path, 'w') as f: f.write('\n')
+    for path in self._states:
+      with open(path, 'w') as f: f.write('offline\n')
+    self._thread = threading.Thread(target=self._remoteproc, name='sysfs')
+    self._thread.start()
+    return self
+
+  def __exit__(self, ex_type, ex_value, traceback):
+    """Context manager exit. Stop the thread (but leave the files)."""
+    del ex_type, ex_value, traceback  # Unused
+    self._stop.set()
+    self._thread.join()
+
+
+class SimulatedPru1:
+  """Simulated PRU1 firmware (and Apple) at the other end of an RPMsg link.
+
+  See the file header comment for an overview.
+
+  Attributes:
+    apple_sector: The 532-byte "Apple sector buffer" that PRU1 fills with data
+        from the Apple during a write. The emulator retrieves it with "get"
+        commands.
+    drive_sector: The 1,064-byte "drive sector buffer" of data/parity byte
+        pairs that PRU1 sends to the Apple during a read. The emulator fills it
+        with "put" commands.
+  """
+
+  def __init__(self, fd: int, timeout: float = 5.0) -> None:
+    """Initialise a SimulatedPru1.
+
+    Args:
+      fd: File descriptor connected to the emulator, probably made by
+          `socketpair()` or `open_pty()`. It will be set to non-blocking mode.
+      timeout: How long in seconds to wait on the emulator for any single
+          message before giving up.
+    """
+    os.set_blocking(fd, False)
+    self._fd = fd
+    self._timeout_ms = int(1000 * timeout)
+    self._poll = select.poll()
+    self._poll.register(fd, select.POLLIN)
+    self._pending = bytearray()  # Received data not yet parsed into commands.
+
+    self.apple_sector = bytearray(SECTOR_SIZE)
+    self.drive_sector = bytearray(2 * SECTOR_SIZE)
+
+  def await_bootup(self, ignore_probes: int = 0) -> None:
+    """Receive the emulator's "bootup" message and answer its handshake.
+
+    The emulator sends PRU1 commands to checksum the drive sector buffer
+    until PRU1 answers one (see `profile.pru1_handshake`). Like the firmware,
+    the simulator takes whatever arrives first as its "bootup" message and
+    discards it, then handles everything that arrives together after that as
+    one message: a run of commands starting at its first byte. Where the
+    firmware would silently stop at anything that isn't a command, though,
+    the simulator complains.
+
+    Args:
+      ignore_probes: Like firmware that isn't listening yet, lose this many
+          deliveries of data from the emulator before the "bootup" message.
+
+    Raises:
+      SimulationError: The emulator sent something besides checksum commands.
+      TimeoutError: The emulator failed to send anything in time.
+    """
+    booted = False
+    while True:
+      if not self._poll.poll(self._timeout_ms): raise TimeoutError(
+          'Timed out waiting for the "bootup" message from the emulator.')
+      try:
+        received = os.read(self._fd, 4096)
+      except BlockingIOError:
+        continue
+      if ignore_probes:
+        ignore_probes -= 1
+      elif not booted:
+        booted = True
+      else:
+        answered = False
+        for offset in range(0, len(received) - 7, 8):
+          if received[offset:offset + 4] != COMMAND_CHECKSUM_DRIVE_SECTOR_DATA:
+            raise SimulationError(
+                'Expected only checksum commands from the emulator, got '
+                '{}'.format(received.hex()))
+          self._send(struct.pack('<H', self._checksum()))
+          answered = True
+        if answered: return
+
+  def command(
+      self,
+      op: int,
+      sector: int,
+      retry_count: int = 0,
+      sparing_threshold: int = 0,
+      data: Optional[bytes] = None,
+  ) -> Optional[bytes]:
+    """Issue a ProFile command to the emulator, then act as PRU1 until done.
+
+    Args:
+      op: ProFile operation byte: $00 for reads, $01..$03 for writes.
+      sector: 24-bit block number to read or write.
+      retry_count: Operation retry count parameter, $00..$FF.
+      sparing_threshold: Operation sparing threshold parameter, $00..$FF.
+      data: For writes, the 532 bytes of data that the Apple is writing.
+          Ignored for reads.
+
+    Returns:
+      For reads, the 532 bytes of data that the emulator placed in the drive
+      sector buffer, with the parity bytes stripped away. For writes, None.
+
+    Raises:
+      SimulationError: The emulator misbehaved, e.g. by sending a malformed
+          command or incorrect parity bytes.
+      TimeoutError: The emulator failed to respond in time.
+    """
+    if op != 0x00:
+      if data is None or len(data) != SECTOR_SIZE: raise ValueError(
+          'Writes must supply exactly {} bytes of data'.format(SECTOR_SIZE))
+      self.apple_sector[:] = data
+
+    self._send(struct.pack('>BBHBB', op, sector >> 16, sector & 0xffff,
+                           retry_count, sparing_threshold))
+    self.serve_until_goahead()
+
+    if op != 0x00: return None
+    return self.sector_data()
+
+  def sector_data(self) -> bytes:
+    """Retrieve data from the drive sector buffer, checking parity.
+
+    Returns:
+      The 532 data bytes in the drive sector buffer.
+
+    Raises:
+      SimulationError: A parity byte in the drive sector buffer was incorrect.
+    """
+    data = bytes(self.drive_sector[0::2])
+    if self.drive_sector[1::2] != data.translate(PARITY_TABLE):
+      raise SimulationError('Drive sector buffer has incorrect parity bytes.')
+    return data
+
+  def serve_until_goahead(self) -> None:
+    """Service commands from the emulator until a "go ahead" command arrives.
+
+    Raises:
+      SimulationError: The emulator sent a malformed command.
+      TimeoutError: The emulator failed to respond in time.
+    """
+    while True:
+      for magic, start, length, payload in self._receive_commands():
+        if magic == COMMAND_GO_AHEAD:
+          if self._pending: raise SimulationError(
+              'The emulator sent data after a "go ahead" command.')
+          return
+        elif magic == COMMAND_GET_APPLE_SECTOR_DATA:
+          self._send(self.apple_sector[start:start + length])
+        elif magic == COMMAND_PUT_DRIVE_SECTOR_DATA:
+          end = min(start + length, len(self.drive_sector))
+          self.drive_sector[start:end] = payload[:max(0, end - start)]
+        elif magic == COMMAND_CHECKSUM_DRIVE_SECTOR_DATA:
+          self._send(struct.pack('<H', self._checksum()))
+
+  def _checksum(self) -> int:
+    """Compute the checksum the firmware reports for the drive sector buffer.
+
+    This mimics `handle_checksum_drive_sector_data_command` in
+    aphd_pru1_interrupt_and_buffer_handler.cc, quirks and all.
+    """
+    checksum = 0
+    for byte in self.drive_sector:
+      checksum = (checksum + byte) & 0xffff
+      carry = (checksum & 0x8000) >> 15
+      checksum = (checksum << (1 + carry)) & 0xffff
+    return checksum
+
+  def _receive_commands(self) -> List[Tuple[bytes, int, int, bytes]]:
+    """Wait for data from the emulator and parse it into commands.
+
+    Returns:
+      A list of (magic, start_byte, length_bytes, payload) tuples, one for each
+      complete command received. The list may be empty if only part of a
+      command has arrived so far.
+
+    Raises:
+      SimulationError: The emulator sent a message with no recognisable
+          command in it.
+      TimeoutError: The emulator failed to send anything in time.
+    """
+    if not self._poll.poll(self._timeout_ms): raise TimeoutError(
+        'Timed out waiting for a command from the emulator.')
+    try:
+      received = os.read(self._fd, 4096)
+    except BlockingIOError:
+      return []
+    if not received: raise SimulationError(
+        'The emulator closed the connection.')
+    if len(received) > RPMSG_MAX_PAYLOAD and not os.isatty(self._fd):
+      raise SimulationError('The emulator sent a {}-byte message; RPMsg '
+                            'messages are limited to {} bytes.'.format(
+                                len(received), RPMSG_MAX_PAYLOAD))
+    self._pending += received
+
+    commands = []
+    while len(self._pending) >= 8:
+      magic = bytes(self._pending[:4])
+      if magic not in ALL_COMMANDS: raise SimulationError(
+          'Unrecognised command from the emulator: {}'.format(
+              self._pending[:8].hex()))
+      start, length = struct.unpack('<HH', self._pending[4:8])
+      payload_length = length if magic == COMMAND_PUT_DRIVE_SECTOR_DATA else 0
+      if len(self._pending) < 8 + payload_length: break  # Wait for the rest.
+      payload = bytes(self._pending[8:8 + payload_length])
+      del self._pending[:8 + payload_length]
+      commands.append((magic, start, length, payload))
+    return commands
+
+  def _send(self, data: bytes) -> None:
+    """Send one RPMsg "message" to the emulator."""
+    if os.write(self._fd, data) != len(data): raise SimulationError(
+        'Failed to send a complete message to the emulator.')
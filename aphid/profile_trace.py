@@ -0,0 +1,282 @@
+#!/usr/bin/python3
+"""Command traces for the ProFile emulator, and a program for studying them.
+
+Forfeited into the public domain with NO WARRANTY. Read LICENSE for details.
+
+With the --trace flag, the emulator in `profile.py` records every command the
+Apple issues in a `TraceRecorder`: when it arrived, the operation, the sector,
+the retry count and sparing threshold parameters, and how long the emulator
+took to service it. Records go into a fixed-size ring buffer in memory, which
+is appended to the trace file whenever the emulator flushes changes to the
+disk image, and when the emulator shuts down. If the Apple issues more
+commands between these times than the ring buffer holds, the oldest are lost
+(and the loss is logged).
+
+With the --trace_data flag as well, each record also holds the 532 bytes of
+sector data that the emulator sent to the Apple (for reads) or received from
+it (for writes). Traces like these can be replayed through the emulator with
+`profile_benchmark.py replay`, which checks that the emulator still returns
+the same data for each read. They take much more memory, so choose
+--trace_events with care.
+
+A trace file starts with a 16-byte header: the magic number `b'APTR0001'`
+(or `b'APTR0002'` if records hold sector data), then the wall-clock time when
+recording started as a little-endian double (seconds since the Unix epoch).
+Then come 20-byte records (see `_RECORD`), each followed by 532 bytes of
+sector data if the magic number is `b'APTR0002'`:
+
+    Bytes  0-7: Microseconds since recording started (little-endian)
+    Bytes 8-11: Sector (little-endian)
+    Byte    12: ProFile operation byte ($00 for reads, $01..$03 for writes)
+    Byte    13: Retry count parameter
+    Byte    14: Sparing threshold parameter
+    Byte    15: Unused
+    Byte 16-19: Microseconds taken to service the command (little-endian)
+
+Run this module as a program to summarise a trace: it prints a "heatmap" of
+reads and writes to ranges of sectors, with service time percentiles for
+each range, and a histogram of service times. Use the --help flag for details.
+"""
+
+import argparse
+import logging
+import os
+import struct
+import threading
+import time
+
+from typing import Dict, List, Optional, Tuple, Union
+
+
+TRACE_MAGIC = b'APTR0001'
+TRACE_DATA_MAGIC = b'APTR0002'  # For traces whose records hold sector data.
+DEFAULT_EVENTS = 65536  # Default ring buffer capacity in records.
+SECTOR_SIZE = 532  # Sector size in bytes.
+
+_HEADER = struct.Struct('<8sd')
+_RECORD = struct.Struct('<QLBBBxL')
+
+
+class TraceRecorder:
+  """Records the Apple's commands in a ring buffer and saves them to a file.
+
+  See the file header comment for an overview. `record` is meant to be called
+  from the emulator's main thread; `dump` may be called from another thread
+  (e.g. the `ImageFlusher` thread).
+
+  Attributes:
+    recorded: How many records have been recorded.
+    lost: How many records were overwritten before they could be saved.
+  """
+
+  def __init__(
+      self,
+      path: str,
+      events: int = DEFAULT_EVENTS,
+      data: bool = False,
+  ) -> None:
+    """Initialise a TraceRecorder, creating (or emptying) the trace file.
+
+    Args:
+      path: Path to the trace file.
+      events: How many records the ring buffer holds.
+      data: Whether records also hold the sector data read or written.
+    """
+    self._path = path
+    self._events = events
+    self._data = data
+    self._size = _RECORD.size + (SECTOR_SIZE if data else 0)  # Record size.
+    self._buffer = bytearray(events * self._size)
+    self._lock = threading.Lock()  # Guards everything below.
+    self._start_ns = time.monotonic_ns()
+    self.recorded = 0
+    self.dumped = 0  # How many records have been saved or lost.
+    self.lost = 0
+    with open(path, 'wb') as f:
+      f.write(_HEADER.pack(TRACE_DATA_MAGIC if data else TRACE_MAGIC,
+                           time.time()))
+
+  def start(self) -> int:
+    """Mark the moment a command arrives; pass the result to `record`."""
+    return time.monotonic_ns()
+
+  def record(
+      self,
+      started: int,
+      op: int,
+      sector: int,
+      retry_count: int,
+      sparing_threshold: int,
+      data: Optional[Union[bytes, memoryview]] = None,
+  ) -> None:
+    """Record a command that the emulator has just finished servicing.
+
+    Args:
+      started: What `start` returned when the command arrived.
+      op: ProFile operation byte.
+      sector: Sector the command read or wrote.
+      retry_count: Retry count parameter.
+      sparing_threshold: Sparing threshold parameter.
+      data: The 532 bytes of sector data read or written. Ignored unless the
+          TraceRecorder was made to record sector data.
+    """
+    now = time.monotonic_ns()
+    with self._lock:
+      offset = (self.recorded % self._events) * self._size
+      _RECORD.pack_into(
+          self._buffer, offset,
+          (started - self._start_ns) // 1000, sector, op, retry_count,
+          sparing_threshold, (now - started) // 1000)
+      if self._data:
+        offset += _RECORD.size
+        if data is None or len(data) != SECTOR_SIZE: data = bytes(SECTOR_SIZE)
+        self._buffer[offset:offset + SECTOR_SIZE] = data
+      self.recorded += 1
+
+  def dump(self) -> None:
+    """Append all records not yet saved to the trace file."""
+    with self._lock:
+      first = max(self.dumped, self.recorded - self._events)
+      lost = first - self.dumped
+      count = self.recorded - first
+      start = (first % self._events) * self._size
+      end = start + count * self._size
+      data = bytes(self._buffer[start:end])
+      if end > len(self._buffer):  # The records wrap around.
+        data += self._buffer[:end - len(self._buffer)]
+      self.dumped = self.recorded
+    if lost:
+      self.lost += lost
+      logging.warning('Trace: %d records were lost before they could be '
+                      'saved.', lost)
+    if data:
+      with open(self._path, 'ab') as f:
+        f.write(data)
+
+  def __enter__(self) -> 'TraceRecorder':
+    return self
+
+  def __exit__(self, ex_type, ex_value, traceback):
+    """Context manager exit. Save all records not yet saved."""
+    del ex_type, ex_value, traceback  # Unused
+    self.dump()
+    logging.info('Trace: %d records saved to %s.',
+                 self.recorded - self.lost, self._path)
+
+
+def read_trace(path: str) -> Tuple[
+    float, List[Tuple[int, int, int, int, int, int]], Optional[List[bytes]]]:
+  """Read a trace file.
+
+  Args:
+    path: Path to the trace file.
+
+  Returns:
+    The wall-clock time when recording started; a list of
+    (microseconds since start, sector, op, retry count, sparing threshold,
+    service microseconds) tuples, one for each record; and, if the records
+    hold sector data, a list of the data for each record (else None).
+
+  Raises:
+    ValueError: The file at `path` isn't a trace file.
+  """
+  with open(path, 'rb') as f:
+    contents = f.read()
+  if len(contents) < _HEADER.size: raise ValueError(
+      '{} is too small to be a trace file.'.format(path))
+  magic, start_time = _HEADER.unpack_from(contents)
+  if magic not in (TRACE_MAGIC, TRACE_DATA_MAGIC): raise ValueError(
+      '{} is not a trace file.'.format(path))
+  if magic == TRACE_MAGIC:
+    body = memoryview(contents)[_HEADER.size:]
+    body = body[:len(body) - len(body) % _RECORD.size]  # Ignore a torn record.
+    return start_time, list(_RECORD.iter_unpack(body)), None
+
+  size = _RECORD.size + SECTOR_SIZE
+  offsets = range(_HEADER.size, len(contents) - size + 1, size)
+  return (start_time, [_RECORD.unpack_from(contents, o) for o in offsets],
+          [contents[o + _RECORD.size:o + size] for o in offsets])
+
+
+###########################
+#### Analysis program ####
+###########################
+
+
+def _define_flags() -> argparse.ArgumentParser:
+  """Defines an `ArgumentParser` for command-line flags used by this program."""
+
+  flags = argparse.ArgumentParser(
+      description='Summarise a ProFile emulator command trace.')
+  flags.add_argument(
+      '--range_sectors', type=int, default=512, help=(
+          'Size of the sector ranges in the heatmap.'))
+  flags.add_argument(
+      '--width', type=int, default=40, help=(
+          'Width of the bars in the heatmap.'))
+  flags.add_argument(
+      'trace_file', type=str, help='Trace file recorded by profile.py --trace.')
+
+  return flags
+
+
+def _percentile(ordered: List[int], fraction: float) -> int:
+  """Nearest-rank percentile of an ordered list."""
+  return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def main(FLAGS: argparse.Namespace):
+  start_time, records, _ = read_trace(FLAGS.trace_file)
+  print('Trace {} started {}: {} commands over {:.1f} seconds.'.format(
+      FLAGS.trace_file, time.strftime('%Y-%m-%d %H:%M:%S',
+                                      time.localtime(start_time)),
+      len(records), records[-1][0] / 1e6 if records else 0.0))
+  if not records: return
+
+  # Gather reads, writes, and service times for each sector range. Magic
+  # blocks (spare table, plugins, etc.) get ranges of their own.
+  ranges = {}  # type: Dict[Tuple[int, int], Tuple[List[int], List[int]]]
+  for _, sector, op, _, _, micros in records:
+    if sector >= 0xff0000:
+      key = (sector, sector)
+    else:
+      first = sector - sector % FLAGS.range_sectors
+      key = (first, first + FLAGS.range_sectors - 1)
+    reads, writes = ranges.setdefault(key, ([], []))
+    (reads if op == 0x00 else writes).append(micros)
+
+  busiest = max(len(r) + len(w) for r, w in ranges.values())
+  print()
+  print('{:>15} {:>7} {:>7}  {:<{width}} {:>7} {:>7} {:>8}'.format(
+      'Sectors', 'Reads', 'Writes', 'Activity', 'p50 us', 'p99 us', 'max us',
+      width=FLAGS.width))
+  for (first, last), (reads, writes) in sorted(ranges.items()):
+    times = sorted(reads + writes)
+    bar = round(FLAGS.width * len(times) / busiest)
+    print('{:>15} {:>7} {:>7}  {:<{width}} {:>7} {:>7} {:>8}'.format(
+        '${:06X}'.format(first) if first == last else
+        '${:06X}-${:06X}'.format(first, last),
+        len(reads), len(writes),
+        '#' * (bar - bar * len(writes) // len(times)) +
+        'W' * (bar * len(writes) // len(times)),
+        _percentile(times, 0.5), _percentile(times, 0.99), times[-1],
+        width=FLAGS.width))
+
+  # Histogram of service times in power-of-two buckets.
+  buckets = {}  # type: Dict[int, int]
+  for record in records:
+    bucket = max(0, record[5] - 1).bit_length()
+    buckets[bucket] = buckets.get(bucket, 0) + 1
+  most = max(buckets.values())
+  print()
+  print('Service times:')
+  for bucket in range(min(buckets), max(buckets) + 1):
+    count = buckets.get(bucket, 0)
+    print('  <= {:>8} us {:>7}  {}'.format(
+        1 << bucket, count, '#' * round(FLAGS.width * count / most)))
+
+
+if __name__ == '__main__':
+  flags = _define_flags()
+  FLAGS = flags.parse_args()
+  main(FLAGS)